@@ -1,5 +1,79 @@
-from statistics import median
-from typing import List
+from typing import List, Sequence
+from datetime import datetime, timedelta
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from .models import Stat
+from . import archive
+
+# Оси, по которым считается статистика
+AXES = ("x", "y", "z")
+
+# Процентили, которые describe считает по умолчанию
+DEFAULT_PERCENTILES = (25, 75, 95, 99)
+
+def _select_quantiles(columns: np.ndarray, quantiles: Sequence[float]) -> np.ndarray:
+    """
+    Квантили по строкам массива столбцов через частичную сортировку (np.partition) вместо полной.
+    Интерполяция линейная, как в statistics.median и numpy.percentile.
+    :return: Массив формы (число столбцов, len(quantiles)).
+    """
+    count = columns.shape[1]
+    positions = np.asarray(quantiles, dtype=np.float64) * (count - 1)
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.ceil(positions).astype(np.int64)
+    # Одна частичная сортировка ставит на свои места все нужные порядковые статистики
+    selected = np.partition(columns, np.unique(np.concatenate([lower, upper])), axis=1)
+    return selected[:, lower] + (selected[:, upper] - selected[:, lower]) * (positions - lower)
+
+def describe(values, percentiles: Sequence[float] = DEFAULT_PERCENTILES, axes: Sequence[str] = AXES):
+    """
+    Статистика сразу по всем столбцам массива N×len(axes) за один вызов.
+    :param values: Массив N×3 со значениями x, y, z.
+    :param percentiles: Процентили (0-100), которые нужно посчитать дополнительно к медиане.
+    :return: Словарь {ось: {"min", "max", "count", "sum", "mean", "std", "median", "percentiles"}}.
+    """
+    values = np.asarray(values, dtype=np.float64).reshape(-1, len(axes))
+    count = values.shape[0]
+    if not count:
+        return {
+            axis: {
+                "min": None,
+                "max": None,
+                "count": 0,
+                "sum": 0,
+                "mean": None,
+                "std": None,
+                "median": None,
+                "percentiles": {f"p{p:g}": None for p in percentiles}
+            }
+            for axis in axes
+        }
+
+    # Столбцы в непрерывной памяти: проходы по каждой оси идут последовательно
+    columns = np.ascontiguousarray(values.T)
+    mins = columns.min(axis=1)
+    maxs = columns.max(axis=1)
+    sums = columns.sum(axis=1)
+    means = sums / count
+    stds = columns.std(axis=1)
+    quantiles = _select_quantiles(columns, [0.5] + [p / 100 for p in percentiles])
+
+    return {
+        axis: {
+            "min": float(mins[i]),
+            "max": float(maxs[i]),
+            "count": count,
+            "sum": float(sums[i]),
+            "mean": float(means[i]),
+            "std": float(stds[i]),
+            "median": float(quantiles[i, 0]),
+            "percentiles": {
+                f"p{p:g}": float(quantiles[i, j + 1]) for j, p in enumerate(percentiles)
+            }
+        }
+        for i, axis in enumerate(axes)
+    }
 
 def calculate_statistics(data: List[float]):
     """
@@ -7,7 +81,7 @@ def calculate_statistics(data: List[float]):
     :param data: Список чисел.
     :return: Словарь с результатами анализа.
     """
-    if not data:
+    if not len(data):
         return {
             "min": None,
             "max": None,
@@ -15,10 +89,65 @@ def calculate_statistics(data: List[float]):
             "sum": 0,
             "median": None
         }
-    return {
-        "min": min(data),
-        "max": max(data),
-        "count": len(data),
-        "sum": sum(data),
-        "median": median(data)
-    }
\ No newline at end of file
+    stats = describe(data, percentiles=(), axes=("value",))["value"]
+    return {key: stats[key] for key in ("min", "max", "count", "sum", "median")}
+
+def aggregate_stats(db: Session, device_id: int, start_time: datetime, end_time: datetime,
+                    with_median: bool = False):
+    """
+    Вычисляет count/min/max/sum/avg по осям x, y, z одним агрегирующим запросом в БД.
+    Строки статистики не загружаются в Python.
+    :param with_median: Дополнительно вычислить медиану через percentile_cont.
+    :return: Словарь {"count": n, "x": {...}, "y": {...}, "z": {...}}.
+    """
+    archived = archive.read_values(
+        db, device_id, device_id, [(start_time, end_time + timedelta(microseconds=1))]
+    ).get(device_id)
+    if archived is not None:
+        # Часть периода в архивных сегментах: точный расчет по объединенным значениям
+        hot = db.query(Stat.x, Stat.y, Stat.z).filter(
+            Stat.device_id == device_id,
+            Stat.timestamp >= start_time,
+            Stat.timestamp <= end_time
+        ).all()
+        hot = np.array([tuple(row) for row in hot], dtype=np.float64).reshape(-1, len(AXES))
+        values = np.concatenate([hot, archived])
+        stats = describe(values, percentiles=())
+        result = {"count": len(values)}
+        for axis in AXES:
+            keys = ("min", "max", "count", "sum", "median") if with_median else ("min", "max", "count", "sum")
+            result[axis] = dict({key: stats[axis][key] for key in keys}, avg=stats[axis]["mean"])
+        return result
+
+    columns = [func.count()]
+    for axis in AXES:
+        column = getattr(Stat, axis)
+        columns += [func.min(column), func.max(column), func.sum(column), func.avg(column)]
+        if with_median:
+            columns.append(func.percentile_cont(0.5).within_group(column))
+
+    row = db.query(*columns).filter(
+        Stat.device_id == device_id,
+        Stat.timestamp >= start_time,
+        Stat.timestamp <= end_time
+    ).one()
+
+    count = row[0]
+    result = {"count": count}
+    values = iter(row[1:])
+    for axis in AXES:
+        axis_stats = {
+            "min": next(values),
+            "max": next(values),
+            "count": count,
+            "sum": next(values) or 0,
+            "avg": next(values)
+        }
+        if with_median:
+            axis_stats["median"] = next(values)
+        result[axis] = axis_stats
+    return result
+
+def to_statistics(axis_stats: dict):
+    """Приводит агрегаты оси к формату calculate_statistics."""
+    return {key: axis_stats.get(key) for key in ("min", "max", "count", "sum", "median")}
@@ -0,0 +1,248 @@
+"""
+Холодное хранение старой статистики в колоночных сегментах.
+
+Задача archive_stats (celery beat, раз в сутки) переносит записи stats старше STATS_ARCHIVE_AFTER_DAYS дней
+в сегменты по устройству и календарному месяцу: каталог STATS_ARCHIVE_DIR/<device id>/<YYYY-MM>-<версия>
+с файлами timestamp.npy (int64, микросекунды UTC, по возрастанию), x.npy, y.npy, z.npy (float64).
+Индекс сегментов - таблица stat_segments. Удаление строк из stats и обновление индекса выполняются
+одной транзакцией; сегмент не изменяется, поздние записи за архивный месяц сливаются в новую версию.
+
+Агрегаты stat_rollups при архивации не удаляются, поэтому полные часовые корзины по-прежнему читаются из них,
+а сегменты нужны только для крайних неполных корзин и точного расчета. Файлы открываются через np.load(mmap_mode="r"):
+нужный диапазон находится двоичным поиском по timestamp и читается последовательно, без загрузки сегмента целиком.
+"""
+import logging
+import os
+import shutil
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+import numpy as np
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from .models import StatSegment
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Пустой каталог - архив отключен
+ARCHIVE_DIR = os.getenv("STATS_ARCHIVE_DIR", "")
+ARCHIVE_AFTER_DAYS = int(os.getenv("STATS_ARCHIVE_AFTER_DAYS", "365"))
+# Сколько сегментов (устройство, месяц) обрабатывается за один запуск задачи
+ARCHIVE_MAX_SEGMENTS = int(os.getenv("STATS_ARCHIVE_MAX_SEGMENTS", "1000"))
+
+AXES = ("x", "y", "z")
+COLUMNS = ("timestamp",) + AXES
+
+# Месяцы устройств со старыми записями; на секционированной таблице читаются только старые секции
+CANDIDATES_SQL = """
+SELECT DISTINCT device_id, date_trunc('month', "timestamp") AS period_start
+FROM stats
+WHERE "timestamp" < :cutoff
+ORDER BY period_start, device_id
+LIMIT :limit
+"""
+
+MOVE_SQL = """
+DELETE FROM stats
+WHERE device_id = :device_id AND "timestamp" >= :period_start AND "timestamp" < :period_end
+RETURNING "timestamp", x, y, z
+"""
+
+def enabled() -> bool:
+    return bool(ARCHIVE_DIR)
+
+def month_floor(value: datetime) -> datetime:
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def next_month(value: datetime) -> datetime:
+    return month_floor(month_floor(value) + timedelta(days=32))
+
+def _to_us(value) -> np.ndarray:
+    return np.asarray(value, dtype="datetime64[us]").astype(np.int64)
+
+def _open(path: str) -> Dict[str, np.ndarray]:
+    return {
+        name: np.load(os.path.join(ARCHIVE_DIR, path, f"{name}.npy"), mmap_mode="r")
+        for name in COLUMNS
+    }
+
+def _write(device_id: int, period_start: datetime, columns: Dict[str, np.ndarray]) -> str:
+    """Записывает новую версию сегмента во временный каталог и переименовывает его. :return: Путь от ARCHIVE_DIR."""
+    path = os.path.join(str(device_id), f"{period_start:%Y-%m}-{uuid.uuid4().hex[:8]}")
+    final = os.path.join(ARCHIVE_DIR, path)
+    temporary = f"{final}.tmp"
+    os.makedirs(temporary)
+    for name in COLUMNS:
+        with open(os.path.join(temporary, f"{name}.npy"), "wb") as file:
+            np.save(file, columns[name])
+            file.flush()
+            os.fsync(file.fileno())
+    os.rename(temporary, final)
+    return path
+
+def archive_month(db: Session, device_id: int, period_start: datetime) -> int:
+    """
+    Переносит записи устройства за месяц из stats в сегмент (существующий сегмент сливается с ними).
+    :return: Количество перенесенных записей.
+    """
+    rows = db.execute(text(MOVE_SQL), {
+        "device_id": device_id,
+        "period_start": period_start,
+        "period_end": next_month(period_start)
+    }).fetchall()
+    if not rows:
+        db.rollback()
+        return 0
+
+    columns = {"timestamp": _to_us([row.timestamp for row in rows])}
+    for axis in AXES:
+        columns[axis] = np.array([getattr(row, axis) for row in rows], dtype=np.float64)
+    segment = db.query(StatSegment).filter(
+        StatSegment.device_id == device_id,
+        StatSegment.period_start == period_start
+    ).with_for_update().one_or_none()
+    previous_path = segment.path if segment else None
+    if previous_path:
+        previous = _open(previous_path)
+        columns = {name: np.concatenate([previous[name], columns[name]]) for name in COLUMNS}
+    order = np.argsort(columns["timestamp"], kind="stable")
+    columns = {name: np.ascontiguousarray(values[order]) for name, values in columns.items()}
+
+    path = _write(device_id, period_start, columns)
+    if segment is None:
+        segment = StatSegment(device_id=device_id, period_start=period_start)
+        db.add(segment)
+    segment.path = path
+    segment.count = len(order)
+    segment.first_timestamp = np.datetime64(int(columns["timestamp"][0]), "us").astype(datetime)
+    segment.last_timestamp = np.datetime64(int(columns["timestamp"][-1]), "us").astype(datetime)
+    try:
+        db.commit()
+    except Exception:
+        db.rollback()
+        shutil.rmtree(os.path.join(ARCHIVE_DIR, path), ignore_errors=True)
+        raise
+    if previous_path:
+        shutil.rmtree(os.path.join(ARCHIVE_DIR, previous_path), ignore_errors=True)
+    return len(rows)
+
+def run(db: Session, now: datetime = None) -> dict:
+    """Архивирует полные месяцы, закончившиеся раньше чем STATS_ARCHIVE_AFTER_DAYS дней назад"""
+    cutoff = month_floor((now or datetime.utcnow()) - timedelta(days=ARCHIVE_AFTER_DAYS))
+    candidates = db.execute(text(CANDIDATES_SQL), {"cutoff": cutoff, "limit": ARCHIVE_MAX_SEGMENTS}).fetchall()
+    db.rollback()
+    rows = 0
+    for device_id, period_start in candidates:
+        rows += archive_month(db, device_id, period_start)
+    return {"cutoff": cutoff.isoformat(), "segments": len(candidates), "rows": rows}
+
+def delete_segments(db: Session, device_id: int, before: datetime) -> int:
+    """Удаляет сегменты устройства за месяцы, целиком закончившиеся до before. :return: Количество записей в них."""
+    segments = db.query(StatSegment).filter(
+        StatSegment.device_id == device_id,
+        StatSegment.period_start < month_floor(before)
+    ).all()
+    if not segments:
+        return 0
+    paths = [segment.path for segment in segments]
+    rows = sum(segment.count for segment in segments)
+    for segment in segments:
+        db.delete(segment)
+    db.commit()
+    for path in paths:
+        shutil.rmtree(os.path.join(ARCHIVE_DIR, path), ignore_errors=True)
+    return rows
+
+def _slice(columns: Dict[str, np.ndarray], intervals) -> List[np.ndarray]:
+    timestamps = columns["timestamp"]
+    parts = []
+    for start, end in intervals:
+        first, last = np.searchsorted(timestamps, _to_us([start, end]), side="left")
+        if last > first:
+            parts.append(np.column_stack([columns[axis][first:last] for axis in AXES]))
+    return parts
+
+def _open_segment(db: Session, device_id: int, period_start: datetime, path: str) -> Dict[str, np.ndarray]:
+    try:
+        return _open(path)
+    except FileNotFoundError:
+        # Сегмент заменен новой версией после чтения индекса
+        path = db.query(StatSegment.path).filter(
+            StatSegment.device_id == device_id,
+            StatSegment.period_start == period_start
+        ).scalar()
+        return _open(path)
+
+def read_values(db: Session, first_id: int, last_id: int, intervals: List[Tuple[datetime, datetime]]):
+    """
+    Архивные значения x, y, z устройств с id в [first_id, last_id], попавшие в полуинтервалы [начало, конец).
+    :return: Словарь {id устройства: массив N×3}, устройства без архивных записей в периоде отсутствуют.
+    """
+    intervals = [(start, end) for start, end in intervals if end > start]
+    if not enabled() or not intervals:
+        return {}
+    with metrics.span("archive"):
+        segments = db.query(StatSegment.device_id, StatSegment.period_start, StatSegment.path).filter(
+            StatSegment.device_id.between(first_id, last_id),
+            StatSegment.first_timestamp < max(end for _, end in intervals),
+            StatSegment.last_timestamp >= min(start for start, _ in intervals)
+        ).order_by(StatSegment.device_id, StatSegment.period_start).all()
+        parts = {}
+        for device_id, period_start, path in segments:
+            columns = _open_segment(db, device_id, period_start, path)
+            parts.setdefault(device_id, []).extend(_slice(columns, intervals))
+        return {device_id: np.concatenate(values) for device_id, values in parts.items() if values}
+
+def read_windows(db: Session, windows) -> dict:
+    """
+    Архивные значения для нескольких окон одним запросом к индексу сегментов.
+    :param windows: Список (ключ, id устройства, полуинтервалы [начало, конец)).
+    :return: Словарь {ключ: массив N×3}, окна без архивных записей отсутствуют.
+    """
+    windows = [
+        (key, device_id, [(start, end) for start, end in intervals if end > start])
+        for key, device_id, intervals in windows
+    ]
+    windows = [window for window in windows if window[2]]
+    if not enabled() or not windows:
+        return {}
+    with metrics.span("archive"):
+        segments = db.query(
+            StatSegment.device_id, StatSegment.period_start, StatSegment.path,
+            StatSegment.first_timestamp, StatSegment.last_timestamp
+        ).filter(
+            StatSegment.device_id.in_({device_id for _, device_id, _ in windows}),
+            StatSegment.first_timestamp < max(end for _, _, intervals in windows for _, end in intervals),
+            StatSegment.last_timestamp >= min(start for _, _, intervals in windows for start, _ in intervals)
+        ).order_by(StatSegment.device_id, StatSegment.period_start).all()
+        by_device = {}
+        for segment in segments:
+            by_device.setdefault(segment.device_id, []).append(segment)
+        result = {}
+        for key, device_id, intervals in windows:
+            parts = []
+            for segment in by_device.get(device_id, ()):
+                if any(start <= segment.last_timestamp and end > segment.first_timestamp for start, end in intervals):
+                    columns = _open_segment(db, device_id, segment.period_start, segment.path)
+                    parts.extend(_slice(columns, intervals))
+            if parts:
+                result[key] = np.concatenate(parts)
+        return result
+
+def merge_aggregates(result: dict, values: np.ndarray) -> dict:
+    """Добавляет архивные значения N×3 к агрегатам в формате analitics.aggregate_stats (без медианы)"""
+    count = result["count"] + len(values)
+    result["count"] = count
+    for i, axis in enumerate(AXES):
+        column = values[:, i][~np.isnan(values[:, i])]
+        axis_stats = result[axis]
+        axis_stats["count"] = count
+        axis_stats["sum"] = (axis_stats["sum"] or 0) + float(column.sum())
+        axis_stats["avg"] = axis_stats["sum"] / count if count else None
+        if len(column):
+            bounds = [float(column.min()), float(column.max())]
+            if axis_stats["min"] is not None:
+                bounds += [axis_stats["min"], axis_stats["max"]]
+            axis_stats["min"], axis_stats["max"] = min(bounds), max(bounds)
+    return result
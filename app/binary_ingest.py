@@ -0,0 +1,109 @@
+"""
+Двоичный формат загрузки статистики application/vnd.stats.v1+octet-stream.
+
+Заголовок, 8 байт, little-endian:
+  magic   2 байта  b"ST"
+  version uint8    1
+  flags   uint8    бит 0: значения float64 вместо float32
+  count   uint32   количество записей
+
+Записи сразу за заголовком, little-endian, без выравнивания:
+  timestamp int64    микросекунды от 1970-01-01 UTC
+  x, y, z   float32  (float64 при флаге FLAG_FLOAT64)
+
+Тело разбирается np.frombuffer без копирования и без объектов Python на запись и передается в Postgres
+через COPY в двоичном формате, собранном векторно.
+"""
+import struct
+import numpy as np
+from fastapi import HTTPException
+
+MEDIA_TYPE = "application/vnd.stats.v1+octet-stream"
+
+MAGIC = b"ST"
+VERSION = 1
+FLAG_FLOAT64 = 0x01
+HEADER = struct.Struct("<2sBBI")
+
+# Максимальное количество записей в одном запросе
+MAX_BINARY_RECORDS = 200000
+# Допустимые метки времени, микросекунды Unix: диапазон datetime Python (годы 1-9999)
+MIN_TIMESTAMP_US = -62135596800 * 1000000
+MAX_TIMESTAMP_US = 253402300800 * 1000000 - 1
+
+def record_dtype(flags: int) -> np.dtype:
+    value = "<f8" if flags & FLAG_FLOAT64 else "<f4"
+    return np.dtype([("timestamp", "<i8"), ("x", value), ("y", value), ("z", value)])
+
+def encode(timestamps_us, values, float64: bool = False) -> bytes:
+    """
+    Тело запроса для массива меток времени (микросекунды Unix) и массива N×3 значений.
+    Используется клиентами и нагрузочными тестами.
+    """
+    flags = FLAG_FLOAT64 if float64 else 0
+    values = np.asarray(values).reshape(-1, 3)
+    records = np.empty(len(values), dtype=record_dtype(flags))
+    records["timestamp"] = timestamps_us
+    records["x"], records["y"], records["z"] = values[:, 0], values[:, 1], values[:, 2]
+    return HEADER.pack(MAGIC, VERSION, flags, len(records)) + records.tobytes()
+
+def decode(body: bytes) -> np.ndarray:
+    """
+    Разбор тела запроса в структурированный массив (timestamp, x, y, z), ссылающийся на body.
+    Ошибки формата, NaN и бесконечные значения, метки времени вне годов 1-9999 - 400, слишком большой пакет - 413.
+    """
+    if len(body) < HEADER.size:
+        raise HTTPException(status_code=400, detail="Body is shorter than the binary header")
+    magic, version, flags, count = HEADER.unpack_from(body)
+    if magic != MAGIC:
+        raise HTTPException(status_code=400, detail="Invalid binary stats magic")
+    if version != VERSION:
+        raise HTTPException(status_code=400, detail=f"Unsupported binary stats version {version}")
+    if flags & ~FLAG_FLOAT64:
+        raise HTTPException(status_code=400, detail=f"Unsupported binary stats flags {flags:#x}")
+    if count > MAX_BINARY_RECORDS:
+        raise HTTPException(status_code=413, detail=f"Batch size exceeds {MAX_BINARY_RECORDS} records")
+    dtype = record_dtype(flags)
+    if len(body) != HEADER.size + count * dtype.itemsize:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Body length {len(body)} does not match {count} records of {dtype.itemsize} bytes"
+        )
+    records = np.frombuffer(body, dtype=dtype, count=count, offset=HEADER.size)
+    # Проверка до записи: NaN и бесконечности навсегда испортили бы суммы и скетчи stat_rollups
+    for axis in ("x", "y", "z"):
+        if not np.isfinite(records[axis]).all():
+            raise HTTPException(status_code=400, detail=f"Non-finite {axis} values are not allowed")
+    timestamps = records["timestamp"]
+    if count and (timestamps.min() < MIN_TIMESTAMP_US or timestamps.max() > MAX_TIMESTAMP_US):
+        raise HTTPException(status_code=400, detail="Timestamp is out of range (years 1-9999)")
+    return records
+
+# Двоичный формат COPY Postgres: заголовок, кортежи (число полей, затем длина и значение каждого поля), -1
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+COPY_TRAILER = struct.pack(">h", -1)
+COPY_COLUMNS = 'device_id, "timestamp", x, y, z'
+# Эпоха timestamp в Postgres - 2000-01-01, в микросекундах от 1970-01-01
+POSTGRES_EPOCH_US = 946684800 * 1000000
+
+COPY_TUPLE_DTYPE = np.dtype([
+    ("fields", ">i2"),
+    ("device_id_len", ">i4"), ("device_id", ">i4"),
+    ("timestamp_len", ">i4"), ("timestamp", ">i8"),
+    ("x_len", ">i4"), ("x", ">f8"),
+    ("y_len", ">i4"), ("y", ">f8"),
+    ("z_len", ">i4"), ("z", ">f8")
+])
+
+def to_copy_binary(device_id: int, records: np.ndarray) -> bytes:
+    """Данные COPY stats (device_id, timestamp, x, y, z) FROM STDIN WITH (FORMAT binary)"""
+    tuples = np.empty(len(records), dtype=COPY_TUPLE_DTYPE)
+    tuples["fields"] = 5
+    tuples["device_id_len"] = 4
+    tuples["device_id"] = device_id
+    tuples["timestamp_len"] = 8
+    tuples["timestamp"] = records["timestamp"] - POSTGRES_EPOCH_US
+    for axis in ("x", "y", "z"):
+        tuples[f"{axis}_len"] = 8
+        tuples[axis] = records[axis]
+    return COPY_HEADER + tuples.tobytes() + COPY_TRAILER
@@ -0,0 +1,251 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+import aioredis
+import redis
+from .config import settings
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = settings.redis_url
+
+# Время жизни записи о выполняющемся анализе и о готовом результате, секунды
+ANALYSIS_PENDING_TTL = int(os.getenv("ANALYSIS_PENDING_TTL", "600"))
+ANALYSIS_RESULT_TTL = int(os.getenv("ANALYSIS_RESULT_TTL", "3600"))
+# Максимальное количество закешированных окон на одно устройство
+ANALYSIS_MAX_WINDOWS_PER_DEVICE = 1000
+
+KEY_PREFIX = "analysis:req:"
+DEVICE_INDEX_PREFIX = "analysis:device:"
+
+# Ключ, под которым redis-бэкенд Celery хранит результат задачи
+CELERY_TASK_META_PREFIX = "celery-task-meta-"
+# Состояния задачи Celery, после которых результат уже не изменится
+CELERY_READY_STATES = ("SUCCESS", "FAILURE", "REVOKED")
+# Канал pub/sub, в который задача анализа публикует свое завершение
+ANALYSIS_DONE_CHANNEL_PREFIX = "analysis:done:"
+
+# Ограничение частоты запуска анализов владельца: скорость пополнения (токенов в секунду) и емкость ведра.
+# Анализ устройства стоит один токен, анализ всех устройств владельца - OWNER_ANALYSIS_TOKEN_COST
+OWNER_RATE_LIMIT = float(os.getenv("OWNER_ANALYSIS_RATE", "1"))
+OWNER_RATE_BURST = float(os.getenv("OWNER_ANALYSIS_BURST", "30"))
+OWNER_ANALYSIS_TOKEN_COST = float(os.getenv("OWNER_ANALYSIS_TOKEN_COST", "10"))
+RATE_LIMIT_PREFIX = "ratelimit:owner:"
+
+_client = None
+_async_client = None
+
+def get_redis() -> redis.Redis:
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+    return _client
+
+def get_async_redis() -> aioredis.Redis:
+    """Асинхронный клиент для эндпоинтов async def"""
+    global _async_client
+    if _async_client is None:
+        _async_client = aioredis.from_url(REDIS_URL, decode_responses=True)
+    return _async_client
+
+async def get_task_meta(task_id: str):
+    """
+    Состояние задачи Celery напрямую из redis-бэкенда без блокирующего AsyncResult.
+    :return: Словарь {"status", "result", ...} или None, если задача еще не завершилась.
+    """
+    raw = await get_async_redis().get(CELERY_TASK_META_PREFIX + task_id)
+    return json.loads(raw) if raw else None
+
+def publish_done(task_id: str, status: str, result=None):
+    """Уведомляет ожидающих клиентов о завершении задачи анализа"""
+    get_redis().publish(
+        ANALYSIS_DONE_CHANNEL_PREFIX + task_id,
+        json.dumps({"status": status, "result": result})
+    )
+
+@asynccontextmanager
+async def subscribe_done(task_id: str):
+    """
+    Подписка на завершение задачи анализа.
+    Подписываться нужно до проверки состояния задачи, иначе уведомление между проверкой и подпиской теряется.
+    """
+    async with get_async_redis().pubsub() as pubsub:
+        await pubsub.subscribe(ANALYSIS_DONE_CHANNEL_PREFIX + task_id)
+        yield pubsub
+
+async def wait_done(pubsub, timeout: float):
+    """
+    Ожидание уведомления о завершении задачи.
+    :return: Словарь {"status", "result"} или None, если задача не завершилась за timeout секунд.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    remaining = timeout
+    while remaining > 0:
+        message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=remaining)
+        if message is not None:
+            return json.loads(message["data"])
+        remaining = deadline - loop.time()
+    return None
+
+def _epoch(value: datetime) -> float:
+    """Секунды Unix; время без часового пояса считается UTC"""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+def analysis_key(device_id: int, start_time: datetime, end_time: datetime, kind: str = "device_stats") -> str:
+    """
+    Ключ запроса анализа: хеш от (device_id, start_time, end_time, вид анализа).
+    Время сравнивается в секундах Unix: API получает время с часовым поясом, задача - в UTC без пояса.
+    """
+    payload = json.dumps([device_id, _epoch(start_time), _epoch(end_time), kind])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+# Захват ключа: если запроса еще нет, записываем task_id и регистрируем окно в индексе устройства.
+# Индекс устройства - ZSET, score = конец окна, member = "<начало окна>:<ключ>".
+_CLAIM_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'task_id', ARGV[1], 'status', 'pending')
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[4], ARGV[3] .. ':' .. ARGV[5])
+redis.call('EXPIRE', KEYS[2], ARGV[6])
+local extra = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[7])
+if extra > 0 then
+    local evicted = redis.call('ZRANGE', KEYS[2], 0, extra - 1)
+    for _, member in ipairs(evicted) do
+        redis.call('DEL', ARGV[8] .. string.sub(member, string.find(member, ':') + 1))
+    end
+    redis.call('ZREMRANGEBYRANK', KEYS[2], 0, extra - 1)
+end
+return 1
+"""
+
+# Запись результата, только если ключ все еще принадлежит этой задаче (не был инвалидирован)
+_STORE_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'task_id') ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'status', ARGV[2], 'result', ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 1
+"""
+
+# Удаление закешированных окон устройства, пересекающихся с [ARGV[1], ARGV[2]]
+_INVALIDATE_SCRIPT = """
+local members = redis.call('ZRANGEBYSCORE', KEYS[1], ARGV[1], '+inf')
+local removed = 0
+for _, member in ipairs(members) do
+    local separator = string.find(member, ':')
+    if tonumber(string.sub(member, 1, separator - 1)) <= tonumber(ARGV[2]) then
+        redis.call('DEL', ARGV[3] .. string.sub(member, separator + 1))
+        redis.call('ZREM', KEYS[1], member)
+        removed = removed + 1
+    end
+end
+return removed
+"""
+
+# Ведро токенов: пополняется по времени Redis со скоростью ARGV[1] до емкости ARGV[2], запрос забирает ARGV[3].
+# Возвращает {1, 0} или {0, секунд до появления нужного количества токенов}
+_TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(now - updated, 0) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    retry_after = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, tostring(retry_after)}
+"""
+
+def take_owner_tokens(owner: str, cost: float = 1):
+    """
+    Забирает cost токенов из ведра владельца.
+    :return: 0, если запрос разрешен, иначе количество секунд до повторной попытки.
+    """
+    script = get_redis().register_script(_TOKEN_BUCKET_SCRIPT)
+    allowed, retry_after = script(
+        keys=[RATE_LIMIT_PREFIX + owner],
+        args=[OWNER_RATE_LIMIT, OWNER_RATE_BURST, min(cost, OWNER_RATE_BURST)]
+    )
+    return 0 if allowed else float(retry_after)
+
+def get_entry(key: str):
+    """Запись кеша: {"task_id", "status", "result"} или None"""
+    entry = get_redis().hgetall(KEY_PREFIX + key)
+    if not entry:
+        return None
+    if "result" in entry:
+        entry["result"] = json.loads(entry["result"])
+    return entry
+
+def claim(key: str, task_id: str, device_id: int, start_time: datetime, end_time: datetime) -> bool:
+    """Регистрирует новый запрос анализа. False, если такой запрос уже выполняется или выполнен."""
+    script = get_redis().register_script(_CLAIM_SCRIPT)
+    return bool(script(
+        keys=[KEY_PREFIX + key, f"{DEVICE_INDEX_PREFIX}{device_id}"],
+        args=[
+            task_id, ANALYSIS_PENDING_TTL, _epoch(start_time), _epoch(end_time), key,
+            ANALYSIS_RESULT_TTL, ANALYSIS_MAX_WINDOWS_PER_DEVICE, KEY_PREFIX
+        ]
+    ))
+
+def store_result(key: str, task_id: str, result) -> bool:
+    script = get_redis().register_script(_STORE_SCRIPT)
+    return bool(script(
+        keys=[KEY_PREFIX + key],
+        args=[task_id, "success", json.dumps(result), ANALYSIS_RESULT_TTL]
+    ))
+
+def release(key: str, task_id: str):
+    """Снимает запись о запросе после ошибки задачи, чтобы повторный запрос запустил анализ заново"""
+    client = get_redis()
+    if client.hget(KEY_PREFIX + key, "task_id") == task_id:
+        client.delete(KEY_PREFIX + key)
+
+def invalidate_device_window(device_id: int, start_time: datetime, end_time: datetime) -> int:
+    """
+    Удаляет закешированные анализы устройства, чьи окна пересекаются с [start_time, end_time].
+    Вызывается после записи новой статистики.
+    """
+    script = get_redis().register_script(_INVALIDATE_SCRIPT)
+    return script(
+        keys=[f"{DEVICE_INDEX_PREFIX}{device_id}"],
+        args=[_epoch(start_time), _epoch(end_time), KEY_PREFIX]
+    )
+
+def invalidate_for_rows(rows):
+    """
+    Сброс закешированных анализов, окна которых задеты новыми записями {"device_id", "timestamp"}.
+    Недоступность Redis не должна ломать запись, поэтому ошибка только логируется.
+    """
+    windows = {}
+    for row in rows:
+        first, last = windows.get(row["device_id"], (row["timestamp"], row["timestamp"]))
+        windows[row["device_id"]] = (min(first, row["timestamp"]), max(last, row["timestamp"]))
+    try:
+        with metrics.span("cache"):
+            for device_id, (first, last) in windows.items():
+                invalidate_device_window(device_id, first, last)
+    except redis.RedisError as e:
+        logger.warning(f"Failed to invalidate analysis cache: {str(e)}")
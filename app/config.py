@@ -0,0 +1,36 @@
+from typing import Optional
+from pydantic import BaseSettings
+
+class Settings(BaseSettings):
+    """
+    Настройки подключений из переменных окружения (имя переменной - имя поля в верхнем регистре).
+    Пулы создаются в каждом процессе отдельно: для API размер пула рассчитывается на один процесс uvicorn,
+    для Celery - на один дочерний процесс воркера, поэтому воркерам обычно хватает DB_POOL_SIZE=1-2.
+    """
+    database_url: str = "postgresql://postgres:postgres@db:5432/postgres"
+    redis_url: str = "redis://redis:6379/0"
+    # Брокер и бэкенд результатов Celery, по умолчанию - REDIS_URL
+    celery_broker_url: Optional[str] = None
+    celery_result_backend: Optional[str] = None
+
+    # Пул соединений SQLAlchemy
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    # Сколько секунд ждать свободного соединения, прежде чем вернуть ошибку
+    db_pool_timeout: float = 30
+    # Соединения старше указанного количества секунд переоткрываются
+    db_pool_recycle: int = 1800
+    # Проверка соединения перед выдачей из пула
+    db_pool_pre_ping: bool = True
+    # Режим PgBouncer (pool_mode=transaction): пул держит PgBouncer, приложение не кеширует
+    # соединения и подготовленные выражения
+    db_pgbouncer: bool = False
+
+    # Реплика только для чтения (потоковая репликация). Не задана - все запросы идут в основной сервер
+    database_replica_url: Optional[str] = None
+    # Реплика, отстающая больше чем на указанное количество секунд, не используется
+    db_replica_max_lag: float = 5
+    # Как часто (в секундах) процесс проверяет отставание реплики
+    db_replica_lag_check_interval: float = 1
+
+settings = Settings()
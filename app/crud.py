@@ -1,10 +1,23 @@
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import IntegrityError
-from .models import Device, Stat
-from .schemas import DeviceCreate, StatCreate
-from datetime import datetime
+from .models import Device, Stat, AnalysisResult, AnalysisJob, RetentionPolicy
+from .pagination import paginate, paginate_async
+from .schemas import DeviceCreate, StatCreate, StatBatchItem, DeviceStatBatchItem, RetentionPolicyCreate
+from . import rollups, series, cache, metrics, binary_ingest, retention, registry
+from typing import List
+from datetime import datetime, timezone
 from .tasks import analyze_device_stats, analyze_user_devices
 from fastapi import HTTPException
+import io
+import logging
+import math
+import uuid
+import numpy as np
+import redis
+
+logger = logging.getLogger(__name__)
 
 # Создание нового устройства
 def create_device(db: Session, device: DeviceCreate):
@@ -13,22 +26,120 @@ def create_device(db: Session, device: DeviceCreate):
         db.add(db_device)
         db.commit()
         db.refresh(db_device)
-        return db_device
     except IntegrityError:
         db.rollback()
         raise HTTPException(
             status_code=400,
             detail=f"Device with ID {device.device_id} already exists"
         )
+    # Процессы API и воркеров удаляют закешированное отсутствие устройства
+    registry.announce(db_device)
+    return db_device
 
 # Создание новой записи статистики
 def create_stat(db: Session, stat: StatCreate, device_id: int):
-    db_stat = Stat(**stat.dict(), device_id=device_id)
+    registry.require(db, device_id)
+    db_stat = Stat(**stat.dict(), device_id=device_id, timestamp=datetime.utcnow())
     db.add(db_stat)
+    # Часовые агрегаты и отметки для прореженных рядов обновляются в той же транзакции
+    rollups.record(db, [device_id], [db_stat.timestamp], [[stat.x, stat.y, stat.z]])
+    series.record(db, [device_id], [db_stat.timestamp])
     db.commit()
     db.refresh(db_stat)
+    metrics.INGEST_ROWS.labels("single").inc()
+    cache.invalidate_for_rows([{"device_id": device_id, "timestamp": db_stat.timestamp}])
     return db_stat
 
+# Максимальное количество записей в одном пакете
+MAX_STAT_BATCH_SIZE = 10000
+
+# Массовая вставка записей статистики одной транзакцией
+def bulk_insert_stats(db: Session, rows: List[dict], source: str = "batch"):
+    """
+    Вставляет записи одним multi-row INSERT (execute_values в psycopg2) и одним commit.
+    Записи без timestamp получают текущее время сервера.
+    :param source: Метка источника для метрики записанных строк.
+    :return: Словарь с количеством вставленных записей и устройств.
+    """
+    if not rows:
+        return {"inserted": 0, "devices": 0}
+    # Неизвестные устройства отклоняются до вставки, обычно без запроса к БД
+    registry.require_many(db, [row["device_id"] for row in rows])
+    now = datetime.utcnow()
+    for row in rows:
+        timestamp = row.get("timestamp")
+        if timestamp is None:
+            row["timestamp"] = now
+        elif timestamp.tzinfo is not None:
+            # В БД время хранится в UTC без часового пояса
+            row["timestamp"] = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    try:
+        with metrics.span("insert"):
+            db.execute(insert(Stat), rows)
+        with metrics.span("rollups"):
+            rollups.record(
+                db,
+                [row["device_id"] for row in rows],
+                [row["timestamp"] for row in rows],
+                [[row["x"], row["y"], row["z"]] for row in rows]
+            )
+            series.record(db, [row["device_id"] for row in rows], [row["timestamp"] for row in rows])
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=404, detail="Batch references an unknown device")
+    metrics.INGEST_ROWS.labels(source).inc(len(rows))
+    cache.invalidate_for_rows(rows)
+    return {
+        "inserted": len(rows),
+        "devices": len({row["device_id"] for row in rows})
+    }
+
+# Загрузка статистики устройства из двоичного формата через COPY
+def insert_binary_stats(db: Session, device_id: int, body: bytes):
+    """
+    Записи разбираются из body без копирования и объектов Python на строку (binary_ingest.decode)
+    и передаются в Postgres двоичным COPY; агрегаты обновляются в той же транзакции.
+    :return: Словарь с количеством вставленных записей и устройств.
+    """
+    records = binary_ingest.decode(body)
+    if not len(records):
+        return {"inserted": 0, "devices": 0}
+    registry.require(db, device_id)
+
+    timestamps = records["timestamp"].astype("datetime64[us]")
+    with metrics.span("copy"):
+        cursor = db.connection().connection.cursor()
+        cursor.copy_expert(
+            f"COPY stats ({binary_ingest.COPY_COLUMNS}) FROM STDIN WITH (FORMAT binary)",
+            io.BytesIO(binary_ingest.to_copy_binary(device_id, records))
+        )
+    with metrics.span("rollups"):
+        rollups.record(
+            db,
+            np.full(len(records), device_id),
+            timestamps,
+            np.column_stack((records["x"], records["y"], records["z"]))
+        )
+        series.record(db, np.full(len(records), device_id), timestamps)
+    db.commit()
+    metrics.INGEST_ROWS.labels("binary").inc(len(records))
+    cache.invalidate_for_rows([
+        {"device_id": device_id, "timestamp": timestamps.min().astype(datetime)},
+        {"device_id": device_id, "timestamp": timestamps.max().astype(datetime)}
+    ])
+    return {"inserted": len(records), "devices": 1}
+
+# Пакетное создание статистики для одного устройства
+def create_stats_batch(db: Session, stats: List[StatBatchItem], device_id: int):
+    rows = [dict(stat.dict(), device_id=device_id) for stat in stats]
+    return bulk_insert_stats(db, rows)
+
+# Пакетное создание статистики для нескольких устройств
+def create_multi_device_stats_batch(db: Session, stats: List[DeviceStatBatchItem]):
+    rows = [stat.dict() for stat in stats]
+    return bulk_insert_stats(db, rows)
+
 # Получение всех записей статистики для устройства за определенный период
 def get_stats_by_device(db: Session, device_id: int, start_time: datetime, end_time: datetime):
     return db.query(Stat).filter(
@@ -37,18 +148,166 @@ def get_stats_by_device(db: Session, device_id: int, start_time: datetime, end_t
         Stat.timestamp <= end_time
     ).all()
 
+# Статистика устройства за период кортежами (timestamp, x, y, z) без ORM-объектов (layout=columnar)
+def get_stats_columns(db: Session, device_id: int, start_time: datetime, end_time: datetime):
+    return db.execute(
+        select(Stat.timestamp, Stat.x, Stat.y, Stat.z).where(
+            Stat.device_id == device_id,
+            Stat.timestamp >= start_time,
+            Stat.timestamp <= end_time
+        ).order_by(Stat.timestamp, Stat.id)
+    ).all()
+
+# Страница статистики устройства за период (от старых к новым)
+def get_stats_page(db: Session, device_id: int, start_time: datetime, end_time: datetime,
+                   limit: int, cursor: str = None):
+    query = db.query(Stat).filter(
+        Stat.device_id == device_id,
+        Stat.timestamp >= start_time,
+        Stat.timestamp <= end_time
+    )
+    return paginate(query, (Stat.timestamp, Stat.id), limit, cursor)
+
+# Результат анализа по ID задачи (асинхронная сессия)
+async def get_analysis_by_task_id(db: AsyncSession, task_id: str):
+    result = await db.execute(select(AnalysisResult).where(AnalysisResult.task_id == task_id))
+    return result.scalars().first()
+
+# Задание анализа пользователя или парка по ID задачи (асинхронная сессия)
+async def get_analysis_job(db: AsyncSession, task_id: str):
+    result = await db.execute(select(AnalysisJob).where(AnalysisJob.task_id == task_id))
+    return result.scalars().first()
+
+# Результаты задания по устройствам одним запросом по индексу job_id (асинхронная сессия)
+async def get_job_results(db: AsyncSession, job_id: int):
+    """:return: Строки (device_id устройства, avg_x, avg_y, avg_z, total_records)."""
+    result = await db.execute(
+        select(
+            Device.device_id, AnalysisResult.avg_x, AnalysisResult.avg_y,
+            AnalysisResult.avg_z, AnalysisResult.total_records
+        )
+        .join(Device, Device.id == AnalysisResult.device_id)
+        .where(AnalysisResult.job_id == job_id)
+    )
+    return result.all()
+
+# Все результаты анализа устройства (асинхронная сессия)
+async def get_device_analysis_results(db: AsyncSession, device_id: int):
+    result = await db.execute(select(AnalysisResult).where(AnalysisResult.device_id == device_id))
+    return result.scalars().all()
+
+# Страница результатов анализа устройства (асинхронная сессия, от новых к старым)
+async def get_analysis_page(db: AsyncSession, device_id: int, limit: int, cursor: str = None):
+    statement = select(AnalysisResult).where(AnalysisResult.device_id == device_id)
+    return await paginate_async(
+        db, statement, (AnalysisResult.created_at, AnalysisResult.id), limit, cursor, descending=True
+    )
+
+# Потоковое чтение статистики устройства за период серверным курсором
+def iter_stats_by_device(db: Session, device_id: int, start_time: datetime, end_time: datetime,
+                         chunk_size: int = 1000):
+    """
+    Возвращает кортежи (id, device_id, timestamp, x, y, z) без создания ORM-объектов.
+    Строки читаются из серверного курсора порциями по chunk_size, поэтому память не зависит от периода.
+    """
+    return db.query(
+        Stat.id, Stat.device_id, Stat.timestamp, Stat.x, Stat.y, Stat.z
+    ).filter(
+        Stat.device_id == device_id,
+        Stat.timestamp >= start_time,
+        Stat.timestamp <= end_time
+    ).order_by(
+        Stat.timestamp, Stat.id
+    ).execution_options(stream_results=True).yield_per(chunk_size)
+
+# Ограничение частоты запуска анализов владельца (ведро токенов в Redis)
+def check_owner_rate_limit(owner: str, cost: float = 1):
+    """429 с Retry-After, если владелец исчерпал токены; недоступность Redis запуск не блокирует"""
+    try:
+        retry_after = cache.take_owner_tokens(owner, cost)
+    except redis.RedisError as e:
+        logger.warning(f"Rate limiter unavailable: {str(e)}")
+        return
+    if retry_after:
+        raise HTTPException(
+            status_code=429,
+            detail=f"Analysis rate limit exceeded for owner {owner}",
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+
 # Запуск анализа статистики устройства
 def start_device_analysis(db: Session, device_id: int, start_time: datetime, end_time: datetime):
-    task = analyze_device_stats.delay(device_id, start_time, end_time)
-    return task.id
+    """
+    Одинаковые запросы (устройство, период) не запускают повторный анализ:
+    для выполняющегося возвращается task_id, для выполненного - сразу готовый результат из кеша.
+    :return: Словарь {"task_id", "status"} и "result" для готового результата.
+    """
+    owner = registry.require(db, device_id)["owner"]
+    key = cache.analysis_key(device_id, start_time, end_time)
+    try:
+        entry = cache.get_entry(key)
+        if entry is None:
+            # Токен списывается только за новый анализ: повтор того же окна бесплатен
+            check_owner_rate_limit(owner or f"device:{device_id}")
+            task_id = str(uuid.uuid4())
+            if cache.claim(key, task_id, device_id, start_time, end_time):
+                analyze_device_stats.apply_async(
+                    (device_id, start_time, end_time), {"cache_key": key}, task_id=task_id
+                )
+                return {"task_id": task_id, "status": "pending"}
+            # Параллельный запрос успел зарегистрировать такой же анализ
+            entry = cache.get_entry(key)
+    except redis.RedisError as e:
+        logger.warning(f"Analysis cache unavailable: {str(e)}")
+        entry = None
+
+    if entry is None:
+        task = analyze_device_stats.delay(device_id, start_time, end_time)
+        return {"task_id": task.id, "status": "pending"}
+    return entry
 
 # Запуск анализа всех устройств пользователя
 def start_user_analysis(db: Session, owner: str, start_time: datetime, end_time: datetime):
-    task = analyze_user_devices.delay(owner, start_time, end_time)
-    return task.id
+    """:return: task_id или None, если у владельца нет устройств."""
+    if not registry.owner_exists(db, owner):
+        return None
+    check_owner_rate_limit(owner, cache.OWNER_ANALYSIS_TOKEN_COST)
+    # Запись задания создается до запуска задачи, чтобы ход анализа был виден сразу по task_id
+    task_id = str(uuid.uuid4())
+    db.add(AnalysisJob(task_id=task_id, owner=owner, start_time=start_time, end_time=end_time))
+    db.commit()
+    analyze_user_devices.apply_async((owner, start_time, end_time), task_id=task_id)
+    return task_id
 
 # Получение результата анализа по ID задачи
 def get_analysis_result(task_id: str):
     from .tasks import celery_app
     result = celery_app.AsyncResult(task_id)
-    return result.get() if result.ready() else None
\ No newline at end of file
+    return result.get() if result.ready() else None
+
+# Политики срока хранения
+def create_retention_policy(db: Session, policy: RetentionPolicyCreate):
+    if policy.table_name not in retention.TABLES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Retention is supported for tables: {', '.join(retention.TABLES)}"
+        )
+    if policy.keep_days < 1:
+        raise HTTPException(status_code=400, detail="keep_days must be positive")
+    if policy.device_id is not None:
+        registry.require(db, policy.device_id)
+    db_policy = RetentionPolicy(**policy.dict())
+    db.add(db_policy)
+    db.commit()
+    db.refresh(db_policy)
+    return db_policy
+
+def get_retention_policies(db: Session):
+    return db.query(RetentionPolicy).order_by(RetentionPolicy.id).all()
+
+def delete_retention_policy(db: Session, policy_id: int):
+    db_policy = db.query(RetentionPolicy).filter(RetentionPolicy.id == policy_id).first()
+    if db_policy is None:
+        raise HTTPException(status_code=404, detail="Retention policy not found")
+    db.delete(db_policy)
+    db.commit()
@@ -1,10 +1,245 @@
-from sqlalchemy import create_engine
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from typing import Optional, Union
+from sqlalchemy import create_engine, event, exc, text
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
+from .config import settings
+from . import metrics
 
-SQLALCHEMY_DATABASE_URL = "postgresql://postgres:postgres@db:5432/postgres"
+logger = logging.getLogger(__name__)
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+SQLALCHEMY_DATABASE_URL = settings.database_url
+# Тот же сервер через асинхронный драйвер asyncpg
+ASYNC_SQLALCHEMY_DATABASE_URL = SQLALCHEMY_DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1)
+REPLICA_DATABASE_URL = settings.database_replica_url
+
+# Счетчики пулов по имени движка: выдачи соединений, ожидание свободного соединения, таймауты
+POOL_STATS = {}
+
+def _pool_stats(name: str) -> dict:
+    return POOL_STATS.setdefault(name, {
+        "checkouts": 0,
+        "connects": 0,
+        "invalidations": 0,
+        "timeouts": 0,
+        "wait_seconds_total": 0.0,
+        "wait_seconds_max": 0.0
+    })
+
+class _InstrumentedPoolMixin:
+    """Замеряет время получения соединения из пула (включая ожидание при исчерпанном пуле)"""
+    stats_name = "default"
+
+    def _do_get(self):
+        stats = _pool_stats(self.stats_name)
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            stats["timeouts"] += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            stats["wait_seconds_total"] += waited
+            stats["wait_seconds_max"] = max(stats["wait_seconds_max"], waited)
+
+def _instrumented_pool_class(base, name: str):
+    return type(f"Instrumented{base.__name__}", (_InstrumentedPoolMixin, base), {"stats_name": name})
+
+def _add_pool_events(engine, name: str):
+    """
+    Счетчики пула и защита от использования соединений, унаследованных при fork:
+    соединение, открытое в другом процессе, отбрасывается без закрытия (его сокет принадлежит родителю).
+    """
+    stats = _pool_stats(name)
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        connection_record.info["pid"] = os.getpid()
+        stats["connects"] += 1
+
+    @event.listens_for(engine, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        pid = os.getpid()
+        if connection_record.info["pid"] != pid:
+            connection_record.dbapi_connection = connection_proxy.dbapi_connection = None
+            raise exc.DisconnectionError(
+                f"Connection record belongs to pid {connection_record.info['pid']}, "
+                f"attempting to check out in pid {pid}"
+            )
+        stats["checkouts"] += 1
+
+    @event.listens_for(engine, "invalidate")
+    def invalidate(dbapi_connection, connection_record, exception):
+        stats["invalidations"] += 1
+
+def _pool_options(base, name: str) -> dict:
+    if settings.db_pgbouncer:
+        # Соединения держит PgBouncer, пул приложения только мешал бы ему
+        return {"poolclass": NullPool}
+    return {
+        "poolclass": _instrumented_pool_class(base, name),
+        "pool_size": settings.db_pool_size,
+        "max_overflow": settings.db_max_overflow,
+        "pool_timeout": settings.db_pool_timeout,
+        "pool_recycle": settings.db_pool_recycle,
+        "pool_pre_ping": settings.db_pool_pre_ping
+    }
+
+def make_engine(name: str = "sync", url: str = SQLALCHEMY_DATABASE_URL, **options):
+    """Синхронный движок с пулом из настроек; options переопределяют параметры create_engine"""
+    engine = create_engine(url, **{**_pool_options(QueuePool, name), **options})
+    _add_pool_events(engine, name)
+    metrics.instrument_engine(engine, name)
+    return engine
+
+def make_async_engine(name: str = "async", url: str = ASYNC_SQLALCHEMY_DATABASE_URL, **options):
+    """Асинхронный движок (asyncpg) с пулом из настроек"""
+    if settings.db_pgbouncer:
+        # В режиме transaction PgBouncer подготовленные выражения asyncpg не переживают смену сервера
+        options.setdefault("connect_args", {"statement_cache_size": 0, "prepared_statement_cache_size": 0})
+    engine = create_async_engine(url, **{**_pool_options(AsyncAdaptedQueuePool, name), **options})
+    _add_pool_events(engine.sync_engine, name)
+    metrics.instrument_engine(engine.sync_engine, name)
+    return engine
+
+def reset_after_fork():
+    """
+    Сброс пулов в дочернем процессе (Celery prefork) до первого запроса.
+    Родитель соединений не открывает, а унаследованные соединения отбрасывает событие checkout.
+    """
+    engine.dispose()
+    if replica_engine is not engine:
+        replica_engine.dispose()
+    _replica_state.update(as_of=None, checked=0.0)
+
+def pool_metrics() -> dict:
+    """Состояние пулов процесса: размер, выданные соединения, переполнение и накопленные счетчики"""
+    pools = [("sync", engine.pool), ("async", async_engine.sync_engine.pool)]
+    if replica_enabled():
+        pools += [("replica", replica_engine.pool), ("replica_async", async_replica_engine.sync_engine.pool)]
+    result = {}
+    for name, pool in pools:
+        result[name] = dict(POOL_STATS.get(name, {}), status=pool.status())
+        if isinstance(pool, QueuePool):
+            result[name].update(
+                size=pool.size(),
+                checked_out=pool.checkedout(),
+                overflow=pool.overflow()
+            )
+    if replica_enabled() and replica_lag() is not None:
+        result["replica"]["lag_seconds"] = replica_lag()
+    return result
+
+engine = make_engine()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-Base = declarative_base()
\ No newline at end of file
+# Асинхронный движок для эндпоинтов async def, не блокирующий цикл событий
+async_engine = make_async_engine()
+AsyncSessionLocal = sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+# Реплика для тяжелых чтений; без DATABASE_REPLICA_URL - те же движки, что и для записи
+if REPLICA_DATABASE_URL:
+    replica_engine = make_engine("replica", REPLICA_DATABASE_URL)
+    async_replica_engine = make_async_engine(
+        "replica_async", REPLICA_DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1)
+    )
+else:
+    replica_engine = engine
+    async_replica_engine = async_engine
+ReplicaSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=replica_engine)
+AsyncReplicaSessionLocal = sessionmaker(
+    async_replica_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+)
+
+# Момент, по который реплика применила все изменения: при полностью примененном WAL - текущее время,
+# иначе время последней примененной транзакции
+REPLICA_POSITION_SQL = """
+SELECT extract(epoch FROM now()) - CASE
+    WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+END AS replayed_at, extract(epoch FROM now()) AS replica_now
+"""
+
+# Последняя проверка реплики в процессе: as_of - момент по часам процесса, до которого реплика догнала основной сервер
+_replica_state = {"as_of": None, "checked": 0.0}
+
+def replica_enabled() -> bool:
+    return replica_engine is not engine
+
+def to_epoch(value) -> Optional[float]:
+    """Секунды Unix для datetime с часовым поясом или без (наивное - UTC); числа возвращаются как есть"""
+    if value is None or isinstance(value, (int, float)):
+        return value
+    if value.tzinfo is None:
+        # Время в БД и в запросах - наивное UTC
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+def _update_replica_state(row):
+    if row is None or row.replayed_at is None:
+        as_of = None
+    else:
+        # Отставание считается по часам реплики, а момент - по часам процесса: расхождение часов не влияет
+        as_of = time.time() - (float(row.replica_now) - float(row.replayed_at))
+    _replica_state.update(as_of=as_of, checked=time.monotonic())
+
+def _replica_check_due() -> bool:
+    return time.monotonic() - _replica_state["checked"] >= settings.db_replica_lag_check_interval
+
+def _replica_fresh(after) -> bool:
+    as_of = _replica_state["as_of"]
+    if as_of is None:
+        return False
+    if after is None:
+        return time.time() - as_of <= settings.db_replica_max_lag
+    return as_of >= to_epoch(after)
+
+def _routed(fresh: bool) -> bool:
+    metrics.DB_READ_ROUTING.labels("replica" if fresh else "primary").inc()
+    return fresh
+
+def replica_lag() -> Optional[float]:
+    """Отставание реплики в секундах по последней проверке; None - реплика недоступна или не проверялась"""
+    as_of = _replica_state["as_of"]
+    return None if as_of is None else max(time.time() - as_of, 0.0)
+
+def use_replica(after: Union[datetime, float] = None) -> bool:
+    """
+    Можно ли читать с реплики: она настроена и применила все изменения, сделанные до after
+    (datetime или секунды Unix; без after - отстает не больше DB_REPLICA_MAX_LAG секунд). Недоступная реплика не используется.
+    """
+    if not replica_enabled():
+        return False
+    if _replica_check_due():
+        try:
+            with replica_engine.connect() as connection:
+                _update_replica_state(connection.execute(text(REPLICA_POSITION_SQL)).first())
+        except (exc.SQLAlchemyError, OSError) as e:
+            logger.warning(f"Replica lag check failed: {str(e)}")
+            _update_replica_state(None)
+    return _routed(_replica_fresh(after))
+
+async def use_replica_async(after: Union[datetime, float] = None) -> bool:
+    """use_replica для асинхронных эндпоинтов"""
+    if not replica_enabled():
+        return False
+    if _replica_check_due():
+        try:
+            async with async_replica_engine.connect() as connection:
+                _update_replica_state((await connection.execute(text(REPLICA_POSITION_SQL))).first())
+        except (exc.SQLAlchemyError, OSError) as e:
+            logger.warning(f"Replica lag check failed: {str(e)}")
+            _update_replica_state(None)
+    return _routed(_replica_fresh(after))
+
+def read_engine(after: Union[datetime, float] = None):
+    """Движок для тяжелого чтения: реплика, если use_replica(after), иначе основной сервер"""
+    return replica_engine if use_replica(after) else engine
+
+Base = declarative_base()
@@ -0,0 +1,118 @@
+import csv
+import gzip
+import io
+import json
+from typing import Iterable, Iterator, Optional, Sequence
+import orjson
+
+try:
+    import brotli
+except ImportError:  # brotli необязателен: без него ответы сжимаются только gzip
+    brotli = None
+
+# Поля записи статистики в порядке выгрузки
+STAT_FIELDS = ("id", "device_id", "timestamp", "x", "y", "z")
+
+# Форматы потоковой выгрузки и их MIME-типы
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv"
+}
+
+def _chunked(rows: Iterable[tuple], chunk_size: int) -> Iterator[list]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def iter_ndjson(rows: Iterable[tuple], chunk_size: int = 1000) -> Iterator[bytes]:
+    """Выгрузка кортежей (id, device_id, timestamp, x, y, z) построчным JSON, порциями по chunk_size"""
+    for chunk in _chunked(rows, chunk_size):
+        yield "".join(
+            json.dumps({
+                "id": row[0],
+                "device_id": row[1],
+                "timestamp": row[2].isoformat(),
+                "x": row[3],
+                "y": row[4],
+                "z": row[5]
+            }) + "\n"
+            for row in chunk
+        ).encode()
+
+def iter_csv(rows: Iterable[tuple], chunk_size: int = 1000) -> Iterator[bytes]:
+    """Выгрузка кортежей (id, device_id, timestamp, x, y, z) в CSV с заголовком, порциями по chunk_size"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(STAT_FIELDS)
+    for chunk in _chunked(rows, chunk_size):
+        writer.writerows(
+            (row[0], row[1], row[2].isoformat(), row[3], row[4], row[5]) for row in chunk
+        )
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    # Пустая выгрузка содержит только заголовок
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+FORMATTERS = {
+    "ndjson": iter_ndjson,
+    "csv": iter_csv
+}
+
+# Колонки ответа layout=columnar
+COLUMNAR_FIELDS = ("timestamp", "x", "y", "z")
+
+# Тела меньше этого размера не сжимаются
+MIN_COMPRESS_SIZE = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+def columnar(rows: Sequence[tuple]) -> dict:
+    """Кортежи (timestamp, x, y, z) в словарь столбцов {"timestamp": [...], "x": [...], ...}"""
+    columns = zip(*rows) if rows else ((),) * len(COLUMNAR_FIELDS)
+    return dict(zip(COLUMNAR_FIELDS, columns))
+
+def _quality(value: str) -> float:
+    """q-значение из Accept-Encoding; нечисловое или NaN считается 0 (кодировка не принимается)"""
+    try:
+        quality = float(value)
+    except ValueError:
+        return 0
+    return quality if quality == quality else 0
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """Кодировка сжатия по заголовку Accept-Encoding: br (если установлен brotli), gzip или None"""
+    accepted = set()
+    for item in (accept_encoding or "").split(","):
+        name, _, params = item.strip().partition(";")
+        quality = params.strip()
+        if quality.startswith("q=") and _quality(quality[2:]) == 0:
+            continue
+        accepted.add(name.strip().lower())
+    if brotli is not None and ("br" in accepted or "*" in accepted):
+        return "br"
+    if "gzip" in accepted or "*" in accepted:
+        return "gzip"
+    return None
+
+def encode_json(payload, accept_encoding: str = None):
+    """
+    Сериализация orjson (datetime - в ISO 8601) и сжатие по Accept-Encoding.
+    :return: Тело ответа и заголовки (Content-Encoding, Vary).
+    """
+    body = orjson.dumps(payload)
+    headers = {"Vary": "Accept-Encoding"}
+    encoding = negotiate_encoding(accept_encoding) if len(body) >= MIN_COMPRESS_SIZE else None
+    if encoding == "br":
+        body = brotli.compress(body, quality=BROTLI_QUALITY)
+    elif encoding == "gzip":
+        body = gzip.compress(body, compresslevel=GZIP_LEVEL)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return body, headers
@@ -0,0 +1,259 @@
+"""
+Буфер записи статистики в потоке Redis (режим STATS_INGEST_MODE=stream).
+
+API добавляет запись в поток STATS_STREAM_KEY и сразу отвечает 202, не дожидаясь commit в Postgres.
+Воркер (python -m app.ingest_stream) читает поток в группе потребителей, накапливает пакет
+до STATS_STREAM_FLUSH_ROWS записей или STATS_STREAM_FLUSH_SECONDS секунд и пишет его одним INSERT.
+
+Доставка - не менее одного раза: запись подтверждается (XACK) только после commit, а пакеты упавших
+потребителей забираются через XPENDING/XCLAIM. Повторная доставка не создает дублей: каждая запись несет
+ключ идемпотентности, а INSERT ... ON CONFLICT DO NOTHING по уникальному индексу ux_stats_ingest_key
+возвращает только действительно вставленные строки, и только они попадают в агрегаты stat_rollups.
+"""
+import logging
+import os
+import signal
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+import redis
+from prometheus_client import Counter, Histogram
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from .database import engine
+from .schemas import StatCreate
+from . import cache, metrics, rollups, series
+
+logger = logging.getLogger(__name__)
+
+# sync - запись в Postgres в запросе, stream - через поток Redis
+INGEST_MODE = os.getenv("STATS_INGEST_MODE", "sync")
+STREAM_KEY = os.getenv("STATS_STREAM_KEY", "stats:ingest")
+CONSUMER_GROUP = "stats-writers"
+# Размер пакета и максимальное ожидание его накопления
+FLUSH_MAX_ROWS = int(os.getenv("STATS_STREAM_FLUSH_ROWS", "5000"))
+FLUSH_MAX_WAIT = float(os.getenv("STATS_STREAM_FLUSH_SECONDS", "0.5"))
+# Записи, не подтвержденные потребителем дольше этого времени, забираются другим потребителем
+RECLAIM_IDLE_MS = int(os.getenv("STATS_STREAM_RECLAIM_IDLE_MS", "60000"))
+RECLAIM_INTERVAL = 10
+# Ключ идемпотентности клиента (заголовок Idempotency-Key) хранится столько секунд
+IDEMPOTENCY_TTL = 86400
+IDEMPOTENCY_PREFIX = "stats:ingest:key:"
+# Порт метрик воркера (0 - не отдавать)
+INGEST_METRICS_PORT = int(os.getenv("INGEST_METRICS_PORT", "0"))
+
+EPOCH = datetime(1970, 1, 1)
+
+FLUSH_SECONDS = Histogram("stats_ingest_stream_flush_seconds", "Время записи пакета из потока в Postgres")
+FLUSH_ROWS = Histogram(
+    "stats_ingest_stream_flush_rows", "Записей в пакете из потока",
+    buckets=(1, 10, 100, 500, 1000, 2500, 5000, 10000, 50000)
+)
+INGEST_LAG = Histogram(
+    "stats_ingest_stream_lag_seconds", "Время от приема записи API до commit в Postgres",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+)
+SKIPPED_ROWS = Counter(
+    "stats_ingest_stream_skipped_total", "Записи потока, не вставленные в stats: повторная доставка или неизвестное устройство"
+)
+
+# Вставка пакета массивами: неизвестные устройства отбрасываются соединением с devices,
+# повторно доставленные записи - ON CONFLICT; RETURNING отдает только вставленные строки
+FLUSH_SQL = """
+INSERT INTO stats (device_id, "timestamp", x, y, z, ingest_key)
+SELECT batch.device_id, batch.ts, batch.x, batch.y, batch.z, batch.ingest_key
+FROM unnest(
+    CAST(:device_ids AS integer[]), CAST(:timestamps AS timestamp[]), CAST(:xs AS double precision[]),
+    CAST(:ys AS double precision[]), CAST(:zs AS double precision[]), CAST(:keys AS varchar[])
+) AS batch (device_id, ts, x, y, z, ingest_key)
+JOIN devices ON devices.id = batch.device_id
+ON CONFLICT (device_id, "timestamp", ingest_key) WHERE ingest_key IS NOT NULL DO NOTHING
+RETURNING device_id, "timestamp", x, y, z
+"""
+
+def stream_enabled() -> bool:
+    return INGEST_MODE == "stream"
+
+def _to_us(value: datetime) -> int:
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+def append(device_id: int, stat: StatCreate, idempotency_key: str = None) -> dict:
+    """
+    Добавляет запись в поток. Повторный запрос с тем же Idempotency-Key не добавляет запись второй раз.
+    :return: Ответ 202 для клиента.
+    """
+    client = cache.get_redis()
+    timestamp = datetime.utcnow()
+    ingest_key = idempotency_key or uuid.uuid4().hex
+    response = {"status": "accepted", "device_id": device_id, "timestamp": timestamp, "ingest_key": ingest_key}
+    if idempotency_key is not None:
+        marker = f"{IDEMPOTENCY_PREFIX}{device_id}:{idempotency_key}"
+        if not client.set(marker, timestamp.isoformat(), nx=True, ex=IDEMPOTENCY_TTL):
+            return dict(response, timestamp=client.get(marker), duplicate=True)
+    try:
+        response["stream_id"] = client.xadd(STREAM_KEY, {
+            "d": device_id, "t": _to_us(timestamp), "x": stat.x, "y": stat.y, "z": stat.z, "k": ingest_key
+        })
+    except redis.RedisError:
+        if idempotency_key is not None:
+            client.delete(marker)
+        raise
+    return response
+
+def ensure_group(client: redis.Redis):
+    try:
+        client.xgroup_create(STREAM_KEY, CONSUMER_GROUP, id="0", mkstream=True)
+    except redis.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+def _parse(messages):
+    """Записи потока в массивы для FLUSH_SQL; поврежденные записи пропускаются"""
+    columns = {name: [] for name in ("device_ids", "timestamps", "xs", "ys", "zs", "keys")}
+    accepted_at = []
+    for message_id, fields in messages:
+        try:
+            timestamp = EPOCH + timedelta(microseconds=int(fields["t"]))
+            row = (int(fields["d"]), timestamp, float(fields["x"]), float(fields["y"]), float(fields["z"]), fields["k"])
+        except (KeyError, TypeError, ValueError):
+            logger.error(f"Skipping malformed stream entry {message_id}: {fields}")
+            continue
+        for name, value in zip(columns, row):
+            columns[name].append(value)
+        accepted_at.append(timestamp)
+    return columns, accepted_at
+
+def flush(client: redis.Redis, messages) -> int:
+    """
+    Записывает пакет в stats и агрегаты одной транзакцией, затем подтверждает и удаляет записи из потока.
+    :return: Количество вставленных строк.
+    """
+    if not messages:
+        return 0
+    started = time.perf_counter()
+    columns, accepted_at = _parse(messages)
+    inserted = []
+    if accepted_at:
+        with Session(engine) as db:
+            inserted = db.execute(text(FLUSH_SQL), columns).fetchall()
+            rollups.record(
+                db,
+                [row.device_id for row in inserted],
+                [row.timestamp for row in inserted],
+                [[row.x, row.y, row.z] for row in inserted]
+            )
+            series.record(db, [row.device_id for row in inserted], [row.timestamp for row in inserted])
+            db.commit()
+    message_ids = [message_id for message_id, _ in messages]
+    client.xack(STREAM_KEY, CONSUMER_GROUP, *message_ids)
+    client.xdel(STREAM_KEY, *message_ids)
+
+    now = datetime.utcnow()
+    for timestamp in accepted_at:
+        INGEST_LAG.observe(max((now - timestamp).total_seconds(), 0))
+    FLUSH_ROWS.observe(len(messages))
+    FLUSH_SECONDS.observe(time.perf_counter() - started)
+    SKIPPED_ROWS.inc(len(accepted_at) - len(inserted))
+    metrics.INGEST_ROWS.labels("stream").inc(len(inserted))
+    cache.invalidate_for_rows([{"device_id": row.device_id, "timestamp": row.timestamp} for row in inserted])
+    return len(inserted)
+
+def _read_batch(client: redis.Redis, consumer: str, stream_id: str = ">"):
+    """
+    Новые записи (stream_id=">") накапливаются до FLUSH_MAX_ROWS или FLUSH_MAX_WAIT секунд.
+    stream_id="0" - записи, уже выданные этому потребителю, но не подтвержденные.
+    """
+    messages = []
+    deadline = None
+    while len(messages) < FLUSH_MAX_ROWS:
+        block = 1000 if deadline is None else max(int((deadline - time.monotonic()) * 1000), 1)
+        response = client.xreadgroup(
+            CONSUMER_GROUP, consumer, {STREAM_KEY: stream_id},
+            count=FLUSH_MAX_ROWS - len(messages), block=None if stream_id != ">" else block
+        )
+        entries = response[0][1] if response else []
+        messages.extend(entries)
+        if stream_id != ">":
+            break
+        if deadline is None:
+            if not entries:
+                break
+            deadline = time.monotonic() + FLUSH_MAX_WAIT
+        elif time.monotonic() >= deadline:
+            break
+    return messages
+
+def _reclaim(client: redis.Redis, consumer: str):
+    """Записи, которые другие потребители получили, но не подтвердили за RECLAIM_IDLE_MS (упали или зависли)"""
+    pending = client.xpending_range(STREAM_KEY, CONSUMER_GROUP, "-", "+", FLUSH_MAX_ROWS)
+    stale = [
+        entry["message_id"] for entry in pending
+        if entry["consumer"] != consumer and entry["time_since_delivered"] >= RECLAIM_IDLE_MS
+    ]
+    if not stale:
+        return []
+    claimed = client.xclaim(STREAM_KEY, CONSUMER_GROUP, consumer, RECLAIM_IDLE_MS, stale)
+    # Записи, удаленные из потока до подтверждения, XCLAIM возвращает без полей
+    deleted = [message_id for message_id, fields in claimed if not fields]
+    if deleted:
+        client.xack(STREAM_KEY, CONSUMER_GROUP, *deleted)
+    logger.warning(f"Reclaimed {len(claimed)} stale stream entries")
+    return [(message_id, fields) for message_id, fields in claimed if fields]
+
+class StreamCollector:
+    """Глубина очереди потока: всего записей, выданных и не подтвержденных, возраст самой старой"""
+    def collect(self):
+        length = GaugeMetricFamily("stats_ingest_stream_length", "Записи в потоке, еще не записанные в Postgres")
+        pending = GaugeMetricFamily("stats_ingest_stream_pending", "Записи, выданные потребителям и не подтвержденные")
+        oldest = GaugeMetricFamily("stats_ingest_stream_oldest_age_seconds", "Возраст самой старой записи потока")
+        try:
+            client = cache.get_redis()
+            length.add_metric([], client.xlen(STREAM_KEY))
+            groups = {group["name"]: group for group in client.xinfo_groups(STREAM_KEY)}
+            pending.add_metric([], groups.get(CONSUMER_GROUP, {}).get("pending", 0))
+            first = client.xrange(STREAM_KEY, count=1)
+            age = time.time() - int(first[0][0].split("-")[0]) / 1000 if first else 0
+            oldest.add_metric([], max(age, 0))
+        except redis.RedisError as e:
+            logger.warning(f"Failed to collect stream metrics: {str(e)}")
+            return []
+        return [length, pending, oldest]
+
+def run(consumer: str = None):
+    """Цикл потребителя до SIGTERM/SIGINT: сначала свои неподтвержденные записи, затем новые"""
+    consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+    client = cache.get_redis()
+    ensure_group(client)
+    stopping = []
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *args: stopping.append(True))
+    logger.info(f"Stream consumer {consumer} started on {STREAM_KEY}")
+
+    retry_own = True
+    last_reclaim = 0.0
+    while not stopping:
+        try:
+            messages = _read_batch(client, consumer, "0") if retry_own else []
+            retry_own = bool(messages)
+            if not messages and time.monotonic() - last_reclaim >= RECLAIM_INTERVAL:
+                last_reclaim = time.monotonic()
+                messages = _reclaim(client, consumer)
+            if not messages:
+                messages = _read_batch(client, consumer)
+            flush(client, messages)
+        except Exception as e:
+            # Пакет остается неподтвержденным и будет повторен этим же потребителем
+            logger.error(f"Failed to flush stream batch: {str(e)}")
+            retry_own = True
+            time.sleep(1)
+    logger.info(f"Stream consumer {consumer} stopped")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if INGEST_METRICS_PORT:
+        from prometheus_client import REGISTRY, start_http_server
+        REGISTRY.register(StreamCollector())
+        start_http_server(INGEST_METRICS_PORT)
+    run()
@@ -1,11 +1,79 @@
-from sqlalchemy import create_engine
-from .database import SQLALCHEMY_DATABASE_URL
-from .models import Base
+import os
+from sqlalchemy import inspect, text
+from sqlalchemy.pool import NullPool
+from sqlalchemy.schema import CreateIndex
+from .database import make_engine
+from .models import Base, StatRollup
+from .partitions import PARTITIONED_TABLES, create_partitioned_tables, is_partitioned
+from .rollups import create_functions, rebuild_all
 
-def init_db():
-    engine = create_engine(SQLALCHEMY_DATABASE_URL)
-    Base.metadata.create_all(bind=engine)
+def _add_missing_columns(engine):
+    """Добавляет nullable-колонки, появившиеся в моделях после создания таблиц"""
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing or not column.nullable:
+                    continue
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=engine.dialect)}"
+                for foreign_key in column.foreign_keys:
+                    ddl += f" REFERENCES {foreign_key.column.table.name} ({foreign_key.column.name})"
+                connection.execute(text(ddl))
+
+def _create_missing_indexes(engine):
+    """
+    Создает индексы, добавленные в модели после создания таблиц.
+    На обычных таблицах индекс строится CONCURRENTLY, чтобы не блокировать запись.
+    """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        for table in Base.metadata.sorted_tables:
+            partitioned = is_partitioned(connection, table.name)
+            for index in table.indexes:
+                exists = connection.execute(
+                    text("SELECT to_regclass(:name) IS NOT NULL"), {"name": index.name}
+                ).scalar()
+                if exists:
+                    continue
+                ddl = str(CreateIndex(index).compile(dialect=engine.dialect))
+                if not partitioned:
+                    ddl = ddl.replace(" INDEX ", " INDEX CONCURRENTLY ", 1)
+                connection.execute(text(ddl))
+
+def _create_rollups(engine):
+    """
+    Создает stat_rollups и в той же транзакции заполняет агрегаты по уже записанной статистике,
+    иначе полные часы старых периодов читались бы из пустой таблицы до ручного rebuild_rollups.
+    """
+    with engine.begin() as connection:
+        if inspect(connection).has_table(StatRollup.__tablename__):
+            return
+        StatRollup.__table__.create(bind=connection)
+        buckets = rebuild_all(connection)
+    print(f"Таблица {StatRollup.__tablename__} создана, пересчитано корзин: {buckets}")
+
+def init_db(partitioned: bool = None):
+    """
+    :param partitioned: Создать stats и device_data секционированными по месяцам.
+    По умолчанию берется из переменной окружения STATS_PARTITIONING.
+    """
+    if partitioned is None:
+        partitioned = os.getenv("STATS_PARTITIONING", "").lower() in ("1", "true", "yes")
+    # Одноразовый процесс: пул не нужен
+    engine = make_engine("init_db", poolclass=NullPool)
+    with engine.begin() as connection:
+        create_functions(connection)
+    # stat_rollups создается после stats, вместе с заполнением агрегатов
+    skipped = (StatRollup.__tablename__,) + (PARTITIONED_TABLES if partitioned else ())
+    Base.metadata.create_all(bind=engine, tables=[
+        table for table in Base.metadata.sorted_tables if table.name not in skipped
+    ])
+    if partitioned:
+        create_partitioned_tables(engine)
+    _create_rollups(engine)
+    _add_missing_columns(engine)
+    _create_missing_indexes(engine)
     print("База данных успешно инициализирована")
 
 if __name__ == "__main__":
-    init_db() 
\ No newline at end of file
+    init_db()
@@ -1,11 +1,26 @@
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, Header, HTTPException, Query, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
 from sqlalchemy.orm import Session
-from . import crud, models, schemas, analitics
-from .database import engine, SessionLocal
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import (
+    crud, models, schemas, analitics, export, rollups, series, cache, metrics, binary_ingest, ingest_stream, registry
+)
+from .tasks import queue_depths
+from .database import (
+    engine, SessionLocal, AsyncSessionLocal, ReplicaSessionLocal, AsyncReplicaSessionLocal, pool_metrics,
+    replica_enabled, use_replica, use_replica_async
+)
 from datetime import datetime
+from typing import Optional
+import json
 import logging
-from .tasks import celery_app
-from .models import AnalysisResult
+import time
+import redis
+from prometheus_client import REGISTRY
+from starlette.routing import Match
+from .pagination import MAX_PAGE_SIZE
 
 # Настройка логирования
 logging.basicConfig(level=logging.WARNING)
@@ -13,6 +28,54 @@ logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
+# Заголовок запроса, включающий разбивку времени ответа в заголовке Server-Timing
+PROFILE_HEADER = "X-Profile"
+# Чтение с реплики: X-Read-After (секунды Unix или ISO-время) - реплика используется, только если применила
+# все изменения до этого момента; X-Consistency: primary - чтение только с основного сервера.
+# Ответы на запросы записи содержат X-Read-After, который клиент передает в следующем чтении
+READ_AFTER_HEADER = "X-Read-After"
+CONSISTENCY_HEADER = "X-Consistency"
+READ_SOURCE_HEADER = "X-Read-Source"
+
+metrics.register_pool_metrics(pool_metrics)
+metrics.register_queue_metrics(queue_depths)
+if ingest_stream.stream_enabled():
+    REGISTRY.register(ingest_stream.StreamCollector())
+
+def _route_path(request: Request) -> str:
+    """Шаблон пути маршрута: метрики не должны расти на каждый device_id"""
+    for route in app.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+@app.middleware("http")
+async def collect_metrics(request: Request, call_next):
+    timing = metrics.start_request()
+    started = time.perf_counter()
+    route = _route_path(request)
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        metrics.REQUEST_LATENCY.labels(request.method, route, str(status)).observe(time.perf_counter() - started)
+        metrics.REQUEST_SQL_QUERIES.labels(route).observe(timing.sql_queries)
+        metrics.REQUEST_SQL_SECONDS.labels(route).observe(timing.sql_seconds)
+    if request.headers.get(PROFILE_HEADER):
+        response.headers["Server-Timing"] = timing.server_timing()
+    if request.method != "GET" and replica_enabled():
+        # Ответ готов после commit: с этим временем следующее чтение увидит запись
+        response.headers[READ_AFTER_HEADER] = f"{time.time():.6f}"
+    return response
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    """Метрики в формате Prometheus"""
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
 # Dependency
 def get_db():
     db = SessionLocal()
@@ -21,25 +84,184 @@ def get_db():
     finally:
         db.close()
 
+def _read_after(request: Request):
+    """
+    Требование свежести чтения из заголовков.
+    :return: False - только основной сервер, None - допустимо отставание DB_REPLICA_MAX_LAG, иначе момент записи.
+    """
+    if request.headers.get(CONSISTENCY_HEADER, "").lower() == "primary":
+        return False
+    value = request.headers.get(READ_AFTER_HEADER)
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid {READ_AFTER_HEADER} header")
+
+def _mark_read_source(response: Response, replica: bool):
+    if replica_enabled():
+        response.headers[READ_SOURCE_HEADER] = "replica" if replica else "primary"
+
+# Сессия для тяжелых чтений: реплика, если она настроена и достаточно свежая, иначе основной сервер
+def get_read_db(request: Request, response: Response):
+    after = _read_after(request)
+    replica = after is not False and use_replica(after)
+    _mark_read_source(response, replica)
+    db = ReplicaSessionLocal() if replica else SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+async def get_async_read_db(request: Request, response: Response):
+    after = _read_after(request)
+    replica = after is not False and await use_replica_async(after)
+    _mark_read_source(response, replica)
+    async with (AsyncReplicaSessionLocal if replica else AsyncSessionLocal)() as db:
+        yield db
+
+@app.get("/health/db-pool")
+def get_db_pool_metrics():
+    """Состояние пулов соединений процесса API: выданные соединения, ожидание и таймауты"""
+    return pool_metrics()
+
 @app.post("/devices/", response_model=schemas.Device)
 def create_device(device: schemas.DeviceCreate, db: Session = Depends(get_db)):
     db_device = crud.create_device(db=db, device=device)
     return db_device
 
+@app.post("/retention/policies", response_model=schemas.RetentionPolicy)
+def create_retention_policy(policy: schemas.RetentionPolicyCreate, db: Session = Depends(get_db)):
+    """Срок хранения строк таблицы для устройства (device_id), владельца (owner) или по умолчанию"""
+    return crud.create_retention_policy(db, policy)
+
+@app.get("/retention/policies", response_model=list[schemas.RetentionPolicy])
+def get_retention_policies(db: Session = Depends(get_db)):
+    return crud.get_retention_policies(db)
+
+@app.delete("/retention/policies/{policy_id}", status_code=204)
+def delete_retention_policy(policy_id: int, db: Session = Depends(get_db)):
+    crud.delete_retention_policy(db, policy_id)
+    return Response(status_code=204)
+
 @app.post("/devices/{device_id}/stats/", response_model=schemas.StatResponse)
-def create_stat(device_id: int, stat: schemas.StatCreate, db: Session = Depends(get_db)):
+def create_stat(
+    device_id: int,
+    stat: schemas.StatCreate,
+    idempotency_key: Optional[str] = Header(None),
+    db: Session = Depends(get_db)
+):
+    """
+    В режиме STATS_INGEST_MODE=stream запись добавляется в поток Redis и API отвечает 202, не дожидаясь Postgres;
+    повтор запроса с тем же заголовком Idempotency-Key не создает второй записи.
+    Если Redis недоступен, запись выполняется синхронно.
+    """
+    if ingest_stream.stream_enabled():
+        # Запись для неизвестного устройства не попадает в поток
+        registry.require(db, device_id)
+        try:
+            accepted = ingest_stream.append(device_id, stat, idempotency_key)
+            return JSONResponse(status_code=202, content=jsonable_encoder(accepted))
+        except redis.RedisError as e:
+            logger.warning(f"Stream ingest unavailable, writing synchronously: {str(e)}")
     return crud.create_stat(db=db, stat=stat, device_id=device_id)
 
+def _check_batch_size(stats: list):
+    if len(stats) > crud.MAX_STAT_BATCH_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Batch size exceeds {crud.MAX_STAT_BATCH_SIZE} records"
+        )
+
+@app.post("/devices/{device_id}/stats/batch", response_model=schemas.StatBatchResponse)
+def create_stats_batch(device_id: int, stats: list[schemas.StatBatchItem], db: Session = Depends(get_db)):
+    """Пакетная загрузка статистики устройства одной транзакцией"""
+    _check_batch_size(stats)
+    return crud.create_stats_batch(db=db, stats=stats, device_id=device_id)
+
+@app.post("/stats/batch", response_model=schemas.StatBatchResponse)
+def create_multi_device_stats_batch(stats: list[schemas.DeviceStatBatchItem], db: Session = Depends(get_db)):
+    """Пакетная загрузка статистики нескольких устройств одной транзакцией"""
+    _check_batch_size(stats)
+    return crud.create_multi_device_stats_batch(db=db, stats=stats)
+
+@app.post("/devices/{device_id}/stats/binary", response_model=schemas.StatBatchResponse)
+async def create_stats_binary(device_id: int, request: Request, db: Session = Depends(get_db)):
+    """
+    Загрузка статистики устройства в двоичном формате application/vnd.stats.v1+octet-stream
+    (заголовок 8 байт и упакованные записи timestamp int64, x/y/z float32, см. app/binary_ingest.py)
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if content_type != binary_ingest.MEDIA_TYPE:
+        raise HTTPException(status_code=415, detail=f"Expected content type {binary_ingest.MEDIA_TYPE}")
+    body = await request.body()
+    # Запись в БД синхронная, выполняется в пуле потоков, чтобы не блокировать цикл событий
+    return await run_in_threadpool(crud.insert_binary_stats, db, device_id, body)
+
+def _stream_stats(bind, device_id: int, start_time: datetime, end_time: datetime, format: str):
+    """Генератор потоковой выгрузки с собственной сессией, живущей до конца передачи ответа"""
+    db = SessionLocal(bind=bind)
+    try:
+        rows = crud.iter_stats_by_device(db, device_id, start_time, end_time)
+        yield from export.FORMATTERS[format](rows)
+    finally:
+        db.close()
+
 @app.get("/devices/{device_id}/stats/", response_model=list[schemas.StatResponse])
-def get_device_stats(device_id: int, start_time: datetime, end_time: datetime, db: Session = Depends(get_db)):
+def get_device_stats(
+    device_id: int,
+    start_time: datetime,
+    end_time: datetime,
+    response: Response,
+    format: str = Query("json", regex="^(json|ndjson|csv)$"),
+    layout: str = Query("rows", regex="^(rows|columnar)$"),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    accept_encoding: Optional[str] = Header(None),
+    db: Session = Depends(get_read_db)
+):
+    # Столбцы {"timestamp": [...], "x": [...], ...} из кортежей запроса, без ORM- и pydantic-объектов,
+    # сериализуются orjson и сжимаются gzip/br по Accept-Encoding
+    if layout == "columnar":
+        if format != "json" or limit is not None or cursor is not None:
+            raise HTTPException(
+                status_code=400, detail="layout=columnar supports only format=json without pagination"
+            )
+        rows = crud.get_stats_columns(db, device_id, start_time, end_time)
+        with metrics.span("encode"):
+            body, headers = export.encode_json(export.columnar(rows), accept_encoding)
+        return Response(content=body, media_type="application/json", headers=headers)
+    # ndjson/csv отдаются потоком без загрузки всего периода в память
+    if format in export.FORMATTERS:
+        headers = {}
+        if format == "csv":
+            headers["Content-Disposition"] = f'attachment; filename="device_{device_id}_stats.csv"'
+        return StreamingResponse(
+            _stream_stats(db.get_bind(), device_id, start_time, end_time, format),
+            media_type=export.MEDIA_TYPES[format],
+            headers=headers
+        )
+    # Постраничная выдача: курсор следующей страницы возвращается в заголовке X-Next-Cursor
+    if limit is not None or cursor is not None:
+        stats, next_cursor = crud.get_stats_page(
+            db, device_id, start_time, end_time, limit=limit or MAX_PAGE_SIZE, cursor=cursor
+        )
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
+        return stats
     return crud.get_stats_by_device(db=db, device_id=device_id, start_time=start_time, end_time=end_time)
 
 @app.post("/devices/{device_id}/analyze/")
 def analyze_device(device_id: int, request: schemas.AnalysisRequest, db: Session = Depends(get_db)):
-    task_id = crud.start_device_analysis(db=db, device_id=device_id, 
-                                       start_time=request.start_time, 
-                                       end_time=request.end_time)
-    return {"task_id": task_id}
+    # Повторный запрос того же окна возвращает task_id выполняющегося анализа или готовый результат
+    return crud.start_device_analysis(db=db, device_id=device_id,
+                                      start_time=request.start_time,
+                                      end_time=request.end_time)
 
 @app.post("/users/{owner}/analyze/")
 def analyze_user_devices(owner: str, request: schemas.AnalysisRequest, db: Session = Depends(get_db)):
@@ -51,90 +273,202 @@ def analyze_user_devices(owner: str, request: schemas.AnalysisRequest, db: Sessi
         if not task_id:
             raise HTTPException(status_code=404, detail=f"No devices found for owner {owner}")
         return {"task_id": task_id}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error processing analysis request: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/analysis/{task_id}/")
-async def get_analysis_result(task_id: str, db: Session = Depends(get_db)):
-    """Получение результата анализа по ID задачи"""
-    try:
-        # Сначала проверяем результат в базе данных
-        result = db.query(AnalysisResult).filter(AnalysisResult.task_id == task_id).first()
-        if result:
-            return {
-                "status": "success",
-                "task_id": task_id,
-                "result": {
-                    "device_id": result.device_id,
-                    "start_time": result.start_time,
-                    "end_time": result.end_time,
-                    "avg_x": result.avg_x,
-                    "avg_y": result.avg_y,
-                    "avg_z": result.avg_z,
-                    "total_records": result.total_records
-                }
+# Максимальное время ожидания результата анализа в ?wait= и /events, секунды
+MAX_ANALYSIS_WAIT = 60
+# Интервал комментариев keep-alive в потоке /events, секунды
+EVENTS_KEEPALIVE_INTERVAL = 15
+
+async def _analysis_state(db: AsyncSession, task_id: str):
+    """Текущее состояние анализа: результат из БД или из redis-бэкенда Celery, иначе pending"""
+    # Сначала проверяем результат в базе данных
+    result = await crud.get_analysis_by_task_id(db, task_id)
+    if result:
+        return {
+            "status": "success",
+            "task_id": task_id,
+            "result": {
+                "device_id": result.device_id,
+                "start_time": result.start_time,
+                "end_time": result.end_time,
+                "avg_x": result.avg_x,
+                "avg_y": result.avg_y,
+                "avg_z": result.avg_z,
+                "total_records": result.total_records
             }
+        }
+    
+    # Анализ пользователя или парка: ход и результаты по устройствам из analysis_jobs/analysis_results
+    job = await crud.get_analysis_job(db, task_id)
+    if job is not None:
+        return await _job_state(db, job)
+    
+    # Если в базе нет, проверяем статус задачи в бэкенде результатов Celery
+    task_meta = await cache.get_task_meta(task_id)
+    
+    if task_meta is None or task_meta["status"] not in cache.CELERY_READY_STATES:
+        return {
+            "status": "pending",
+            "task_id": task_id
+        }
         
-        # Если в базе нет, проверяем статус задачи в Celery
-        task_result = celery_app.AsyncResult(task_id)
+    if task_meta["status"] != "SUCCESS":
+        raise HTTPException(status_code=500, detail=str(task_meta["result"]))
         
-        if not task_result.ready():
-            return {
-                "status": "pending",
-                "task_id": task_id
-            }
-            
-        if task_result.failed():
-            raise HTTPException(status_code=500, detail=str(task_result.result))
-            
-        result = task_result.get()
-        if result is None:
-            raise HTTPException(status_code=404, detail="Результат анализа не найден")
-            
-        # Если результат - словарь с task_id (результат analyze_user_devices)
-        if isinstance(result, dict) and all(isinstance(v, str) for v in result.values()):
-            # Получаем результаты для каждого устройства
-            device_results = {}
-            for device_id, device_task_id in result.items():
-                device_result = db.query(AnalysisResult).filter(
-                    AnalysisResult.task_id == device_task_id
-                ).first()
-                if device_result:
-                    device_results[device_id] = {
-                        "avg_x": device_result.avg_x,
-                        "avg_y": device_result.avg_y,
-                        "avg_z": device_result.avg_z,
-                        "total_records": device_result.total_records
-                    }
-            
-            return {
-                "status": "success",
-                "task_id": task_id,
-                "results": device_results
-            }
-            
-        # Если результат - одиночный анализ устройства
+    result = task_meta["result"]
+    if result is None:
+        raise HTTPException(status_code=404, detail="Результат анализа не найден")
+        
+    # Сводный результат analyze_user_devices / analyze_all_devices
+    if isinstance(result, dict) and "devices" in result:
         return {
             "status": "success",
             "task_id": task_id,
-            "result": result
+            "total_records": result["total_records"],
+            "results": result["devices"]
+        }
+        
+    # Если результат - одиночный анализ устройства
+    return {
+        "status": "success",
+        "task_id": task_id,
+        "result": result
+    }
+
+async def _job_state(db: AsyncSession, job: models.AnalysisJob):
+    """Состояние задания: готовые результаты по устройствам и счетчики обработанных/оставшихся устройств"""
+    if job.status == "failure":
+        raise HTTPException(status_code=500, detail="Анализ устройств завершился с ошибкой")
+    rows = await crud.get_job_results(db, job.id)
+    processed = job.processed_devices or 0
+    return {
+        "status": job.status,
+        "task_id": job.task_id,
+        "progress": {
+            "total": job.total_devices,
+            "done": processed,
+            "pending": job.total_devices - processed if job.total_devices is not None else None
+        },
+        "total_records": sum(row.total_records for row in rows),
+        "results": {
+            row.device_id: {
+                "avg_x": row.avg_x,
+                "avg_y": row.avg_y,
+                "avg_z": row.avg_z,
+                "total_records": row.total_records
+            }
+            for row in rows
         }
-            
+    }
+
+async def _state_after_done(db: AsyncSession, task_id: str, event: dict):
+    """Состояние после уведомления о завершении: из БД, а если там результата нет - из самого уведомления"""
+    state = await _analysis_state(db, task_id)
+    return _done_state(task_id, event) if state["status"] == "pending" else state
+
+def _done_state(task_id: str, event: dict):
+    """Состояние анализа по уведомлению о завершении задачи"""
+    if event["status"] != "success":
+        raise HTTPException(status_code=500, detail=str(event["result"]))
+    if event["result"] is None:
+        raise HTTPException(status_code=404, detail="Результат анализа не найден")
+    return {
+        "status": "success",
+        "task_id": task_id,
+        "result": event["result"]
+    }
+
+@app.get("/analysis/{task_id}/")
+async def get_analysis_result(
+    task_id: str,
+    wait: Optional[float] = Query(None, gt=0, le=MAX_ANALYSIS_WAIT)
+):
+    """
+    Получение результата анализа по ID задачи.
+    С параметром wait запрос ждет завершения задачи до wait секунд вместо немедленного ответа pending.
+    Сессия БД открывается только на время чтения состояния: ожидание не держит соединение из пула.
+    """
+    try:
+        if not wait:
+            async with AsyncSessionLocal() as db:
+                return await _analysis_state(db, task_id)
+        async with cache.subscribe_done(task_id) as subscription:
+            async with AsyncSessionLocal() as db:
+                state = await _analysis_state(db, task_id)
+            if state["status"] == "pending":
+                event = await cache.wait_done(subscription, wait)
+                if event is not None:
+                    async with AsyncSessionLocal() as db:
+                        state = await _state_after_done(db, task_id, event)
+            return state
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error getting analysis result: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(jsonable_encoder(data))}\n\n"
+
+async def _stream_analysis_events(task_id: str, timeout: float):
+    """Поток SSE: текущее состояние, затем итоговое состояние после уведомления о завершении"""
+    try:
+        async with cache.subscribe_done(task_id) as subscription:
+            async with AsyncSessionLocal() as db:
+                state = await _analysis_state(db, task_id)
+            yield _sse("status", state)
+            remaining = timeout
+            while state["status"] == "pending" and remaining > 0:
+                event = await cache.wait_done(subscription, min(EVENTS_KEEPALIVE_INTERVAL, remaining))
+                remaining -= EVENTS_KEEPALIVE_INTERVAL
+                if event is None:
+                    yield ": keep-alive\n\n"
+                    continue
+                async with AsyncSessionLocal() as db:
+                    state = await _state_after_done(db, task_id, event)
+                yield _sse("status", state)
+    except HTTPException as e:
+        yield _sse("error", {"status_code": e.status_code, "detail": e.detail})
+    except Exception as e:
+        logger.error(f"Error streaming analysis events: {str(e)}")
+        yield _sse("error", {"status_code": 500, "detail": str(e)})
+
+@app.get("/analysis/{task_id}/events")
+async def get_analysis_events(task_id: str, timeout: float = Query(MAX_ANALYSIS_WAIT, gt=0, le=MAX_ANALYSIS_WAIT)):
+    """
+    Server-Sent Events: событие status с текущим состоянием и событие status с результатом после завершения задачи.
+    Поток закрывается после результата, ошибки (событие error) или через timeout секунд.
+    """
+    return StreamingResponse(
+        _stream_analysis_events(task_id, timeout),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"}
+    )
+
 @app.get("/devices/{device_id}/analysis/")
-async def get_device_analysis(device_id: int, db: Session = Depends(get_db)):
-    """Получение всех результатов анализа для устройства"""
+async def get_device_analysis(
+    device_id: int,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    """Получение результатов анализа для устройства, от новых к старым, с keyset-пагинацией"""
     try:
-        # Получаем все результаты анализа для устройства
-        results = db.query(AnalysisResult).filter(
-            AnalysisResult.device_id == device_id
-        ).all()
+        next_cursor = None
+        if limit is not None or cursor is not None:
+            results, next_cursor = await crud.get_analysis_page(
+                db, device_id, limit=limit or MAX_PAGE_SIZE, cursor=cursor
+            )
+        else:
+            # Получаем все результаты анализа для устройства
+            results = await crud.get_device_analysis_results(db, device_id)
         
-        if not results:
+        if not results and cursor is None:
             raise HTTPException(status_code=404, detail="Результаты анализа не найдены")
         
         return {
@@ -151,8 +485,11 @@ async def get_device_analysis(device_id: int, db: Session = Depends(get_db)):
                     "total_records": result.total_records
                 }
                 for result in results
-            ]
+            ],
+            "next_cursor": next_cursor
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error getting device analysis: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -162,25 +499,63 @@ def get_device_analytics(
     device_id: int,
     start_time: datetime,
     end_time: datetime,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
-    # Получение данных за указанный период
-    stats = crud.get_stats_by_device(db, device_id, start_time, end_time)
-    if not stats:
+    # Полные часовые корзины берутся из агрегатов, из stats читаются только крайние
+    aggregates = rollups.window_statistics(db, device_id, start_time, end_time, with_median=True)
+    if not aggregates["count"]:
         raise HTTPException(status_code=404, detail="No stats found for the given period")
 
-    # Извлечение значений x, y, z
-    x_values = [stat.x for stat in stats]
-    y_values = [stat.y for stat in stats]
-    z_values = [stat.z for stat in stats]
+    return {
+        axis: analitics.to_statistics(aggregates[axis])
+        for axis in analitics.AXES
+    }
+
+# Максимальное количество окон в одном запросе пакетной аналитики
+MAX_ANALYTICS_WINDOWS = 500
 
-    # Расчет статистики
-    x_stats = analitics.calculate_statistics(x_values)
-    y_stats = analitics.calculate_statistics(y_values)
-    z_stats = analitics.calculate_statistics(z_values)
+@app.post("/analytics/batch")
+def get_batch_analytics(request: schemas.AnalyticsBatchRequest, db: Session = Depends(get_read_db)):
+    """
+    Аналитика для списка окон (device_id, start_time, end_time) или всех устройств владельца за период
+    одним сгруппированным запросом. Результаты - по ключу окна (key или номер окна в списке,
+    для владельца - id устройства); окна без записей возвращаются с count = 0.
+    """
+    if (request.windows is None) == (request.owner is None):
+        raise HTTPException(status_code=400, detail="Specify either windows or owner")
+    if request.owner is not None and (request.start_time is None or request.end_time is None):
+        raise HTTPException(status_code=400, detail="start_time and end_time are required with owner")
+    windows = [
+        (window.key if window.key is not None else str(number), window.device_id, window.start_time, window.end_time)
+        for number, window in enumerate(request.windows or [])
+    ]
+    if len(windows) > MAX_ANALYTICS_WINDOWS:
+        raise HTTPException(status_code=413, detail=f"Batch size exceeds {MAX_ANALYTICS_WINDOWS} windows")
+    if len({window[0] for window in windows}) != len(windows):
+        raise HTTPException(status_code=400, detail="Window keys must be unique")
 
+    aggregates = rollups.windows_statistics(
+        db, windows, owner=request.owner, start_time=request.start_time, end_time=request.end_time
+    )
     return {
-        "x": x_stats,
-        "y": y_stats,
-        "z": z_stats
-    }
\ No newline at end of file
+        key: dict(
+            device_id=result["device_id"],
+            start_time=result["start_time"],
+            end_time=result["end_time"],
+            count=result["count"],
+            **{axis: analitics.to_statistics(result[axis]) for axis in analitics.AXES}
+        )
+        for key, result in aggregates.items()
+    }
+
+@app.get("/devices/{device_id}/series")
+def get_device_series(
+    device_id: int,
+    start: datetime,
+    end: datetime,
+    bucket: str = Query("auto", regex="^(1m|1h|1d|auto)$"),
+    points: int = Query(500, ge=1, le=series.MAX_SERIES_POINTS),
+    db: Session = Depends(get_read_db)
+):
+    """Прореженный ряд min/avg/max по x, y, z из предрассчитанных таблиц (задержка до минуты)"""
+    return series.get_series(db, device_id, start, end, bucket=bucket, points=points)
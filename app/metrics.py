@@ -0,0 +1,182 @@
+"""
+Метрики Prometheus и разбивка времени отдельного запроса (заголовок Server-Timing).
+
+Метрики API собираются в процессе uvicorn и отдаются через GET /metrics. Метрики Celery пишутся
+дочерними процессами воркера в каталог PROMETHEUS_MULTIPROC_DIR и отдаются главным процессом воркера
+на порту CELERY_METRICS_PORT. Если PROMETHEUS_MULTIPROC_DIR задан и для API (несколько процессов uvicorn),
+/metrics тоже собирает метрики всех процессов.
+"""
+import logging
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from prometheus_client import (
+    REGISTRY, CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+)
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Время обработки HTTP-запроса",
+    ["method", "route", "status"]
+)
+REQUEST_SQL_QUERIES = Histogram(
+    "http_request_sql_queries", "Количество SQL-запросов на один HTTP-запрос",
+    ["route"], buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+)
+REQUEST_SQL_SECONDS = Histogram(
+    "http_request_sql_duration_seconds", "Суммарное время SQL-запросов на один HTTP-запрос",
+    ["route"]
+)
+SQL_QUERY_SECONDS = Histogram(
+    "sql_query_duration_seconds", "Время выполнения одного SQL-запроса",
+    ["engine"]
+)
+CELERY_QUEUE_WAIT = Histogram(
+    "celery_task_queue_wait_seconds", "Время от отправки задачи до начала выполнения",
+    ["task"], buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+)
+CELERY_RUN_SECONDS = Histogram(
+    "celery_task_run_seconds", "Время выполнения задачи",
+    ["task", "state"], buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+)
+ANALYSIS_RECORDS = Histogram(
+    "analysis_records", "Количество записей stats, охваченных одним анализом",
+    ["kind"], buckets=(10, 100, 1000, 10000, 100000, 1000000, 10000000, 100000000)
+)
+INGEST_ROWS = Counter(
+    "stats_ingested_rows_total", "Записанные строки статистики (скорость - rate())",
+    ["source"]
+)
+DB_READ_ROUTING = Counter(
+    "db_read_routing_total", "Тяжелые чтения по серверу: replica или primary (отставание реплики или read-your-writes)",
+    ["target"]
+)
+DEVICE_REGISTRY_LOOKUPS = Counter(
+    "device_registry_lookups_total", "Поиск устройств в кеше процесса: hit - без запроса к Postgres",
+    ["result"]
+)
+RETENTION_ROWS = Counter(
+    "retention_deleted_rows_total", "Строки, удаленные по срокам хранения и как устаревшие результаты анализа",
+    ["table"]
+)
+
+class RequestTiming:
+    """Разбивка времени одного запроса: SQL и именованные участки"""
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_queries = 0
+        self.sql_seconds = 0.0
+        self.spans = {}
+
+    def server_timing(self) -> str:
+        """Значение заголовка Server-Timing, длительности в миллисекундах"""
+        parts = [f'sql;dur={self.sql_seconds * 1000:.2f};desc="{self.sql_queries} queries"']
+        parts += [f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.spans.items()]
+        parts.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.2f}")
+        return ", ".join(parts)
+
+_request_timing = ContextVar("request_timing", default=None)
+
+def start_request() -> RequestTiming:
+    timing = RequestTiming()
+    _request_timing.set(timing)
+    return timing
+
+@contextmanager
+def span(name: str):
+    """Замер участка кода; попадает в Server-Timing, если запрос профилируется"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing = _request_timing.get()
+        if timing is not None:
+            timing.spans[name] = timing.spans.get(name, 0.0) + time.perf_counter() - started
+
+def instrument_engine(engine, name: str):
+    """Счетчики и длительность SQL-запросов движка (для асинхронного - передавать engine.sync_engine)"""
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - connection.info["query_started"].pop()
+        SQL_QUERY_SECONDS.labels(name).observe(elapsed)
+        timing = _request_timing.get()
+        if timing is not None:
+            timing.sql_queries += 1
+            timing.sql_seconds += elapsed
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(exception_context):
+        connection = exception_context.connection
+        if connection is not None and connection.info.get("query_started"):
+            connection.info["query_started"].pop()
+
+class _PoolCollector:
+    """Состояние пулов соединений процесса в виде gauge-метрик"""
+    def __init__(self, pool_metrics):
+        self.pool_metrics = pool_metrics
+
+    def collect(self):
+        gauges = {
+            name: GaugeMetricFamily(f"db_pool_{name}", description, labels=["engine"])
+            for name, description in (
+                ("checked_out", "Выданные соединения"),
+                ("overflow", "Соединения сверх pool_size"),
+                ("checkouts", "Выдачи соединений с запуска процесса"),
+                ("timeouts", "Таймауты ожидания соединения с запуска процесса"),
+                ("wait_seconds_total", "Суммарное ожидание соединения с запуска процесса"),
+                ("wait_seconds_max", "Максимальное ожидание соединения с запуска процесса"),
+                ("lag_seconds", "Отставание реплики по последней проверке")
+            )
+        }
+        for engine, values in self.pool_metrics().items():
+            for name, gauge in gauges.items():
+                if name in values:
+                    gauge.add_metric([engine], values[name])
+        return gauges.values()
+
+def register_pool_metrics(pool_metrics):
+    REGISTRY.register(_PoolCollector(pool_metrics))
+
+class _QueueCollector:
+    """Количество ожидающих задач в очередях celery, читается из брокера при каждом запросе метрик"""
+    def __init__(self, queue_depths):
+        self.queue_depths = queue_depths
+
+    def describe(self):
+        # Регистрация не обращается к брокеру
+        return [GaugeMetricFamily("celery_queue_depth", "Задачи, ожидающие в очереди", labels=["queue"])]
+
+    def collect(self):
+        gauge = self.describe()[0]
+        try:
+            depths = self.queue_depths()
+        except Exception as e:
+            logger.warning(f"Failed to read celery queue depths: {str(e)}")
+            depths = {}
+        for queue, depth in depths.items():
+            gauge.add_metric([queue], depth)
+        return [gauge]
+
+def register_queue_metrics(queue_depths):
+    REGISTRY.register(_QueueCollector(queue_depths))
+
+def multiprocess_enabled() -> bool:
+    return bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+
+def multiprocess_registry() -> CollectorRegistry:
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+def render():
+    """Текст метрик и его content-type для ответа /metrics"""
+    registry = multiprocess_registry() if multiprocess_enabled() else REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, BigInteger, String, Float, DateTime, ForeignKey, Index, text
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship
 from .database import Base
 from datetime import datetime
@@ -18,6 +19,16 @@ class Device(Base):
 
 class Stat(Base):
     __tablename__ = "stats"
+    __table_args__ = (
+        # Диапазонные запросы по устройству и времени и keyset-пагинация по (timestamp, id)
+        Index("ix_stats_device_id_timestamp", "device_id", "timestamp", "id"),
+        # Идемпотентная запись из потока Redis: повторно доставленная запись не вставляется второй раз.
+        # timestamp входит в индекс, потому что уникальный индекс секционированной таблицы включает ключ секционирования
+        Index(
+            "ux_stats_ingest_key", "device_id", "timestamp", "ingest_key",
+            unique=True, postgresql_where=text("ingest_key IS NOT NULL")
+        ),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     device_id = Column(Integer, ForeignKey("devices.id"))
@@ -25,12 +36,20 @@ class Stat(Base):
     x = Column(Float)
     y = Column(Float)
     z = Column(Float)
+    # Ключ идемпотентности записи, поступившей через поток Redis (NULL для синхронной записи)
+    ingest_key = Column(String, nullable=True)
     
     # Связь с устройством
     device = relationship("Device", back_populates="stats")
 
 class AnalysisResult(Base):
     __tablename__ = "analysis_results"
+    __table_args__ = (
+        # История анализов устройства и keyset-пагинация по (created_at, id)
+        Index("ix_analysis_results_device_id_created_at", "device_id", "created_at", "id"),
+        # Поиск более новых результатов того же окна при удалении устаревших (app/retention.py)
+        Index("ix_analysis_results_device_window", "device_id", "start_time", "end_time", "id"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     task_id = Column(String, unique=True, index=True)
@@ -41,13 +60,39 @@ class AnalysisResult(Base):
     avg_y = Column(Float)
     avg_z = Column(Float)
     total_records = Column(Integer)
+    # Анализ пользователя или парка, в рамках которого получен результат
+    job_id = Column(Integer, ForeignKey("analysis_jobs.id"), index=True, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     
     # Связь с устройством
     device = relationship("Device", back_populates="analysis_results")
+    job = relationship("AnalysisJob", back_populates="results")
+
+class AnalysisJob(Base):
+    """Анализ всех устройств пользователя (owner) или всего парка (owner = NULL)"""
+    __tablename__ = "analysis_jobs"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    task_id = Column(String, unique=True, index=True)
+    owner = Column(String, nullable=True)
+    start_time = Column(DateTime)
+    end_time = Column(DateTime)
+    # pending, success или failure
+    status = Column(String, default="pending")
+    # Количество устройств в анализе и уже обработанных (в том числе без записей за период)
+    total_devices = Column(Integer, nullable=True)
+    processed_devices = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+    
+    # Результаты по устройствам
+    results = relationship("AnalysisResult", back_populates="job")
 
 class DeviceData(Base):
     __tablename__ = "device_data"
+    __table_args__ = (
+        Index("ix_device_data_device_id_timestamp", "device_id", "timestamp"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     device_id = Column(Integer, ForeignKey("devices.id"))
@@ -57,4 +102,82 @@ class DeviceData(Base):
     z = Column(Float)
     
     # Связь с устройством
-    device = relationship("Device", back_populates="device_data")
\ No newline at end of file
+    device = relationship("Device", back_populates="device_data")
+
+class StatRollup(Base):
+    """Агрегаты статистики устройства по часовым корзинам, обновляются при записи"""
+    __tablename__ = "stat_rollups"
+
+    device_id = Column(Integer, ForeignKey("devices.id"), primary_key=True)
+    bucket_start = Column(DateTime, primary_key=True)
+    count = Column(BigInteger, nullable=False, default=0)
+    sum_x = Column(Float)
+    sumsq_x = Column(Float)
+    min_x = Column(Float)
+    max_x = Column(Float)
+    sketch_x = Column(JSONB)
+    sum_y = Column(Float)
+    sumsq_y = Column(Float)
+    min_y = Column(Float)
+    max_y = Column(Float)
+    sketch_y = Column(JSONB)
+    sum_z = Column(Float)
+    sumsq_z = Column(Float)
+    min_z = Column(Float)
+    max_z = Column(Float)
+    sketch_z = Column(JSONB)
+
+class StatSeries(Base):
+    """Прореженные ряды статистики (1m/1h/1d), пересчитываются периодической задачей"""
+    __tablename__ = "stat_series"
+
+    device_id = Column(Integer, ForeignKey("devices.id"), primary_key=True)
+    resolution = Column(String(3), primary_key=True)
+    bucket_start = Column(DateTime, primary_key=True)
+    count = Column(BigInteger, nullable=False)
+    sum_x = Column(Float)
+    min_x = Column(Float)
+    max_x = Column(Float)
+    sum_y = Column(Float)
+    min_y = Column(Float)
+    max_y = Column(Float)
+    sum_z = Column(Float)
+    min_z = Column(Float)
+    max_z = Column(Float)
+
+class SeriesDirtyBucket(Base):
+    """
+    Минутная корзина устройства с новыми записями stats, ожидающая пересчета рядов.
+    Отмечается в транзакции записи, version растет при каждой новой записи в корзину.
+    """
+    __tablename__ = "stat_series_dirty"
+
+    device_id = Column(Integer, ForeignKey("devices.id"), primary_key=True)
+    bucket_start = Column(DateTime, primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
+
+class StatSegment(Base):
+    """Архивный сегмент статистики устройства за месяц: столбцы timestamp/x/y/z в файлах .npy (см. app/archive.py)"""
+    __tablename__ = "stat_segments"
+
+    device_id = Column(Integer, ForeignKey("devices.id"), primary_key=True)
+    period_start = Column(DateTime, primary_key=True)
+    path = Column(String, nullable=False)
+    count = Column(BigInteger, nullable=False)
+    first_timestamp = Column(DateTime, nullable=False)
+    last_timestamp = Column(DateTime, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class RetentionPolicy(Base):
+    """
+    Срок хранения строк таблицы (stats, device_data, analysis_results, stat_rollups).
+    Политика устройства важнее политики владельца, политика владельца - политики по умолчанию (owner и device_id NULL).
+    """
+    __tablename__ = "retention_policies"
+
+    id = Column(Integer, primary_key=True, index=True)
+    table_name = Column(String, nullable=False)
+    owner = Column(String, nullable=True)
+    device_id = Column(Integer, ForeignKey("devices.id"), nullable=True)
+    keep_days = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
@@ -0,0 +1,54 @@
+import base64
+import json
+from datetime import datetime
+from fastapi import HTTPException
+from sqlalchemy import tuple_
+
+# Максимальный размер страницы
+MAX_PAGE_SIZE = 1000
+
+def encode_cursor(timestamp: datetime, row_id: int) -> str:
+    """Непрозрачный курсор из ключа последней строки страницы (timestamp, id)"""
+    payload = json.dumps([timestamp.isoformat(), row_id]).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+def decode_cursor(cursor: str):
+    """Разбор курсора в кортеж (timestamp, id)"""
+    try:
+        payload = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        timestamp, row_id = json.loads(payload)
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def keyset(statement, key_columns: tuple, limit: int, cursor: str = None, descending: bool = False):
+    """
+    Keyset-пагинация: страница выбирается условием по ключу (timestamp, id) от курсора,
+    поэтому стоимость любой страницы равна стоимости первой при наличии индекса по ключу.
+    Подходит и для Query, и для select(); выбирается limit + 1 строка, чтобы понять, есть ли следующая страница.
+    """
+    key = tuple_(*key_columns)
+    if cursor:
+        bound = tuple_(*decode_cursor(cursor))
+        statement = statement.where(key < bound if descending else key > bound)
+    order = [column.desc() if descending else column for column in key_columns]
+    return statement.order_by(*order).limit(limit + 1)
+
+def split_page(rows: list, key_columns: tuple, limit: int):
+    """:return: Кортеж (строки страницы, курсор следующей страницы или None)."""
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(*(getattr(last, column.key) for column in key_columns))
+    return rows, next_cursor
+
+def paginate(query, key_columns: tuple, limit: int, cursor: str = None, descending: bool = False):
+    rows = keyset(query, key_columns, limit, cursor, descending).all()
+    return split_page(rows, key_columns, limit)
+
+async def paginate_async(db, statement, key_columns: tuple, limit: int, cursor: str = None,
+                         descending: bool = False):
+    """То же, что paginate, для select() в асинхронной сессии"""
+    result = await db.execute(keyset(statement, key_columns, limit, cursor, descending))
+    return split_page(result.scalars().all(), key_columns, limit)
@@ -0,0 +1,126 @@
+from datetime import date, datetime
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Таблицы временных рядов, которые можно секционировать по месяцам
+PARTITIONED_TABLES = ("stats", "device_data")
+
+# DDL секционированной таблицы. Ключ секционирования должен входить в первичный ключ,
+# поэтому он составной (id, timestamp). Набор колонок должен совпадать с models.Stat / models.DeviceData.
+PARTITIONED_TABLE_DDL = """
+CREATE TABLE IF NOT EXISTS {table} (
+    id SERIAL,
+    device_id INTEGER REFERENCES devices (id),
+    "timestamp" TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    x DOUBLE PRECISION,
+    y DOUBLE PRECISION,
+    z DOUBLE PRECISION,{extra_columns}
+    PRIMARY KEY (id, "timestamp")
+) PARTITION BY RANGE ("timestamp")
+"""
+
+# Колонки, которые есть только в одной из секционированных таблиц
+PARTITIONED_EXTRA_COLUMNS = {
+    "stats": "\n    ingest_key VARCHAR,"
+}
+
+def _month_start(value: date, shift: int = 0) -> date:
+    """Первое число месяца, сдвинутого на shift месяцев"""
+    month_index = value.year * 12 + value.month - 1 + shift
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+def partition_name(table: str, month: date) -> str:
+    return f"{table}_y{month.year}m{month.month:02d}"
+
+def is_partitioned(connection, table: str) -> bool:
+    return connection.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table p "
+        "JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = :table)"
+    ), {"table": table}).scalar()
+
+def create_partitioned_tables(engine: Engine, tables=PARTITIONED_TABLES, months_back: int = 0, months_ahead: int = 3):
+    """
+    Создает секционированные по месяцам таблицы, секцию по умолчанию и секции на ближайшие месяцы.
+    Таблица devices должна уже существовать.
+    """
+    with engine.begin() as connection:
+        for table in tables:
+            connection.execute(text(PARTITIONED_TABLE_DDL.format(
+                table=table, extra_columns=PARTITIONED_EXTRA_COLUMNS.get(table, "")
+            )))
+            connection.execute(text(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT"))
+    ensure_partitions(engine, tables=tables, months_back=months_back, months_ahead=months_ahead)
+
+def ensure_partitions(engine: Engine, tables=PARTITIONED_TABLES, months_back: int = 0, months_ahead: int = 3,
+                      today: date = None):
+    """
+    Заранее создает месячные секции с months_back месяцев назад по months_ahead месяцев вперед.
+    :return: Список созданных секций.
+    """
+    today = today or datetime.utcnow().date()
+    created = []
+    for table in tables:
+        with engine.connect() as connection:
+            if not is_partitioned(connection, table):
+                continue
+        for shift in range(-months_back, months_ahead + 1):
+            month = _month_start(today, shift)
+            name = partition_name(table, month)
+            try:
+                # Каждая секция в своей транзакции: ошибка одной не откатывает остальные
+                with engine.begin() as connection:
+                    exists = connection.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": name}).scalar()
+                    if exists:
+                        continue
+                    connection.execute(text(
+                        f"CREATE TABLE {name} PARTITION OF {table} "
+                        f"FOR VALUES FROM ('{month.isoformat()}') TO ('{_month_start(month, 1).isoformat()}')"
+                    ))
+                created.append(name)
+            except Exception as e:
+                # Например, в секции по умолчанию уже есть строки за этот месяц
+                logger.error(f"Failed to create partition {name}: {str(e)}")
+    if created:
+        logger.info(f"Created partitions: {', '.join(created)}")
+    return created
+
+def detach_old_partitions(engine: Engine, retention_months: int, tables=PARTITIONED_TABLES, drop: bool = False,
+                          today: date = None):
+    """
+    Отсоединяет секции, которые целиком старше retention_months месяцев.
+    Отсоединение — операция над метаданными и не переписывает данные.
+    :param drop: Удалить отсоединенные секции.
+    :return: Список отсоединенных секций.
+    """
+    today = today or datetime.utcnow().date()
+    cutoff = _month_start(today, -retention_months)
+    detached = []
+    for table in tables:
+        with engine.begin() as connection:
+            if not is_partitioned(connection, table):
+                continue
+            names = connection.execute(text(
+                "SELECT c.relname FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid "
+                "JOIN pg_class p ON p.oid = i.inhparent "
+                "WHERE p.relname = :table"
+            ), {"table": table}).scalars().all()
+            for name in sorted(names):
+                suffix = name[len(table) + 1:]
+                try:
+                    month = datetime.strptime(suffix, "y%Ym%m").date()
+                except ValueError:
+                    # Секция по умолчанию и секции с нестандартными именами не трогаем
+                    continue
+                if _month_start(month, 1) > cutoff:
+                    continue
+                connection.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+                if drop:
+                    connection.execute(text(f"DROP TABLE {name}"))
+                detached.append(name)
+    if detached:
+        logger.info(f"Detached partitions: {', '.join(detached)}")
+    return detached
@@ -0,0 +1,185 @@
+"""
+Кеш устройств в памяти процесса для проверок при записи и анализе без запроса к Postgres.
+
+Устройство ищется по числовому id или строковому device_id, результат - словарь {"id", "device_id", "owner"}.
+Кеш ограничен DEVICE_CACHE_SIZE записями (вытесняются давно не использованные) и временем жизни DEVICE_CACHE_TTL.
+Отсутствие устройства тоже кешируется, на DEVICE_CACHE_MISS_TTL секунд: create_device публикует новое устройство
+в канал Redis devices:created, и каждый процесс удаляет из кеша отрицательные записи по его id, device_id и владельцу.
+Пока подписка на канал не работает (Redis недоступен), отсутствие устройств не кешируется,
+а после переподключения кеш очищается: сообщения за это время потеряны.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, Optional
+import redis
+from fastapi import HTTPException
+from sqlalchemy.orm import Session
+from .models import Device
+from . import cache, metrics
+
+logger = logging.getLogger(__name__)
+
+DEVICE_CACHE_SIZE = int(os.getenv("DEVICE_CACHE_SIZE", "100000"))
+DEVICE_CACHE_TTL = float(os.getenv("DEVICE_CACHE_TTL", "300"))
+DEVICE_CACHE_MISS_TTL = float(os.getenv("DEVICE_CACHE_MISS_TTL", "5"))
+DEVICES_CHANNEL = "devices:created"
+# Пауза перед переподключением подписки после ошибки Redis, секунды
+RESUBSCRIBE_DELAY = 1.0
+
+# Ключ ("id", 1), ("device_id", "sensor-1") или ("owner", "alice") -> (момент истечения, значение)
+_entries = OrderedDict()
+_lock = threading.Lock()
+_subscribed = threading.Event()
+_listener_pid = None
+
+def _get(key):
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None:
+            return False, None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del _entries[key]
+            return False, None
+        _entries.move_to_end(key)
+        return True, value
+
+def _put(key, value):
+    if value is None and not _subscribed.is_set():
+        return
+    ttl = DEVICE_CACHE_TTL if value is not None else DEVICE_CACHE_MISS_TTL
+    with _lock:
+        _entries[key] = (time.monotonic() + ttl, value)
+        _entries.move_to_end(key)
+        while len(_entries) > DEVICE_CACHE_SIZE:
+            _entries.popitem(last=False)
+
+def _remember(device: Optional[dict], *keys):
+    """Кеширует устройство под обоими ключами, отсутствие - под запрошенными"""
+    if device is None:
+        for key in keys:
+            _put(key, None)
+        return
+    _put(("id", device["id"]), device)
+    _put(("device_id", device["device_id"]), device)
+
+def _row_to_device(row) -> dict:
+    return {"id": row.id, "device_id": row.device_id, "owner": row.owner}
+
+def _lookup(db: Session, key, condition) -> Optional[dict]:
+    _ensure_listener()
+    found, device = _get(key)
+    metrics.DEVICE_REGISTRY_LOOKUPS.labels("hit" if found else "miss").inc()
+    if found:
+        return device
+    row = db.query(Device.id, Device.device_id, Device.owner).filter(condition).first()
+    device = _row_to_device(row) if row else None
+    _remember(device, key)
+    return device
+
+def get(db: Session, device_pk: int) -> Optional[dict]:
+    """Устройство по числовому id или None"""
+    return _lookup(db, ("id", device_pk), Device.id == device_pk)
+
+def get_by_device_id(db: Session, device_id: str) -> Optional[dict]:
+    """Устройство по строковому device_id или None"""
+    return _lookup(db, ("device_id", device_id), Device.device_id == device_id)
+
+def require(db: Session, device_pk: int) -> dict:
+    """Устройство по числовому id, 404 для неизвестного"""
+    device = get(db, device_pk)
+    if device is None:
+        raise HTTPException(status_code=404, detail="Device not found")
+    return device
+
+def require_many(db: Session, device_pks: Iterable[int]) -> dict:
+    """
+    Устройства по числовым id; незакешированные загружаются одним запросом.
+    :return: Словарь {id: устройство}, 404 со списком id, если часть устройств неизвестна.
+    """
+    _ensure_listener()
+    devices = {}
+    missing = []
+    for device_pk in set(device_pks):
+        found, device = _get(("id", device_pk))
+        if found and device is not None:
+            devices[device_pk] = device
+        elif not found:
+            missing.append(device_pk)
+    metrics.DEVICE_REGISTRY_LOOKUPS.labels("hit").inc(len(devices))
+    metrics.DEVICE_REGISTRY_LOOKUPS.labels("miss").inc(len(missing))
+    if missing:
+        for row in db.query(Device.id, Device.device_id, Device.owner).filter(Device.id.in_(missing)):
+            devices[row.id] = _row_to_device(row)
+            _remember(devices[row.id])
+        for device_pk in missing:
+            if device_pk not in devices:
+                _remember(None, ("id", device_pk))
+    unknown = sorted(set(device_pks) - set(devices))
+    if unknown:
+        raise HTTPException(status_code=404, detail=f"Unknown devices: {', '.join(map(str, unknown[:20]))}")
+    return devices
+
+def owner_exists(db: Session, owner: str) -> bool:
+    """Есть ли у владельца хотя бы одно устройство"""
+    _ensure_listener()
+    key = ("owner", owner)
+    found, exists = _get(key)
+    metrics.DEVICE_REGISTRY_LOOKUPS.labels("hit" if found else "miss").inc()
+    if found:
+        return exists is not None
+    exists = db.query(Device.id).filter(Device.owner == owner).first() is not None
+    _put(key, True if exists else None)
+    return exists
+
+def _forget(device: dict):
+    with _lock:
+        for key in (("id", device.get("id")), ("device_id", device.get("device_id")), ("owner", device.get("owner"))):
+            _entries.pop(key, None)
+
+def announce(device: Device):
+    """Сообщает всем процессам о новом устройстве (вызывается после commit)"""
+    message = _row_to_device(device)
+    _forget(message)
+    try:
+        cache.get_redis().publish(DEVICES_CHANNEL, json.dumps(message))
+    except redis.RedisError as e:
+        logger.warning(f"Failed to publish device creation: {str(e)}")
+
+def _listen():
+    while True:
+        pubsub = cache.get_redis().pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(DEVICES_CHANNEL)
+            # Сообщения, пришедшие без подписки, потеряны
+            clear()
+            _subscribed.set()
+            for message in pubsub.listen():
+                _forget(json.loads(message["data"]))
+        except redis.RedisError as e:
+            logger.warning(f"Device registry subscription lost: {str(e)}")
+        finally:
+            _subscribed.clear()
+            pubsub.close()
+        time.sleep(RESUBSCRIBE_DELAY)
+
+def _ensure_listener():
+    """Подписка запускается в каждом процессе при первом обращении (в том числе после fork)"""
+    global _listener_pid
+    if _listener_pid == os.getpid():
+        return
+    with _lock:
+        if _listener_pid == os.getpid():
+            return
+        _listener_pid = os.getpid()
+        _entries.clear()
+        _subscribed.clear()
+    threading.Thread(target=_listen, name="device-registry", daemon=True).start()
+
+def clear():
+    with _lock:
+        _entries.clear()
@@ -0,0 +1,177 @@
+"""
+Сроки хранения строк и удаление устаревших результатов анализа.
+
+Политики (таблица retention_policies) задаются для таблицы и устройства, владельца или по умолчанию.
+Удаление идет по устройствам пакетами до RETENTION_BATCH_SIZE строк: строки пакета выбираются по индексу
+(device_id, время) с FOR UPDATE SKIP LOCKED, каждый пакет - отдельная короткая транзакция с lock_timeout,
+поэтому удаление не ждет блокировок и не держит их долго. Запуск ограничен RETENTION_MAX_SECONDS секундами,
+оставшиеся строки удаляются следующим запуском.
+
+Удаление из stats не затрагивает stat_rollups: агрегаты старых периодов остаются до срока политики stat_rollups.
+"""
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+from . import archive, metrics
+
+logger = logging.getLogger(__name__)
+
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "5000"))
+RETENTION_MAX_SECONDS = float(os.getenv("RETENTION_MAX_SECONDS", "240"))
+RETENTION_LOCK_TIMEOUT_MS = int(os.getenv("RETENTION_LOCK_TIMEOUT_MS", "1000"))
+# Пауза между пакетами, чтобы удаление не вытесняло запись и не перегружало WAL
+RETENTION_BATCH_PAUSE = float(os.getenv("RETENTION_BATCH_PAUSE", "0.05"))
+# Результаты анализа того же окна устройства, замененные более новыми, удаляются через столько часов
+ANALYSIS_SUPERSEDED_GRACE_HOURS = int(os.getenv("ANALYSIS_SUPERSEDED_GRACE_HOURS", "24"))
+# Завершенные задания анализа без результатов удаляются через столько дней
+ANALYSIS_JOB_KEEP_DAYS = int(os.getenv("ANALYSIS_JOB_KEEP_DAYS", "30"))
+
+# Таблица: (колонка времени, ключ строки)
+TABLES = {
+    "stats": ('"timestamp"', 'id, "timestamp"'),
+    "device_data": ('"timestamp"', 'id, "timestamp"'),
+    "analysis_results": ("created_at", "id"),
+    "stat_rollups": ("bucket_start", "device_id, bucket_start")
+}
+
+# Срок хранения для каждого устройства: политика устройства, затем владельца, затем по умолчанию
+DEVICE_POLICIES_SQL = """
+SELECT id, keep_days FROM (
+    SELECT devices.id, COALESCE(
+        (SELECT keep_days FROM retention_policies p
+         WHERE p.table_name = :table AND p.device_id = devices.id ORDER BY p.id DESC LIMIT 1),
+        (SELECT keep_days FROM retention_policies p
+         WHERE p.table_name = :table AND p.device_id IS NULL AND p.owner = devices.owner ORDER BY p.id DESC LIMIT 1),
+        (SELECT keep_days FROM retention_policies p
+         WHERE p.table_name = :table AND p.device_id IS NULL AND p.owner IS NULL ORDER BY p.id DESC LIMIT 1)
+    ) AS keep_days
+    FROM devices
+) AS policies
+WHERE keep_days IS NOT NULL
+ORDER BY id
+"""
+
+DELETE_BATCH_SQL = """
+DELETE FROM {table} WHERE ({key}) IN (
+    SELECT {key} FROM {table}
+    WHERE device_id = :device_id AND {time_column} < :cutoff
+    ORDER BY {time_column}
+    LIMIT :limit
+    FOR UPDATE SKIP LOCKED
+)
+"""
+
+# Результаты анализа устройства, для того же окна которых есть более новый результат
+# (результаты заданий пользователя и парка удаляются только по сроку хранения)
+SUPERSEDED_BATCH_SQL = """
+DELETE FROM analysis_results WHERE id IN (
+    SELECT older.id FROM analysis_results AS older
+    WHERE older.job_id IS NULL AND older.created_at < :grace AND EXISTS (
+        SELECT 1 FROM analysis_results AS newer
+        WHERE newer.device_id = older.device_id
+            AND newer.start_time = older.start_time
+            AND newer.end_time = older.end_time
+            AND newer.id > older.id
+    )
+    ORDER BY older.id
+    LIMIT :limit
+    FOR UPDATE SKIP LOCKED
+)
+"""
+
+ORPHAN_JOBS_BATCH_SQL = """
+DELETE FROM analysis_jobs WHERE id IN (
+    SELECT id FROM analysis_jobs AS job
+    WHERE job.finished_at < :cutoff
+        AND NOT EXISTS (SELECT 1 FROM analysis_results WHERE analysis_results.job_id = job.id)
+    ORDER BY id
+    LIMIT :limit
+    FOR UPDATE SKIP LOCKED
+)
+"""
+
+class Budget:
+    """Ограничение времени одного запуска"""
+    def __init__(self, seconds: float = None):
+        self.started = time.monotonic()
+        self.deadline = self.started + (RETENTION_MAX_SECONDS if seconds is None else seconds)
+
+    @property
+    def exhausted(self) -> bool:
+        return time.monotonic() >= self.deadline
+
+    @property
+    def elapsed(self) -> float:
+        return round(time.monotonic() - self.started, 3)
+
+def _delete_batches(db: Session, sql: str, params: dict, budget: Budget) -> int:
+    """Удаляет пакетами, пока пакет полный и не исчерпано время; ожидание блокировки пропускает остаток"""
+    deleted = 0
+    while not budget.exhausted:
+        try:
+            db.execute(text(f"SET LOCAL lock_timeout = {RETENTION_LOCK_TIMEOUT_MS}"))
+            count = db.execute(text(sql), dict(params, limit=RETENTION_BATCH_SIZE)).rowcount
+            db.commit()
+        except OperationalError as e:
+            db.rollback()
+            logger.warning(f"Retention batch skipped: {str(e)}")
+            break
+        deleted += count
+        if count < RETENTION_BATCH_SIZE:
+            break
+        time.sleep(RETENTION_BATCH_PAUSE)
+    return deleted
+
+def apply_table(db: Session, table: str, budget: Budget, now: datetime = None) -> dict:
+    """Удаляет строки таблицы старше срока хранения устройства"""
+    now = now or datetime.utcnow()
+    time_column, key = TABLES[table]
+    sql = DELETE_BATCH_SQL.format(table=table, key=key, time_column=time_column)
+    policies = db.execute(text(DEVICE_POLICIES_SQL), {"table": table}).fetchall()
+    db.rollback()
+    report = {"rows": 0, "devices": 0, "complete": True}
+    for device_id, keep_days in policies:
+        if budget.exhausted:
+            report["complete"] = False
+            break
+        cutoff = now - timedelta(days=keep_days)
+        deleted = _delete_batches(db, sql, {"device_id": device_id, "cutoff": cutoff}, budget)
+        if table == "stats" and archive.enabled():
+            deleted += archive.delete_segments(db, device_id, cutoff)
+        if deleted:
+            report["rows"] += deleted
+            report["devices"] += 1
+    metrics.RETENTION_ROWS.labels(table).inc(report["rows"])
+    return report
+
+def apply_policies(db: Session, now: datetime = None) -> dict:
+    """Применяет политики ко всем таблицам в пределах RETENTION_MAX_SECONDS"""
+    budget = Budget()
+    report = {}
+    for table in TABLES:
+        report[table] = apply_table(db, table, budget, now)
+    report["seconds"] = budget.elapsed
+    return report
+
+def prune_analysis(db: Session, now: datetime = None) -> dict:
+    """Удаляет замененные результаты анализа устройств и завершенные задания без результатов"""
+    now = now or datetime.utcnow()
+    budget = Budget()
+    superseded = _delete_batches(
+        db, SUPERSEDED_BATCH_SQL, {"grace": now - timedelta(hours=ANALYSIS_SUPERSEDED_GRACE_HOURS)}, budget
+    )
+    jobs = _delete_batches(
+        db, ORPHAN_JOBS_BATCH_SQL, {"cutoff": now - timedelta(days=ANALYSIS_JOB_KEEP_DAYS)}, budget
+    )
+    metrics.RETENTION_ROWS.labels("analysis_results").inc(superseded)
+    metrics.RETENTION_ROWS.labels("analysis_jobs").inc(jobs)
+    return {
+        "superseded_results": superseded,
+        "jobs": jobs,
+        "complete": not budget.exhausted,
+        "seconds": budget.elapsed
+    }
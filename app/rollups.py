@@ -0,0 +1,451 @@
+from datetime import datetime, timedelta
+from typing import Sequence
+import numpy as np
+from sqlalchemy import func, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+from .analitics import AXES, aggregate_stats
+from .models import Device, StatRollup
+from . import archive, sketch
+
+# Размер корзины агрегатов
+ROLLUP_BUCKET = timedelta(hours=1)
+
+def bucket_floor(value: datetime) -> datetime:
+    return value.replace(minute=0, second=0, microsecond=0)
+
+def bucket_ceil(value: datetime) -> datetime:
+    floor = bucket_floor(value)
+    return floor if floor == value else floor + ROLLUP_BUCKET
+
+def _edge_intervals(start_time: datetime, end_time: datetime, full_start: datetime, full_end: datetime):
+    """Крайние неполные корзины периода как полуинтервалы для archive.read_values (end_time включительно)"""
+    return [(start_time, full_start), (full_end, end_time + timedelta(microseconds=1))]
+
+def summarize(device_ids: Sequence[int], timestamps: Sequence[datetime], values) -> list:
+    """
+    Частичные агрегаты пакета записей по корзинам (device_id, час).
+    :param values: Массив N×3 со значениями x, y, z.
+    :return: Строки для stat_rollups, отсортированные по ключу.
+    """
+    device_ids = np.asarray(device_ids, dtype=np.int64)
+    hours = np.asarray(timestamps, dtype="datetime64[us]").astype("datetime64[h]")
+    values = np.asarray(values, dtype=np.float64).reshape(-1, len(AXES))
+
+    keys = np.stack([device_ids, hours.astype(np.int64)], axis=1)
+    unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+    order = np.argsort(inverse.ravel(), kind="stable")
+    values = values[order]
+    starts = np.searchsorted(inverse.ravel()[order], np.arange(len(unique_keys)))
+    ends = np.append(starts[1:], len(values))
+
+    sums = np.add.reduceat(values, starts, axis=0)
+    sumsqs = np.add.reduceat(values * values, starts, axis=0)
+    mins = np.minimum.reduceat(values, starts, axis=0)
+    maxs = np.maximum.reduceat(values, starts, axis=0)
+
+    rows = []
+    for i, (device_id, hour) in enumerate(unique_keys):
+        row = {
+            "device_id": int(device_id),
+            "bucket_start": np.datetime64(int(hour), "h").astype(datetime),
+            "count": int(ends[i] - starts[i])
+        }
+        for j, axis in enumerate(AXES):
+            row[f"sum_{axis}"] = float(sums[i, j])
+            row[f"sumsq_{axis}"] = float(sumsqs[i, j])
+            row[f"min_{axis}"] = float(mins[i, j])
+            row[f"max_{axis}"] = float(maxs[i, j])
+            row[f"sketch_{axis}"] = sketch.build(values[starts[i]:ends[i], j])
+        rows.append(row)
+    return rows
+
+def record(db: Session, device_ids: Sequence[int], timestamps: Sequence[datetime], values):
+    """
+    Добавляет пакет записей к агрегатам в текущей транзакции (commit делает вызывающий код).
+    Строки обновляются в порядке ключа, чтобы параллельные пакеты не блокировали друг друга крест-накрест.
+    """
+    if not len(device_ids):
+        return
+    statement = pg_insert(StatRollup)
+    excluded = statement.excluded
+    update = {"count": StatRollup.count + excluded.count}
+    for axis in AXES:
+        for name, merge in (
+            (f"sum_{axis}", lambda current, new: current + new),
+            (f"sumsq_{axis}", lambda current, new: current + new),
+            (f"min_{axis}", func.least),
+            (f"max_{axis}", func.greatest),
+            (f"sketch_{axis}", func.stat_sketch_merge)
+        ):
+            update[name] = merge(getattr(StatRollup, name), getattr(excluded, name))
+    statement = statement.on_conflict_do_update(
+        index_elements=[StatRollup.device_id, StatRollup.bucket_start],
+        set_=update
+    )
+    db.execute(statement, summarize(device_ids, timestamps, values))
+
+# Агрегаты окна: полные корзины из stat_rollups + неполные крайние корзины из stats
+WINDOW_AGGREGATE_SQL = "SELECT sum(n)" + "".join(
+    f", sum(s_{a}), sum(sq_{a}), min(mn_{a}), max(mx_{a})" for a in AXES
+) + " FROM (SELECT count AS n" + "".join(
+    f", sum_{a} AS s_{a}, sumsq_{a} AS sq_{a}, min_{a} AS mn_{a}, max_{a} AS mx_{a}" for a in AXES
+) + """
+    FROM stat_rollups
+    WHERE device_id = :device_id AND bucket_start >= :full_start AND bucket_start < :full_end
+    UNION ALL
+    SELECT count(*)""" + "".join(
+    f", sum({a}), sum({a} * {a}), min({a}), max({a})" for a in AXES
+) + """
+    FROM stats
+    WHERE device_id = :device_id AND (
+        ("timestamp" >= :start_time AND "timestamp" < :full_start)
+        OR ("timestamp" >= :full_end AND "timestamp" <= :end_time)
+    )
+) AS parts
+"""
+
+# Слитые скетчи окна: счетчики корзин из stat_rollups и ключи корзин крайних записей из stats
+WINDOW_SKETCH_SQL = "SELECT axis, key, sum(n) FROM (" + " UNION ALL ".join(
+    f"""
+    SELECT '{a}' AS axis, pairs.key::integer AS key, pairs.value::bigint AS n
+    FROM stat_rollups, jsonb_each_text(sketch_{a}) AS pairs
+    WHERE device_id = :device_id AND bucket_start >= :full_start AND bucket_start < :full_end
+    UNION ALL
+    SELECT '{a}', stat_sketch_key({a}), count(*)
+    FROM stats
+    WHERE device_id = :device_id AND {a} IS NOT NULL AND (
+        ("timestamp" >= :start_time AND "timestamp" < :full_start)
+        OR ("timestamp" >= :full_end AND "timestamp" <= :end_time)
+    )
+    GROUP BY 2"""
+    for a in AXES
+) + "\n) AS keys GROUP BY axis, key"
+
+def window_statistics(db: Session, device_id: int, start_time: datetime, end_time: datetime,
+                      with_median: bool = False):
+    """
+    Агрегаты за период в формате analitics.aggregate_stats.
+    Полные часовые корзины берутся из stat_rollups, из stats читаются только неполные крайние корзины.
+    Медиана в этом случае оценивается по слитому скетчу. Если полных корзин в периоде нет,
+    используется точный расчет по stats.
+    """
+    full_start = bucket_ceil(start_time)
+    full_end = bucket_floor(end_time)
+    if full_end <= full_start:
+        return aggregate_stats(db, device_id, start_time, end_time, with_median=with_median)
+
+    params = {
+        "device_id": device_id,
+        "start_time": start_time,
+        "end_time": end_time,
+        "full_start": full_start,
+        "full_end": full_end
+    }
+    row = db.execute(text(WINDOW_AGGREGATE_SQL), params).one()
+    archived = archive.read_values(
+        db, device_id, device_id, _edge_intervals(start_time, end_time, full_start, full_end)
+    ).get(device_id)
+    count = int(row[0] or 0)
+    result = {"count": count}
+    values = iter(row[1:])
+    for axis in AXES:
+        axis_sum, _, axis_min, axis_max = next(values), next(values), next(values), next(values)
+        result[axis] = {
+            "min": axis_min,
+            "max": axis_max,
+            "count": count,
+            "sum": axis_sum or 0,
+            "avg": axis_sum / count if count else None
+        }
+    # Записи крайних корзин, перенесенные в архив (полные корзины учтены в stat_rollups)
+    if archived is not None:
+        archive.merge_aggregates(result, archived)
+
+    if with_median:
+        sketches = {axis: {} for axis in AXES}
+        for axis, key, n in db.execute(text(WINDOW_SKETCH_SQL), params):
+            sketches[axis][str(key)] = int(n)
+        for i, axis in enumerate(AXES):
+            if archived is not None:
+                sketches[axis] = sketch.merge([sketches[axis], sketch.build(archived[:, i])])
+            result[axis]["median"] = sketch.quantile(sketches[axis], 0.5)
+    return result
+
+# Агрегаты и медианы для множества окон (устройство, период) одним запросом, по строке на каждое окно.
+# Окна - из массивов параметров или все устройства владельца за один период; строки parts - полные корзины
+# из stat_rollups (со скетчами) и записи крайних неполных корзин из stats (e_* - значения для точной медианы).
+WINDOWS_STATISTICS_SQL = """
+WITH windows AS (
+    SELECT * FROM unnest(
+        CAST(:keys AS varchar[]), CAST(:device_ids AS integer[]),
+        CAST(:start_times AS timestamp[]), CAST(:end_times AS timestamp[]),
+        CAST(:full_starts AS timestamp[]), CAST(:full_ends AS timestamp[])
+    ) AS w (key, device_id, start_time, end_time, full_start, full_end)
+    UNION ALL
+    SELECT CAST(id AS varchar), id,
+        CAST(:owner_start AS timestamp), CAST(:owner_end AS timestamp),
+        CAST(:owner_full_start AS timestamp), CAST(:owner_full_end AS timestamp)
+    FROM devices WHERE owner = CAST(:owner AS varchar)
+),
+parts AS (
+    SELECT w.key, r.count AS n""" + "".join(
+    f", r.sum_{a} AS s_{a}, r.min_{a} AS mn_{a}, r.max_{a} AS mx_{a}, CAST(NULL AS double precision) AS e_{a}"
+    f", r.sketch_{a} AS sk_{a}"
+    for a in AXES
+) + """
+    FROM windows AS w
+    JOIN stat_rollups AS r ON r.device_id = w.device_id
+        AND r.bucket_start >= w.full_start AND r.bucket_start < w.full_end
+    UNION ALL
+    SELECT w.key, 1""" + "".join(
+    f", s.{a}, s.{a}, s.{a}, s.{a}, CAST(NULL AS jsonb)" for a in AXES
+) + """
+    FROM windows AS w
+    JOIN stats AS s ON s.device_id = w.device_id AND (
+        (s."timestamp" >= w.start_time AND s."timestamp" < w.full_start)
+        OR (s."timestamp" >= w.full_end AND s."timestamp" <= w.end_time)
+    )
+),
+sketch_keys AS (
+    SELECT key, axis || ':' || sketch_key AS sketch_key, sum(n) AS n FROM (""" + "\n        UNION ALL".join(
+    f"""
+        SELECT parts.key, '{a}' AS axis, CAST(pairs.key AS integer) AS sketch_key, CAST(pairs.value AS bigint) AS n
+        FROM parts, jsonb_each_text(parts.sk_{a}) AS pairs
+        UNION ALL
+        SELECT key, '{a}', stat_sketch_key(e_{a}), 1 FROM parts WHERE e_{a} IS NOT NULL"""
+    for a in AXES
+) + """
+    ) AS keys
+    GROUP BY 1, 2
+)
+SELECT windows.key, windows.device_id, windows.start_time, windows.end_time, totals.n""" + "".join(
+    f", totals.s_{a}, totals.mn_{a}, totals.mx_{a}, totals.md_{a}" for a in AXES
+) + """, sketches.sketch
+FROM windows
+LEFT JOIN (
+    SELECT key, sum(n) AS n""" + "".join(
+    f", sum(s_{a}) AS s_{a}, min(mn_{a}) AS mn_{a}, max(mx_{a}) AS mx_{a}"
+    f", percentile_cont(0.5) WITHIN GROUP (ORDER BY e_{a}) AS md_{a}"
+    for a in AXES
+) + """
+    FROM parts
+    GROUP BY key
+) AS totals ON totals.key = windows.key
+LEFT JOIN (
+    SELECT key, jsonb_object_agg(sketch_key, n) AS sketch FROM sketch_keys GROUP BY key
+) AS sketches ON sketches.key = windows.key
+ORDER BY windows.device_id
+"""
+
+def _full_buckets(start_time: datetime, end_time: datetime):
+    """Границы полных корзин периода; без полных корзин весь период читается из stats как крайняя часть"""
+    full_start = bucket_ceil(start_time)
+    full_end = bucket_floor(end_time)
+    if full_end <= full_start:
+        return end_time, end_time
+    return full_start, full_end
+
+def windows_statistics(db: Session, windows: Sequence[tuple] = (), owner: str = None,
+                       start_time: datetime = None, end_time: datetime = None) -> dict:
+    """
+    Агрегаты в формате window_statistics (с медианой) для списка окон (ключ, device_id, начало, конец)
+    или для всех устройств владельца owner за период [start_time, end_time] одним запросом.
+    Медиана точная для окон без полных часовых корзин и оценивается по скетчу для остальных.
+    :return: Словарь {ключ окна (для владельца - id устройства строкой): агрегаты с device_id, start_time, end_time}.
+    """
+    params = {name: [] for name in ("keys", "device_ids", "start_times", "end_times", "full_starts", "full_ends")}
+    exact = {}
+    for key, device_id, window_start, window_end in windows:
+        full_start, full_end = _full_buckets(window_start, window_end)
+        for name, value in zip(params, (key, device_id, window_start, window_end, full_start, full_end)):
+            params[name].append(value)
+        exact[key] = full_start == full_end
+    owner_exact = None
+    params.update(owner=owner, owner_start=start_time, owner_end=end_time, owner_full_start=None, owner_full_end=None)
+    if owner is not None:
+        params["owner_full_start"], params["owner_full_end"] = _full_buckets(start_time, end_time)
+        owner_exact = params["owner_full_start"] == params["owner_full_end"]
+
+    results = {}
+    sketches_by_key = {}
+    for row in db.execute(text(WINDOWS_STATISTICS_SQL), params):
+        count = int(row.n or 0)
+        window_exact = exact.get(row.key, owner_exact)
+        sketches = sketches_by_key[row.key] = {axis: {} for axis in AXES}
+        for sketch_key, n in (row.sketch or {}).items():
+            axis, _, bucket = sketch_key.partition(":")
+            sketches[axis][bucket] = n
+        result = {"device_id": row.device_id, "start_time": row.start_time, "end_time": row.end_time, "count": count}
+        for axis in AXES:
+            axis_sum = getattr(row, f"s_{axis}")
+            result[axis] = {
+                "min": getattr(row, f"mn_{axis}"),
+                "max": getattr(row, f"mx_{axis}"),
+                "count": count,
+                "sum": axis_sum or 0,
+                "avg": axis_sum / count if count and axis_sum is not None else None,
+                "median": getattr(row, f"md_{axis}") if window_exact else sketch.quantile(sketches[axis], 0.5)
+            }
+        results[row.key] = result
+
+    # Записи крайних корзин, перенесенные в архив: для окон с точной медианой - точный расчет по окну
+    if not archive.enabled():
+        return results
+    windows = list(windows) + [
+        (str(device_id), device_id, start_time, end_time) for device_id in _owner_device_ids(db, owner)
+    ]
+    archived = archive.read_windows(db, [
+        (key, device_id, _edge_intervals(window_start, window_end, *_full_buckets(window_start, window_end)))
+        for key, device_id, window_start, window_end in windows
+    ])
+    for key, device_id, window_start, window_end in windows:
+        values = archived.get(key)
+        if values is None:
+            continue
+        if exact.get(key, owner_exact):
+            results[key].update(aggregate_stats(db, device_id, window_start, window_end, with_median=True))
+            continue
+        result = archive.merge_aggregates(results[key], values)
+        # Медиана по скетчу без архивных значений пересчитывается с ними
+        for i, axis in enumerate(AXES):
+            result[axis]["median"] = sketch.quantile(sketch.merge([
+                sketches_by_key.get(key, {}).get(axis, {}), sketch.build(values[:, i])
+            ]), 0.5)
+    return results
+
+def _owner_device_ids(db: Session, owner: str = None):
+    if owner is None:
+        return []
+    return [row.id for row in db.query(Device.id).filter(Device.owner == owner)]
+
+# Количество записей и суммы по каждому устройству диапазона id одним сгруппированным запросом:
+# полные корзины из stat_rollups, крайние неполные корзины из stats
+DEVICES_WINDOW_TOTALS_SQL = """
+WITH chunk AS (
+    SELECT id, device_id FROM devices
+    WHERE id BETWEEN :first_id AND :last_id AND (CAST(:owner AS varchar) IS NULL OR owner = :owner)
+)
+SELECT chunk.id, chunk.device_id, COALESCE(sum(parts.n), 0)""" + "".join(f", sum(parts.s_{a})" for a in AXES) + """
+FROM chunk
+LEFT JOIN (
+    SELECT device_id, count AS n""" + "".join(f", sum_{a} AS s_{a}" for a in AXES) + """
+    FROM stat_rollups
+    WHERE device_id IN (SELECT id FROM chunk)
+        AND bucket_start >= :full_start AND bucket_start < :full_end
+    UNION ALL
+    SELECT device_id, count(*)""" + "".join(f", sum({a})" for a in AXES) + """
+    FROM stats
+    WHERE device_id IN (SELECT id FROM chunk) AND (
+        ("timestamp" >= :start_time AND "timestamp" < :full_start)
+        OR ("timestamp" >= :full_end AND "timestamp" <= :end_time)
+    )
+    GROUP BY device_id
+) AS parts ON parts.device_id = chunk.id
+GROUP BY chunk.id, chunk.device_id
+ORDER BY chunk.id
+"""
+
+def devices_window_totals(db: Session, first_id: int, last_id: int, start_time: datetime, end_time: datetime,
+                          owner: str = None):
+    """
+    Количество записей и суммы по x, y, z за период для всех устройств с id в [first_id, last_id]
+    (и владельцем owner, если он задан) одним запросом.
+    :return: Список кортежей (id, device_id, count, sum_x, sum_y, sum_z).
+    """
+    full_start = bucket_ceil(start_time)
+    full_end = bucket_floor(end_time)
+    if full_end <= full_start:
+        # Полных корзин нет: весь период читается из stats как одна крайняя часть
+        full_start = full_end = end_time
+    totals = db.execute(text(DEVICES_WINDOW_TOTALS_SQL), {
+        "first_id": first_id,
+        "last_id": last_id,
+        "owner": owner,
+        "start_time": start_time,
+        "end_time": end_time,
+        "full_start": full_start,
+        "full_end": full_end
+    }).fetchall()
+    archived = archive.read_values(db, first_id, last_id, _edge_intervals(start_time, end_time, full_start, full_end))
+    if not archived:
+        return totals
+    merged = []
+    for device_pk, device_id, count, *sums in totals:
+        values = archived.get(device_pk)
+        if values is not None:
+            count += len(values)
+            sums = [(axis_sum or 0) + float(np.nansum(values[:, i])) for i, axis_sum in enumerate(sums)]
+        merged.append((device_pk, device_id, count, *sums))
+    return merged
+
+# Месяцы, перенесенные в архив, не пересчитываются: их записей уже нет в stats
+NOT_ARCHIVED = """NOT EXISTS (
+            SELECT 1 FROM stat_segments
+            WHERE stat_segments.device_id = stats.device_id
+                AND stat_segments.period_start = date_trunc('month', stats."timestamp")
+        )"""
+
+# Полный пересчет агрегатов устройства по stats (для данных, записанных до появления агрегатов)
+REBUILD_SQL = """
+INSERT INTO stat_rollups (device_id, bucket_start, count""" + "".join(
+    f", sum_{a}, sumsq_{a}, min_{a}, max_{a}, sketch_{a}" for a in AXES
+) + """)
+SELECT totals.device_id, totals.bucket_start, totals.n""" + "".join(
+    f", totals.s_{a}, totals.sq_{a}, totals.mn_{a}, totals.mx_{a}, COALESCE(sketch_{a}.sketch, '{{}}'::jsonb)"
+    for a in AXES
+) + """
+FROM (
+    SELECT device_id, date_trunc('hour', "timestamp") AS bucket_start, count(*) AS n""" + "".join(
+    f", sum({a}) AS s_{a}, sum({a} * {a}) AS sq_{a}, min({a}) AS mn_{a}, max({a}) AS mx_{a}" for a in AXES
+) + """
+    FROM stats
+    WHERE device_id = :device_id AND "timestamp" < :before AND """ + NOT_ARCHIVED + """
+    GROUP BY 1, 2
+) AS totals""" + "".join(
+    f"""
+LEFT JOIN (
+    SELECT bucket_start, jsonb_object_agg(key, n) AS sketch
+    FROM (
+        SELECT date_trunc('hour', "timestamp") AS bucket_start, stat_sketch_key({a}) AS key, count(*) AS n
+        FROM stats
+        WHERE device_id = :device_id AND "timestamp" < :before AND {a} IS NOT NULL AND {NOT_ARCHIVED}
+        GROUP BY 1, 2
+    ) AS keys
+    GROUP BY bucket_start
+) AS sketch_{a} ON sketch_{a}.bucket_start = totals.bucket_start"""
+    for a in AXES
+) + """
+ON CONFLICT (device_id, bucket_start) DO UPDATE SET count = EXCLUDED.count""" + "".join(
+    f", sum_{a} = EXCLUDED.sum_{a}, sumsq_{a} = EXCLUDED.sumsq_{a}, min_{a} = EXCLUDED.min_{a}"
+    f", max_{a} = EXCLUDED.max_{a}, sketch_{a} = EXCLUDED.sketch_{a}"
+    for a in AXES
+)
+
+def rebuild(db: Session, device_id: int, before: datetime = None):
+    """
+    Пересчитывает агрегаты устройства по stats для корзин раньше before (по умолчанию - текущего часа).
+    Текущий час не пересчитывается, чтобы не затереть приращения от параллельной записи.
+    :return: Количество пересчитанных корзин.
+    """
+    before = before or bucket_floor(datetime.utcnow())
+    result = db.execute(text(REBUILD_SQL), {"device_id": device_id, "before": before})
+    db.commit()
+    return result.rowcount
+
+def rebuild_all(connection) -> int:
+    """
+    Заполняет агрегаты всех устройств по всей stats, включая текущий час (commit делает вызывающий код).
+    Вызывается из init_db в транзакции, создающей stat_rollups: до commit запись не видит таблицу,
+    поэтому приращения не затираются и не учитываются дважды.
+    :return: Количество пересчитанных корзин.
+    """
+    buckets = 0
+    for (device_id,) in connection.execute(text("SELECT id FROM devices")).fetchall():
+        buckets += connection.execute(text(REBUILD_SQL), {"device_id": device_id, "before": datetime.max}).rowcount
+    return buckets
+
+def create_functions(connection):
+    """SQL-функции скетча, нужные для обновления и чтения агрегатов"""
+    connection.execute(text(sketch.SQL_KEY_FUNCTION))
+    connection.execute(text(sketch.SQL_MERGE_FUNCTION))
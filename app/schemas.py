@@ -1,6 +1,7 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, validator
 from typing import Optional, Dict, Any
 from datetime import datetime
+import math
 
 class DeviceCreate(BaseModel):
     device_id: str
@@ -19,6 +20,23 @@ class StatCreate(BaseModel):
     y: float
     z: float
 
+    # NaN и бесконечности портят суммы в stat_rollups и квантильные скетчи, такие записи отклоняются (422)
+    @validator("x", "y", "z")
+    def finite(cls, value):
+        if not math.isfinite(value):
+            raise ValueError("value must be a finite number")
+        return value
+
+class StatBatchItem(StatCreate):
+    timestamp: Optional[datetime] = None
+
+class DeviceStatBatchItem(StatBatchItem):
+    device_id: int
+
+class StatBatchResponse(BaseModel):
+    inserted: int
+    devices: int
+
 class StatResponse(BaseModel):
     id: int
     device_id: int
@@ -48,4 +66,31 @@ class UserAnalysis(BaseModel):
 
 class AnalysisRequest(BaseModel):
     start_time: datetime
-    end_time: datetime
\ No newline at end of file
+    end_time: datetime
+
+class RetentionPolicyCreate(BaseModel):
+    table_name: str
+    owner: Optional[str] = None
+    device_id: Optional[int] = None
+    keep_days: int
+
+class RetentionPolicy(RetentionPolicyCreate):
+    id: int
+    created_at: datetime
+
+    class Config:
+        orm_mode = True
+
+class AnalyticsWindow(BaseModel):
+    device_id: int
+    start_time: datetime
+    end_time: datetime
+    # Ключ окна в ответе, по умолчанию - порядковый номер окна в запросе
+    key: Optional[str] = None
+
+class AnalyticsBatchRequest(BaseModel):
+    """Список окон или все устройства владельца за один период"""
+    windows: Optional[list[AnalyticsWindow]] = None
+    owner: Optional[str] = None
+    start_time: Optional[datetime] = None
+    end_time: Optional[datetime] = None
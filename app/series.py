@@ -0,0 +1,163 @@
+from datetime import datetime, timedelta
+from typing import Sequence
+import numpy as np
+from sqlalchemy import func, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+from fastapi import HTTPException
+from .analitics import AXES
+from .models import StatSeries, SeriesDirtyBucket
+
+# Разрешения прореженных рядов: от мелкого к крупному, поле для date_trunc и шаг
+RESOLUTIONS = {
+    "1m": ("minute", timedelta(minutes=1)),
+    "1h": ("hour", timedelta(hours=1)),
+    "1d": ("day", timedelta(days=1))
+}
+
+# Максимальное количество точек в одном ответе
+MAX_SERIES_POINTS = 20000
+
+_UPSERT_COLUMNS = "device_id, resolution, bucket_start, count" + "".join(
+    f", sum_{a}, min_{a}, max_{a}" for a in AXES
+)
+_ON_CONFLICT = "ON CONFLICT (device_id, resolution, bucket_start) DO UPDATE SET count = EXCLUDED.count" + "".join(
+    f", sum_{a} = EXCLUDED.sum_{a}, min_{a} = EXCLUDED.min_{a}, max_{a} = EXCLUDED.max_{a}" for a in AXES
+)
+
+# Минутные корзины, отмеченные зафиксированными транзакциями записи
+AFFECTED_SQL = """
+CREATE TEMP TABLE series_affected ON COMMIT DROP AS
+SELECT device_id, bucket_start, version FROM stat_series_dirty
+"""
+
+# Снятие отметок с пересчитанных корзин. Корзина, в которую успели записать после чтения отметок
+# (version изменилась), остается до следующего запуска. Блокировки берутся в порядке ключа, как в record.
+CLEAR_AFFECTED_SQL = """
+DELETE FROM stat_series_dirty WHERE (device_id, bucket_start) IN (
+    SELECT d.device_id, d.bucket_start
+    FROM stat_series_dirty AS d
+    JOIN series_affected AS a ON a.device_id = d.device_id
+        AND a.bucket_start = d.bucket_start AND a.version = d.version
+    ORDER BY d.device_id, d.bucket_start
+    FOR UPDATE OF d
+)
+"""
+
+# Полный пересчет затронутых минутных корзин по stats
+MINUTE_SQL = f"""
+INSERT INTO stat_series ({_UPSERT_COLUMNS})
+SELECT s.device_id, '1m', a.bucket_start, count(*)""" + "".join(
+    f", sum(s.{a}), min(s.{a}), max(s.{a})" for a in AXES
+) + f"""
+FROM series_affected AS a
+JOIN stats AS s ON s.device_id = a.device_id
+    AND s."timestamp" >= a.bucket_start AND s."timestamp" < a.bucket_start + interval '1 minute'
+GROUP BY s.device_id, a.bucket_start
+{_ON_CONFLICT}
+"""
+
+# Пересчет корзин крупного разрешения по корзинам предыдущего разрешения
+ROLLUP_LEVEL_SQL = f"""
+INSERT INTO stat_series ({_UPSERT_COLUMNS})
+SELECT f.device_id, :resolution, a.bucket_start, sum(f.count)""" + "".join(
+    f", sum(f.sum_{a}), min(f.min_{a}), max(f.max_{a})" for a in AXES
+) + f"""
+FROM (
+    SELECT DISTINCT device_id, date_trunc(:field, bucket_start) AS bucket_start FROM series_affected
+) AS a
+JOIN stat_series AS f ON f.device_id = a.device_id AND f.resolution = :finer
+    AND f.bucket_start >= a.bucket_start AND f.bucket_start < a.bucket_start + :step
+GROUP BY f.device_id, a.bucket_start
+{_ON_CONFLICT}
+"""
+
+def record(db: Session, device_ids: Sequence[int], timestamps: Sequence[datetime]):
+    """
+    Отмечает минутные корзины пакета записей для refresh в текущей транзакции (commit делает вызывающий код).
+    Отметка видна refresh только вместе с самими записями, поэтому поздно зафиксированные транзакции
+    не пропускаются, в отличие от отбора по id. Корзины обновляются в порядке ключа.
+    """
+    if not len(device_ids):
+        return
+    minutes = np.asarray(timestamps, dtype="datetime64[us]").astype("datetime64[m]")
+    keys = np.unique(np.stack([np.asarray(device_ids, dtype=np.int64), minutes.astype(np.int64)], axis=1), axis=0)
+    statement = pg_insert(SeriesDirtyBucket)
+    statement = statement.on_conflict_do_update(
+        index_elements=[SeriesDirtyBucket.device_id, SeriesDirtyBucket.bucket_start],
+        set_={"version": SeriesDirtyBucket.version + 1}
+    )
+    db.execute(statement, [
+        {"device_id": int(device_id), "bucket_start": np.datetime64(int(minute), "m").astype(datetime), "version": 0}
+        for device_id, minute in keys
+    ])
+
+def refresh(db: Session):
+    """
+    Пересчитывает корзины 1m/1h/1d, отмеченные записью (record) после прошлого запуска.
+    :return: Количество затронутых минутных корзин.
+    """
+    db.execute(text(AFFECTED_SQL))
+    affected = db.execute(text("SELECT count(*) FROM series_affected")).scalar()
+    if affected:
+        db.execute(text(MINUTE_SQL))
+        finer = "1m"
+        for resolution in ("1h", "1d"):
+            field, step = RESOLUTIONS[resolution]
+            db.execute(text(ROLLUP_LEVEL_SQL), {
+                "resolution": resolution, "field": field, "step": step, "finer": finer
+            })
+            finer = resolution
+        db.execute(text(CLEAR_AFFECTED_SQL))
+    db.commit()
+    return affected
+
+def choose_resolution(start_time: datetime, end_time: datetime, points: int) -> str:
+    """Самое крупное разрешение, которое дает не меньше points точек за период, иначе самое мелкое"""
+    span = end_time - start_time
+    for resolution in ("1d", "1h", "1m"):
+        if span / RESOLUTIONS[resolution][1] >= points:
+            return resolution
+    return "1m"
+
+def get_series(db: Session, device_id: int, start_time: datetime, end_time: datetime,
+               bucket: str = "auto", points: int = 500):
+    """
+    Прореженный ряд min/avg/max по x, y, z за период.
+    :param bucket: Разрешение 1m/1h/1d или auto.
+    :param points: Желаемое количество точек для auto.
+    """
+    resolution = choose_resolution(start_time, end_time, points) if bucket == "auto" else bucket
+    field, step = RESOLUTIONS[resolution]
+    if (end_time - start_time) / step > MAX_SERIES_POINTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Period contains more than {MAX_SERIES_POINTS} {resolution} buckets, use a coarser bucket"
+        )
+
+    rows = db.query(StatSeries).filter(
+        StatSeries.device_id == device_id,
+        StatSeries.resolution == resolution,
+        StatSeries.bucket_start >= func.date_trunc(field, start_time),
+        StatSeries.bucket_start <= end_time
+    ).order_by(StatSeries.bucket_start).all()
+
+    return {
+        "device_id": device_id,
+        "bucket": resolution,
+        "points": [
+            dict(
+                timestamp=row.bucket_start,
+                count=row.count,
+                **{
+                    axis: {
+                        "min": getattr(row, f"min_{axis}"),
+                        "avg": getattr(row, f"sum_{axis}") / row.count if row.count else None,
+                        "max": getattr(row, f"max_{axis}")
+                    }
+                    for axis in AXES
+                }
+            )
+            for row in rows
+        ]
+    }
@@ -0,0 +1,92 @@
+"""
+Сливаемый скетч квантилей (логарифмические корзины, как в DDSketch).
+
+Скетч - разреженный словарь {ключ корзины: количество}, ключи - строки целых чисел,
+поэтому он хранится в JSONB и сливается простым суммированием счетчиков, в том числе в SQL.
+Ключи упорядочены так же, как значения: отрицательные, ноль, положительные.
+Относительная погрешность квантиля не превышает RELATIVE_ACCURACY.
+"""
+import math
+from typing import Dict, Iterable
+import numpy as np
+
+RELATIVE_ACCURACY = 0.02
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+# Значения по модулю меньше MIN_VALUE попадают в нулевую корзину
+MIN_VALUE = 1e-9
+# Сдвиг индексов, чтобы ключи положительных значений были >= 1
+KEY_OFFSET = 1 - math.ceil(math.log(MIN_VALUE) / LOG_GAMMA)
+
+# SQL-версия sketch_keys, используется при пересчете скетчей в БД
+SQL_KEY_FUNCTION = f"""
+CREATE OR REPLACE FUNCTION stat_sketch_key(value double precision) RETURNS integer AS $$
+    SELECT CASE
+        WHEN value IS NULL THEN NULL
+        WHEN abs(value) < {MIN_VALUE!r} THEN 0
+        ELSE (sign(value) * (ceil(ln(abs(value)) / {LOG_GAMMA!r}) + {KEY_OFFSET}))::integer
+    END
+$$ LANGUAGE sql IMMUTABLE
+"""
+
+# Слияние двух скетчей в SQL (используется при обновлении агрегатов на записи)
+SQL_MERGE_FUNCTION = """
+CREATE OR REPLACE FUNCTION stat_sketch_merge(a jsonb, b jsonb) RETURNS jsonb AS $$
+    SELECT COALESCE(jsonb_object_agg(key, total), '{}'::jsonb)
+    FROM (
+        SELECT key, SUM(value::bigint) AS total
+        FROM (
+            SELECT * FROM jsonb_each_text(COALESCE(a, '{}'::jsonb))
+            UNION ALL
+            SELECT * FROM jsonb_each_text(COALESCE(b, '{}'::jsonb))
+        ) AS pairs
+        GROUP BY key
+    ) AS merged
+$$ LANGUAGE sql IMMUTABLE
+"""
+
+def sketch_keys(values) -> np.ndarray:
+    """Ключи корзин для массива значений"""
+    values = np.asarray(values, dtype=np.float64)
+    magnitude = np.abs(values)
+    keys = np.zeros(values.shape, dtype=np.int64)
+    nonzero = magnitude >= MIN_VALUE
+    keys[nonzero] = (
+        (np.ceil(np.log(magnitude[nonzero]) / LOG_GAMMA) + KEY_OFFSET) * np.sign(values[nonzero])
+    ).astype(np.int64)
+    return keys
+
+def build(values) -> Dict[str, int]:
+    """Скетч для массива значений (NaN пропускаются)"""
+    values = np.asarray(values, dtype=np.float64)
+    keys, counts = np.unique(sketch_keys(values[~np.isnan(values)]), return_counts=True)
+    return {str(key): int(count) for key, count in zip(keys, counts)}
+
+def merge(sketches: Iterable[Dict[str, int]]) -> Dict[str, int]:
+    merged = {}
+    for sketch in sketches:
+        for key, count in (sketch or {}).items():
+            merged[key] = merged.get(key, 0) + int(count)
+    return merged
+
+def _key_value(key: int) -> float:
+    """Представитель корзины: середина в смысле относительной погрешности"""
+    if key == 0:
+        return 0.0
+    index = abs(key) - KEY_OFFSET
+    value = 2 * GAMMA ** index / (GAMMA + 1)
+    return value if key > 0 else -value
+
+def quantile(sketch: Dict[str, int], q: float):
+    """Оценка квантиля q (0-1) по скетчу, None для пустого скетча"""
+    items = sorted((int(key), int(count)) for key, count in (sketch or {}).items() if int(count) > 0)
+    total = sum(count for _, count in items)
+    if not total:
+        return None
+    rank = q * (total - 1)
+    seen = 0
+    for key, count in items:
+        seen += count
+        if seen > rank:
+            return _key_value(key)
+    return _key_value(items[-1][0])
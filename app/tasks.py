@@ -1,180 +1,510 @@
-from celery import Celery
+from celery import Celery, group, chord
+from celery.signals import before_task_publish, task_prerun, task_postrun, worker_process_init, worker_ready
+from celery.exceptions import Ignore
+from celery.schedules import crontab
+from kombu import Exchange, Queue
 from sqlalchemy.orm import Session
-from sqlalchemy import create_engine
-from .database import SQLALCHEMY_DATABASE_URL
-from .models import Device, Stat, AnalysisResult, DeviceData
-from datetime import datetime
+from sqlalchemy import func, insert, update
+from .config import settings
+from .database import engine, read_engine, reset_after_fork, to_epoch
+from .models import Device, AnalysisResult, AnalysisJob, DeviceData
+from .rollups import window_statistics, devices_window_totals, rebuild
+from . import series, cache, metrics, archive, retention
+import redis
+from .partitions import ensure_partitions, detach_old_partitions
+from datetime import datetime, timezone
+from dateutil.parser import isoparse
+from contextlib import contextmanager
 import logging
+import os
+import time
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Создание экземпляра Celery
-celery_app = Celery('tasks', broker='redis://redis:6379/0', backend='redis://redis:6379/0')
+celery_app = Celery(
+    'tasks',
+    broker=settings.celery_broker_url or settings.redis_url,
+    backend=settings.celery_result_backend or settings.redis_url
+)
 
-# Создание движка SQLAlchemy
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+# Очереди по классам работы: у каждой свои воркеры, поэтому анализ парка не задерживает интерактивные запросы
+INTERACTIVE_QUEUE = "interactive"
+OWNER_QUEUE = "owner"
+FLEET_QUEUE = "fleet"
+MAINTENANCE_QUEUE = "maintenance"
+QUEUES = (INTERACTIVE_QUEUE, OWNER_QUEUE, FLEET_QUEUE, MAINTENANCE_QUEUE)
+
+@worker_process_init.connect
+def _reset_engine_after_fork(**kwargs):
+    """Каждый дочерний процесс воркера открывает собственные соединения"""
+    reset_after_fork()
+
+# Порт, на котором главный процесс воркера отдает метрики дочерних процессов (0 - не отдавать)
+CELERY_METRICS_PORT = int(os.getenv("CELERY_METRICS_PORT", "0"))
+
+@worker_ready.connect
+def _start_metrics_server(**kwargs):
+    if CELERY_METRICS_PORT and metrics.multiprocess_enabled():
+        from prometheus_client import start_http_server
+        start_http_server(CELERY_METRICS_PORT, registry=metrics.multiprocess_registry())
+
+@before_task_publish.connect
+def _stamp_published_at(headers=None, **kwargs):
+    # Время отправки для метрики ожидания в очереди
+    headers["published_at"] = time.time()
+
+# Время начала выполняющихся задач процесса по task_id
+_task_started = {}
+
+@task_prerun.connect
+def _task_prerun(task_id=None, task=None, **kwargs):
+    published_at = getattr(task.request, "published_at", None)
+    if published_at:
+        metrics.CELERY_QUEUE_WAIT.labels(task.name).observe(max(time.time() - published_at, 0))
+    _task_started[task_id] = time.perf_counter()
+
+@task_postrun.connect
+def _task_postrun(task_id=None, task=None, state=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None:
+        metrics.CELERY_RUN_SECONDS.labels(task.name, state or "UNKNOWN").observe(time.perf_counter() - started)
+
+# Количество устройств в одном запросе при анализе всех устройств пользователя или парка
+DEVICE_CHUNK_SIZE = int(os.getenv("ANALYSIS_DEVICE_CHUNK_SIZE", "500"))
+
+# Обслуживание месячных секций stats/device_data (если таблицы секционированы)
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+# Секции старше указанного количества месяцев отсоединяются, 0 - хранить все
+PARTITION_RETENTION_MONTHS = int(os.getenv("PARTITION_RETENTION_MONTHS", "0"))
+
+def _parse_time(value):
+    """
+    Celery сериализует datetime в ISO-строку (UTC - с суффиксом Z, который не разбирает datetime.fromisoformat),
+    приводим аргументы обратно к datetime в UTC без часового пояса, как время в БД
+    """
+    if isinstance(value, str):
+        value = isoparse(value)
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+@contextmanager
+def _read_session(db: Session, request, end_time: datetime):
+    """
+    Сессия для чтения окна: реплика, если она применила все записи до конца окна или до отправки задачи
+    (записи после отправки анализ видеть не обязан), иначе сама db.
+    """
+    # Сравнение в секундах Unix: окно может прийти с часовым поясом, published_at - всегда секунды
+    after = to_epoch(end_time)
+    published_at = getattr(request, "published_at", None)
+    if published_at:
+        after = min(after, published_at)
+    bind = read_engine(after)
+    if bind is engine:
+        yield db
+        return
+    with Session(bind) as read_db:
+        yield read_db
+
+def _analyze_window(db: Session, read_db: Session, task_id: str, device_id: int, start_time: datetime,
+                    end_time: datetime):
+    """Считает средние значения за период одним агрегирующим запросом (read_db) и сохраняет результат (db)"""
+    aggregates = window_statistics(read_db, device_id, start_time, end_time)
+    total_records = aggregates["count"]
+    metrics.ANALYSIS_RECORDS.labels("device").observe(total_records)
+    if not total_records:
+        return None
+
+    avg_x = aggregates["x"]["avg"]
+    avg_y = aggregates["y"]["avg"]
+    avg_z = aggregates["z"]["avg"]
+
+    # Сохраняем результат анализа в базу данных
+    db.add(AnalysisResult(
+        task_id=task_id,
+        device_id=device_id,
+        start_time=start_time,
+        end_time=end_time,
+        avg_x=avg_x,
+        avg_y=avg_y,
+        avg_z=avg_z,
+        total_records=total_records
+    ))
+    db.commit()
+
+    return {
+        "device_id": device_id,
+        "start_time": start_time.isoformat(),
+        "end_time": end_time.isoformat(),
+        "avg_x": avg_x,
+        "avg_y": avg_y,
+        "avg_z": avg_z,
+        "total_records": total_records
+    }
 
 @celery_app.task
-def analyze_device_stats(device_id: int, start_time: datetime, end_time: datetime):
-    """Анализ статистики устройства"""
+def analyze_device_stats(device_id: int, start_time: datetime, end_time: datetime, cache_key: str = None):
+    """
+    Анализ статистики устройства.
+    :param cache_key: Ключ записи кеша, занятой start_device_analysis; освобождается при любой ошибке,
+        в том числе при разборе аргументов.
+    """
     logger.info(f"Starting analysis for device {device_id}")
     
+    task_id = analyze_device_stats.request.id
+    key = cache_key
     try:
-        with Session(engine) as db:
-            # Получаем статистику устройства из таблицы stats
-            stats = db.query(Stat).filter(
-                Stat.device_id == device_id,
-                #Stat.timestamp >= start_time,
-                #Stat.timestamp <= end_time
-            ).all()
-            logger.info(f"Статистика собирается для {device_id}")
-            
-            if not stats:
+        start_time, end_time = _parse_time(start_time), _parse_time(end_time)
+        key = key or cache.analysis_key(device_id, start_time, end_time)
+        with Session(engine) as db, _read_session(db, analyze_device_stats.request, end_time) as read_db:
+            result = _analyze_window(db, read_db, task_id, device_id, start_time, end_time)
+            if result is None:
                 logger.warning(f"No stats found for device {device_id}")
-                return None
-                
-            # Рассчитываем средние значения
-            x_values = [stat.x for stat in stats]
-            y_values = [stat.y for stat in stats]
-            z_values = [stat.z for stat in stats]
-            
-            avg_x = sum(x_values) / len(x_values)
-            avg_y = sum(y_values) / len(y_values)
-            avg_z = sum(z_values) / len(z_values)
-            
-            # Создаем результат анализа
-            result = AnalysisResult(
-                task_id=analyze_device_stats.request.id,
-                device_id=device_id,
-                start_time=start_time,
-                end_time=end_time,
-                avg_x=avg_x,
-                avg_y=avg_y,
-                avg_z=avg_z,
-                total_records=len(stats)
-            )
-            
-            # Сохраняем результат в базу данных
-            db.add(result)
-            db.commit()
-            
-            return {
-                "device_id": device_id,
-                "start_time": start_time.isoformat(),
-                "end_time": end_time.isoformat(),
-                "avg_x": avg_x,
-                "avg_y": avg_y,
-                "avg_z": avg_z,
-                "total_records": len(stats)
-            }
-            
     except Exception as e:
         logger.error(f"Error analyzing device stats: {str(e)}")
+        try:
+            if key is not None:
+                cache.release(key, task_id)
+            cache.publish_done(task_id, "failure", str(e))
+        except redis.RedisError:
+            pass
         raise
 
-@celery_app.task
-def analyze_user_devices(owner: str, start_time: datetime, end_time: datetime):
+    try:
+        cache.store_result(key, task_id, result)
+        # Результат уже в БД - будим клиентов, ожидающих через ?wait= или /events
+        cache.publish_done(task_id, "success", result)
+    except redis.RedisError as e:
+        logger.warning(f"Failed to cache analysis result: {str(e)}")
+    return result
+
+def _device_id_ranges(db: Session, owner: str = None):
+    """
+    Разбиение устройств (пользователя или всего парка) на диапазоны id по DEVICE_CHUNK_SIZE устройств.
+    :return: Список кортежей (первый id, последний id, количество устройств).
+    """
+    ranked = db.query(
+        Device.id.label("id"),
+        ((func.row_number().over(order_by=Device.id) - 1) / DEVICE_CHUNK_SIZE).label("chunk")
+    )
+    if owner is not None:
+        ranked = ranked.filter(Device.owner == owner)
+    ranked = ranked.subquery()
+    return [
+        (first_id, last_id, devices)
+        for first_id, last_id, devices in db.query(func.min(ranked.c.id), func.max(ranked.c.id), func.count())
+        .group_by(ranked.c.chunk).order_by(func.min(ranked.c.id))
+    ]
+
+def _start_job(db: Session, task_id: str, owner: str, start_time: datetime, end_time: datetime,
+               total_devices: int) -> AnalysisJob:
+    """Запись анализа пользователя или парка (создается, если задача запущена не через API)"""
+    job = db.query(AnalysisJob).filter(AnalysisJob.task_id == task_id).first()
+    if job is None:
+        job = AnalysisJob(task_id=task_id, owner=owner, start_time=start_time, end_time=end_time)
+        db.add(job)
+    job.total_devices = total_devices
+    job.processed_devices = 0
+    db.commit()
+    return job
+
+def _finish_job(db: Session, job_id: int, status: str):
+    db.execute(
+        update(AnalysisJob).where(AnalysisJob.id == job_id)
+        .values(status=status, finished_at=datetime.utcnow())
+    )
+    db.commit()
+
+def _notify_job_done(task_id: str, status: str):
+    try:
+        cache.publish_done(task_id, status)
+    except redis.RedisError as e:
+        logger.warning(f"Failed to publish analysis completion: {str(e)}")
+
+def _analyze_device_range(db: Session, job_id: int, task_id: str, first_id: int, last_id: int,
+                          start_time: datetime, end_time: datetime, owner: str = None, read_db: Session = None):
+    """
+    Средние значения за период для всех устройств диапазона одним сгруппированным запросом
+    (через read_db, по умолчанию - db) и массовая запись результатов в analysis_results
+    вместе с продвижением счетчика задания.
+    :return: Словарь {device_id устройства: результат} для устройств, у которых есть записи за период.
+    """
+    results = {}
+    rows = []
+    totals = devices_window_totals(read_db or db, first_id, last_id, start_time, end_time, owner=owner)
+    for device_pk, device_id, total_records, sum_x, sum_y, sum_z in totals:
+        if not total_records:
+            continue
+        result = {
+            "avg_x": sum_x / total_records,
+            "avg_y": sum_y / total_records,
+            "avg_z": sum_z / total_records,
+            "total_records": total_records
+        }
+        results[device_id] = result
+        rows.append(dict(
+            result,
+            task_id=f"{task_id}:{device_pk}",
+            device_id=device_pk,
+            job_id=job_id,
+            start_time=start_time,
+            end_time=end_time
+        ))
+    metrics.ANALYSIS_RECORDS.labels("device_range").observe(sum(row[2] for row in totals))
+    if rows:
+        db.execute(insert(AnalysisResult), rows)
+    db.execute(
+        update(AnalysisJob).where(AnalysisJob.id == job_id)
+        .values(processed_devices=AnalysisJob.processed_devices + len(totals))
+    )
+    db.commit()
+    return results
+
+def _analyze_devices(task, owner: str, start_time: datetime, end_time: datetime):
+    """
+    Анализ всех устройств пользователя (или всего парка при owner=None).
+    Ход анализа записывается в analysis_jobs, результаты по устройствам - в analysis_results с job_id.
+    Небольшой набор устройств считается одним запросом прямо в задаче; большой делится на диапазоны id,
+    которые считаются параллельно группой задач, а merge_device_ranges сводит их в один результат.
+    """
+    task_id = task.request.id
+    with Session(engine) as db:
+        ranges = _device_id_ranges(db, owner)
+        job = _start_job(db, task_id, owner, start_time, end_time, sum(devices for _, _, devices in ranges))
+        job_id = job.id
+        if len(ranges) <= 1:
+            try:
+                with _read_session(db, task.request, end_time) as read_db:
+                    chunks = [
+                        _analyze_device_range(
+                            db, job_id, task_id, first_id, last_id, start_time, end_time, owner=owner, read_db=read_db
+                        )
+                        for first_id, last_id, _ in ranges
+                    ]
+            except Exception:
+                db.rollback()
+                _finish_job(db, job_id, "failure")
+                _notify_job_done(task_id, "failure")
+                raise
+            _finish_job(db, job_id, "success")
+            _notify_job_done(task_id, "success")
+            if not ranges:
+                return None
+            logger.info(f"Analysis completed for {len(chunks[0])} devices")
+            return _merge_device_results(chunks, owner, start_time, end_time)
+
+    logger.info(f"Splitting analysis into {len(ranges)} device chunks")
+    # Диапазоны считаются в очереди исходной задачи, а не в очереди по умолчанию
+    queue = OWNER_QUEUE if owner is not None else FLEET_QUEUE
+    header = group(
+        analyze_device_range.s(job_id, task_id, first_id, last_id,
+                               start_time.isoformat(), end_time.isoformat(), owner).set(queue=queue)
+        for first_id, last_id, _ in ranges
+    )
+    # Задача заменяется хордом, результат merge_device_ranges доступен по исходному task_id
+    return task.replace(chord(
+        header,
+        merge_device_ranges.s(job_id, task_id, owner, start_time.isoformat(), end_time.isoformat()).set(queue=queue)
+    ))
+
+def _merge_device_results(chunks: list, owner: str, start_time: datetime, end_time: datetime):
+    devices = {}
+    for chunk in chunks:
+        devices.update(chunk)
+    return {
+        "owner": owner,
+        "start_time": start_time.isoformat(),
+        "end_time": end_time.isoformat(),
+        "total_records": sum(result["total_records"] for result in devices.values()),
+        "devices": devices
+    }
+
+@celery_app.task(bind=True)
+def analyze_user_devices(self, owner: str, start_time: datetime, end_time: datetime):
     """Анализ всех устройств пользователя"""
     logger.info(f"Starting analysis for owner: {owner}")
-    
+    result = _analyze_devices(self, owner, _parse_time(start_time), _parse_time(end_time))
+    if result is None:
+        logger.warning(f"No devices found for owner {owner}")
+    return result
+
+@celery_app.task
+def analyze_device_range(job_id: int, parent_task_id: str, first_id: int, last_id: int,
+                         start_time: str, end_time: str, owner: str = None):
+    """Анализ диапазона устройств в рамках анализа пользователя или всего парка"""
+    start_time, end_time = _parse_time(start_time), _parse_time(end_time)
+    with Session(engine) as db, _read_session(db, analyze_device_range.request, end_time) as read_db:
+        try:
+            return _analyze_device_range(
+                db, job_id, parent_task_id, first_id, last_id, start_time, end_time, owner=owner, read_db=read_db
+            )
+        except Exception:
+            db.rollback()
+            # Хорд не вызовет merge_device_ranges, поэтому задание завершается здесь
+            _finish_job(db, job_id, "failure")
+            _notify_job_done(parent_task_id, "failure")
+            raise
+
+@celery_app.task
+def merge_device_ranges(chunks: list, job_id: int, task_id: str, owner: str, start_time: str, end_time: str):
+    """Сведение результатов диапазонов устройств в один результат"""
     with Session(engine) as db:
-        # Получаем все устройства пользователя
-        devices = db.query(Device).filter(Device.owner == owner).all()
-        
-        if not devices:
-            logger.warning(f"No devices found for owner {owner}")
-            return None
-            
-        results = {}
-        for device in devices:
-            logger.info(f"Starting analysis for device {device.device_id}")
-            # Запускаем анализ для каждого устройства
-            task = analyze_device_stats.delay(device.id, start_time, end_time)
-            results[device.device_id] = task.id
-            
-        logger.info(f"Analysis tasks started for {len(devices)} devices")
-        return results
+        _finish_job(db, job_id, "success")
+    _notify_job_done(task_id, "success")
+    return _merge_device_results(chunks, owner, _parse_time(start_time), _parse_time(end_time))
 
 @celery_app.task
 def analyze_device_data(device_id: int, start_time: str, end_time: str):
+    start_time, end_time = _parse_time(start_time), _parse_time(end_time)
     try:
-        with Session(engine) as db:
-            # Получаем данные устройства за указанный период
-            device_data = db.query(Stat).filter(
-                Stat.device_id == device_id,
-                Stat.timestamp >= start_time,
-                Stat.timestamp <= end_time
-            ).all()
-            
-            if not device_data:
+        with Session(engine) as db, _read_session(db, analyze_device_data.request, end_time) as read_db:
+            result = _analyze_window(db, read_db, analyze_device_data.request.id, device_id, start_time, end_time)
+            if result is None:
                 logger.warning(f"No data found for device {device_id}")
                 return None
             
-            # Рассчитываем средние значения
-            x_values = [data.x for data in device_data]
-            y_values = [data.y for data in device_data]
-            z_values = [data.z for data in device_data]
-            
-            avg_x = sum(x_values) / len(x_values)
-            avg_y = sum(y_values) / len(y_values)
-            avg_z = sum(z_values) / len(z_values)
-            
-            # Создаем запись с результатами анализа
-            analysis_result = AnalysisResult(
-                task_id=analyze_device_data.request.id,
-                device_id=device_id,
-                start_time=start_time,
-                end_time=end_time,
-                avg_x=avg_x,
-                avg_y=avg_y,
-                avg_z=avg_z,
-                total_records=len(device_data)
-            )
-            
-            db.add(analysis_result)
-            db.commit()
-            
             logger.info(f"Analysis completed for device {device_id}")
-            return analysis_result
+            return result
             
     except Exception as e:
         logger.error(f"Error analyzing device {device_id}: {str(e)}")
         return None
 
-@celery_app.task
-def analyze_all_devices(start_time: str, end_time: str):
+@celery_app.task(bind=True)
+def analyze_all_devices(self, start_time: str, end_time: str):
     try:
-        with Session(engine) as db:
-            # Получаем все устройства
-            devices = db.query(Device).all()
-            
-            if not devices:
-                return {
-                    "status": "error",
-                    "message": "Нет доступных устройств"
-                }
-            
-            # Создаем задачи для каждого устройства
-            results = []
-            for device in devices:
-                task = analyze_device_data.delay(
-                    device_id=device.id,
-                    start_time=start_time,
-                    end_time=end_time
-                )
-                results.append({
-                    "device_id": device.id,
-                    "task_id": task.id
-                })
-            
-            logger.info(f"Analysis tasks started for {len(devices)} devices")
-            return results
+        result = _analyze_devices(self, None, _parse_time(start_time), _parse_time(end_time))
+        if result is None:
+            return {
+                "status": "error",
+                "message": "Нет доступных устройств"
+            }
+        return result
             
+    except Ignore:
+        # Задача заменена хордом по диапазонам устройств
+        raise
     except Exception as e:
-        logger.error(f"Error starting analysis tasks: {str(e)}")
+        logger.error(f"Error analyzing devices: {str(e)}")
         return {
             "status": "error",
             "message": str(e)
         }
+
+
+@celery_app.task
+def maintain_partitions():
+    """Создание секций на ближайшие месяцы и отсоединение устаревших"""
+    created = ensure_partitions(engine, months_ahead=PARTITION_MONTHS_AHEAD)
+    detached = []
+    if PARTITION_RETENTION_MONTHS:
+        detached = detach_old_partitions(engine, PARTITION_RETENTION_MONTHS)
+    return {"created": created, "detached": detached}
+
+@celery_app.task
+def rebuild_rollups(device_id: int = None):
+    """Пересчет часовых агрегатов по stats для одного или всех устройств"""
+    with Session(engine) as db:
+        if device_id is None:
+            device_ids = [row.id for row in db.query(Device.id).all()]
+        else:
+            device_ids = [device_id]
+        buckets = 0
+        for current_id in device_ids:
+            buckets += rebuild(db, current_id)
+        logger.info(f"Rebuilt {buckets} rollup buckets for {len(device_ids)} devices")
+        return {"devices": len(device_ids), "buckets": buckets}
+
+@celery_app.task
+def archive_stats():
+    """Перенос месяцев статистики старше STATS_ARCHIVE_AFTER_DAYS дней из stats в архивные сегменты"""
+    if not archive.enabled():
+        return {"segments": 0, "rows": 0}
+    with Session(engine) as db:
+        result = archive.run(db)
+    logger.info(f"Archived {result['rows']} stats rows into {result['segments']} segments")
+    return result
+
+@celery_app.task
+def apply_retention():
+    """Удаление строк старше сроков хранения из retention_policies"""
+    with Session(engine) as db:
+        report = retention.apply_policies(db)
+    logger.info(f"Retention applied in {report['seconds']}s: " + ", ".join(
+        f"{table} {report[table]['rows']} rows" for table in retention.TABLES
+    ))
+    return report
+
+@celery_app.task
+def prune_analysis_results():
+    """Удаление результатов анализа, замененных более новыми, и пустых завершенных заданий"""
+    with Session(engine) as db:
+        report = retention.prune_analysis(db)
+    logger.info(f"Pruned {report['superseded_results']} superseded analysis results "
+                f"and {report['jobs']} jobs in {report['seconds']}s")
+    return report
+
+@celery_app.task
+def refresh_series():
+    """Пересчет прореженных рядов 1m/1h/1d по новым записям stats"""
+    with Session(engine) as db:
+        affected = series.refresh(db)
+        logger.info(f"Series refreshed, affected minute buckets: {affected}")
+        return {"affected_buckets": affected}
+
+# Периодические задачи (celery beat)
+celery_app.conf.beat_schedule = {
+    "maintain-partitions": {
+        "task": maintain_partitions.name,
+        "schedule": crontab(hour=0, minute=30)
+    },
+    "refresh-series": {
+        "task": refresh_series.name,
+        "schedule": 60.0
+    },
+    "archive-stats": {
+        "task": archive_stats.name,
+        "schedule": crontab(hour=1, minute=30)
+    },
+    "apply-retention": {
+        "task": apply_retention.name,
+        "schedule": crontab(minute="*/15")
+    },
+    "prune-analysis-results": {
+        "task": prune_analysis_results.name,
+        "schedule": crontab(minute=45)
+    }
+}
+
+celery_app.conf.update(
+    task_queues=[Queue(name, Exchange(name), routing_key=name) for name in QUEUES],
+    task_default_queue=INTERACTIVE_QUEUE,
+    task_routes={
+        analyze_device_stats.name: {"queue": INTERACTIVE_QUEUE},
+        analyze_device_data.name: {"queue": INTERACTIVE_QUEUE},
+        analyze_user_devices.name: {"queue": OWNER_QUEUE},
+        analyze_all_devices.name: {"queue": FLEET_QUEUE},
+        maintain_partitions.name: {"queue": MAINTENANCE_QUEUE},
+        rebuild_rollups.name: {"queue": MAINTENANCE_QUEUE},
+        archive_stats.name: {"queue": MAINTENANCE_QUEUE},
+        apply_retention.name: {"queue": MAINTENANCE_QUEUE},
+        prune_analysis_results.name: {"queue": MAINTENANCE_QUEUE},
+        refresh_series.name: {"queue": MAINTENANCE_QUEUE}
+    },
+    # Воркер не резервирует задачи впрок, поэтому задача не ждет за чужой долгой задачей
+    worker_prefetch_multiplier=int(os.getenv("CELERY_PREFETCH_MULTIPLIER", "1"))
+)
+
+def queue_depths() -> dict:
+    """Количество ожидающих задач в каждой очереди"""
+    depths = {}
+    with celery_app.connection_or_acquire() as connection:
+        # Недоступный брокер не должен задерживать сбор метрик повторными попытками
+        connection.ensure_connection(max_retries=1)
+        channel = connection.default_channel
+        for queue in celery_app.conf.task_queues:
+            depths[queue.name] = queue(channel).queue_declare().message_count
+    return depths
@@ -0,0 +1,61 @@
+"""
+Микробенчмарк расчета статистики по x, y, z.
+
+  legacy   - прежняя реализация: три вызова calculate_statistics по спискам Python
+             (min/max/len/sum и statistics.median с полной сортировкой)
+  describe - analitics.describe: один вызов по массиву N×3, медиана через np.partition
+
+Запуск:
+  python -m benchmarks.bench_statistics --sizes 1000 100000 10000000
+"""
+import argparse
+import time
+from statistics import median
+import numpy as np
+from app.analitics import describe
+
+def legacy_calculate_statistics(data):
+    """Реализация calculate_statistics до перехода на NumPy"""
+    if not data:
+        return {"min": None, "max": None, "count": 0, "sum": 0, "median": None}
+    return {
+        "min": min(data),
+        "max": max(data),
+        "count": len(data),
+        "sum": sum(data),
+        "median": median(data)
+    }
+
+def legacy(values: np.ndarray):
+    x_values, y_values, z_values = (values[:, i].tolist() for i in range(3))
+    started = time.perf_counter()
+    for axis_values in (x_values, y_values, z_values):
+        legacy_calculate_statistics(axis_values)
+    return time.perf_counter() - started
+
+def vectorized(values: np.ndarray):
+    started = time.perf_counter()
+    describe(values)
+    return time.perf_counter() - started
+
+def best_of(function, values: np.ndarray, repeat: int):
+    return min(function(values) for _ in range(repeat))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 100_000, 10_000_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    print(f"{'rows':>10} {'legacy, ms':>12} {'describe, ms':>14} {'speedup':>8}")
+    for size in args.sizes:
+        values = rng.uniform(-100, 100, size=(size, 3))
+        legacy_time = best_of(legacy, values, args.repeat)
+        vectorized_time = best_of(vectorized, values, args.repeat)
+        print(f"{size:>10} {legacy_time * 1000:>12.2f} {vectorized_time * 1000:>14.2f} "
+              f"{legacy_time / vectorized_time:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Бенчмарк диапазонных запросов к stats на больших объемах (10M+ строк).
+
+Сравниваются три варианта одной и той же таблицы:
+  plain       - без индекса по (device_id, timestamp), как было до индекса
+  indexed     - составной индекс (device_id, timestamp)
+  partitioned - секционирование по месяцам + составной индекс
+
+Данные генерируются на стороне Postgres (generate_series) в отдельной схеме bench.
+Запуск:
+  python -m benchmarks.bench_stats_index --rows 10000000 --devices 1000 --months 12
+"""
+import argparse
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import text
+from app.database import make_engine
+from app.partitions import _month_start
+
+SCHEMA = "bench"
+VARIANTS = ("plain", "indexed", "partitioned")
+
+COLUMNS = """
+    id BIGSERIAL,
+    device_id INTEGER,
+    "timestamp" TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    x DOUBLE PRECISION,
+    y DOUBLE PRECISION,
+    z DOUBLE PRECISION
+"""
+
+WINDOW_QUERY = """
+SELECT count(*), avg(x), avg(y), avg(z)
+FROM {table}
+WHERE device_id = :device_id AND "timestamp" >= :start_time AND "timestamp" <= :end_time
+"""
+
+def generate(engine, rows: int, devices: int, start: datetime, months: int):
+    end = _month_start(start.date(), months)
+    step = (datetime.combine(end, datetime.min.time()) - start).total_seconds() / rows
+    with engine.begin() as connection:
+        connection.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+        connection.execute(text(f"CREATE SCHEMA {SCHEMA}"))
+        connection.execute(text(f"CREATE TABLE {SCHEMA}.stats_plain ({COLUMNS}, PRIMARY KEY (id))"))
+        connection.execute(text(f"""
+            INSERT INTO {SCHEMA}.stats_plain (device_id, "timestamp", x, y, z)
+            SELECT (g % :devices) + 1,
+                   :start_time + g * :step * interval '1 second',
+                   random() * 200 - 100, random() * 200 - 100, random() * 200 - 100
+            FROM generate_series(0, :rows - 1) AS g
+        """), {"devices": devices, "start_time": start, "step": step, "rows": rows})
+
+        connection.execute(text(f"CREATE TABLE {SCHEMA}.stats_indexed ({COLUMNS}, PRIMARY KEY (id))"))
+        connection.execute(text(f"INSERT INTO {SCHEMA}.stats_indexed SELECT * FROM {SCHEMA}.stats_plain"))
+        connection.execute(text(
+            f'CREATE INDEX ON {SCHEMA}.stats_indexed (device_id, "timestamp")'
+        ))
+
+        connection.execute(text(
+            f'CREATE TABLE {SCHEMA}.stats_partitioned ({COLUMNS}, PRIMARY KEY (id, "timestamp")) '
+            f'PARTITION BY RANGE ("timestamp")'
+        ))
+        for shift in range(months):
+            month = _month_start(start.date(), shift)
+            connection.execute(text(
+                f"CREATE TABLE {SCHEMA}.stats_partitioned_{shift} PARTITION OF {SCHEMA}.stats_partitioned "
+                f"FOR VALUES FROM ('{month.isoformat()}') TO ('{_month_start(month, 1).isoformat()}')"
+            ))
+        connection.execute(text(
+            f'CREATE INDEX ON {SCHEMA}.stats_partitioned (device_id, "timestamp")'
+        ))
+        connection.execute(text(f"INSERT INTO {SCHEMA}.stats_partitioned SELECT * FROM {SCHEMA}.stats_plain"))
+
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        for variant in VARIANTS:
+            connection.execute(text(f"VACUUM ANALYZE {SCHEMA}.stats_{variant}"))
+
+def run_queries(engine, variant: str, windows: list):
+    query = text(WINDOW_QUERY.format(table=f"{SCHEMA}.stats_{variant}"))
+    timings = []
+    with engine.connect() as connection:
+        for params in windows:
+            started = time.perf_counter()
+            connection.execute(query, params).fetchall()
+            timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return {
+        "p50_ms": statistics.median(timings),
+        "p95_ms": timings[int(len(timings) * 0.95) - 1],
+        "mean_ms": statistics.mean(timings)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--months", type=int, default=12)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--window-hours", type=int, default=24)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--skip-generate", action="store_true", help="Использовать уже сгенерированную схему bench")
+    parser.add_argument("--keep", action="store_true", help="Не удалять схему bench после прогона")
+    args = parser.parse_args()
+
+    engine = make_engine("bench")
+    start = datetime(2024, 1, 1)
+    if not args.skip_generate:
+        started = time.perf_counter()
+        generate(engine, args.rows, args.devices, start, args.months)
+        print(f"Generated {args.rows} rows in {time.perf_counter() - started:.1f}s")
+
+    rng = random.Random(args.seed)
+    span_hours = (datetime.combine(_month_start(start.date(), args.months), datetime.min.time()) - start) \
+        .total_seconds() / 3600 - args.window_hours
+    windows = []
+    for _ in range(args.queries):
+        window_start = start + timedelta(hours=rng.uniform(0, span_hours))
+        windows.append({
+            "device_id": rng.randint(1, args.devices),
+            "start_time": window_start,
+            "end_time": window_start + timedelta(hours=args.window_hours)
+        })
+
+    print(f"{'variant':<12} {'p50, ms':>10} {'p95, ms':>10} {'mean, ms':>10}")
+    for variant in VARIANTS:
+        result = run_queries(engine, variant, windows)
+        print(f"{variant:<12} {result['p50_ms']:>10.2f} {result['p95_ms']:>10.2f} {result['mean_ms']:>10.2f}")
+
+    # План запроса для секционированной таблицы показывает отсечение секций
+    with engine.connect() as connection:
+        plan = connection.execute(
+            text("EXPLAIN " + WINDOW_QUERY.format(table=f"{SCHEMA}.stats_partitioned")), windows[0]
+        ).scalars().all()
+    print("\n".join(plan))
+
+    if not args.keep:
+        with engine.begin() as connection:
+            connection.execute(text(f"DROP SCHEMA {SCHEMA} CASCADE"))
+
+if __name__ == "__main__":
+    main()
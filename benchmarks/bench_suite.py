@@ -0,0 +1,212 @@
+"""
+Воспроизводимые микробенчмарки с результатами в JSON (формат benchmarks.report).
+
+  micro - analitics.calculate_statistics и analitics.describe на массивах с фиксированным seed
+          (без БД, 10K-10M строк), а также разбор пакета записи: JSON через pydantic и двоичный формат
+          (binary_ingest.decode + to_copy_binary), ответ GET stats: list[StatResponse] и layout=columnar
+  db    - запросы задач анализа на данных, сгенерированных в Postgres с setseed:
+          window_statistics (analyze_device_stats), aggregate_stats (точный расчет по stats)
+          и devices_window_totals (диапазон устройств в analyze_user_devices / analyze_all_devices)
+
+Данные db создаются в основных таблицах на устройствах bench-<seed>-N владельца bench-owner-<seed>
+и удаляются после прогона (кроме --keep). Повторный запуск с --skip-generate использует уже созданные данные.
+
+Запуск:
+  python -m benchmarks.bench_suite micro --sizes 10000 1000000 10000000 --output results.json
+  python -m benchmarks.bench_suite db --rows 10000000 --devices 1000 --output results.json
+  python -m benchmarks.report results.json --baseline benchmarks/baseline.json
+"""
+import argparse
+import json
+import random
+import time
+from datetime import datetime, timedelta
+import numpy as np
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from types import SimpleNamespace
+from fastapi.encoders import jsonable_encoder
+from pydantic import parse_raw_as
+from app.analitics import aggregate_stats, calculate_statistics, describe
+from app import binary_ingest, export
+from app.schemas import StatBatchItem, StatResponse
+from app.database import make_engine
+from app.rollups import devices_window_totals, rebuild, window_statistics
+from . import report
+
+# Начало сгенерированных данных: фиксированное, чтобы окна запросов совпадали между прогонами
+DATA_START = datetime(2024, 1, 1)
+DATA_SPAN = timedelta(days=30)
+
+def _measure(function, repeat: int):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+def run_micro(sizes, repeat: int, seed: int) -> dict:
+    results = {}
+    for size in sizes:
+        values = np.random.default_rng(seed).uniform(-100, 100, size=(size, 3))
+        axes = [values[:, i].tolist() for i in range(3)]
+        # Как в прежнем эндпоинте аналитики: по вызову на каждую ось
+        results[f"micro.calculate_statistics[{size}]"] = report.summarize(
+            _measure(lambda: [calculate_statistics(axis_values) for axis_values in axes], repeat), size, "rows/s"
+        )
+        results[f"micro.describe[{size}]"] = report.summarize(
+            _measure(lambda: describe(values), repeat), size, "rows/s"
+        )
+        print(f"micro {size}: done")
+
+    # Разбор пакета записи в пределах ограничений API (MAX_STAT_BATCH_SIZE для JSON)
+    size = 10_000
+    values = np.random.default_rng(seed).uniform(-100, 100, size=(size, 3))
+    timestamps = 1_700_000_000_000_000 + np.arange(size) * 1000
+    json_body = json.dumps([
+        {"timestamp": datetime.utcfromtimestamp(ts / 1e6).isoformat(), "x": x, "y": y, "z": z}
+        for ts, (x, y, z) in zip(timestamps.tolist(), values.tolist())
+    ])
+    binary_body = binary_ingest.encode(timestamps, values)
+    results[f"micro.ingest_parse_json[{size}]"] = report.summarize(
+        _measure(lambda: [item.dict() for item in parse_raw_as(list[StatBatchItem], json_body)], repeat),
+        size, "rows/s"
+    )
+    results[f"micro.ingest_parse_binary[{size}]"] = report.summarize(
+        _measure(lambda: binary_ingest.to_copy_binary(1, binary_ingest.decode(binary_body)), repeat),
+        size, "rows/s"
+    )
+    print(f"ingest body bytes per row: json {len(json_body) / size:.1f}, binary {len(binary_body) / size:.1f}")
+
+    # Ответ GET /devices/{id}/stats/ за большое окно: как response_model в FastAPI и layout=columnar с gzip
+    size = 100_000
+    rows = [
+        (datetime.utcfromtimestamp(ts / 1e6), x, y, z)
+        for ts, (x, y, z) in zip((1_700_000_000_000_000 + np.arange(size) * 1000).tolist(),
+                                 np.random.default_rng(seed).uniform(-100, 100, size=(size, 3)).tolist())
+    ]
+    objects = [
+        SimpleNamespace(id=i, device_id=1, timestamp=ts, x=x, y=y, z=z) for i, (ts, x, y, z) in enumerate(rows)
+    ]
+    rows_body = json.dumps(jsonable_encoder([StatResponse.from_orm(item) for item in objects])).encode()
+    columnar_body, _ = export.encode_json(export.columnar(rows), "gzip")
+    results[f"micro.stats_response_rows[{size}]"] = report.summarize(
+        _measure(lambda: json.dumps(jsonable_encoder([StatResponse.from_orm(item) for item in objects])), repeat),
+        size, "rows/s"
+    )
+    results[f"micro.stats_response_columnar[{size}]"] = report.summarize(
+        _measure(lambda: export.encode_json(export.columnar(rows), "gzip"), repeat), size, "rows/s"
+    )
+    print(f"stats response bytes per row: rows {len(rows_body) / size:.1f}, "
+          f"columnar gzip {len(columnar_body) / size:.1f}")
+    return results
+
+def _prefix(seed: int) -> str:
+    return f"bench-{seed}-"
+
+def generate(engine, rows: int, devices: int, seed: int):
+    """Устройства и статистика одним INSERT ... SELECT с детерминированным random() и агрегаты по ним"""
+    per_device = max(rows // devices, 1)
+    step = DATA_SPAN / per_device
+    with engine.begin() as connection:
+        connection.execute(text("SELECT setseed(:seed)"), {"seed": (seed % 1000) / 1000})
+        connection.execute(text("""
+            INSERT INTO devices (device_id, owner, created_at)
+            SELECT :prefix || g, :owner, :start FROM generate_series(1, :devices) AS g
+        """), {"prefix": _prefix(seed), "owner": f"bench-owner-{seed}", "start": DATA_START, "devices": devices})
+        connection.execute(text("""
+            INSERT INTO stats (device_id, "timestamp", x, y, z)
+            SELECT d.id, :start + g * :step, random() * 200 - 100, random() * 200 - 100, random() * 200 - 100
+            FROM devices AS d, generate_series(0, :per_device - 1) AS g
+            WHERE d.device_id LIKE :prefix || '%'
+            ORDER BY d.id, g
+        """), {"prefix": _prefix(seed), "start": DATA_START, "step": step, "per_device": per_device})
+    with Session(engine) as db:
+        for device_pk in _device_pks(engine, seed):
+            rebuild(db, device_pk)
+
+def _device_pks(engine, seed: int):
+    with engine.connect() as connection:
+        return [row[0] for row in connection.execute(
+            text("SELECT id FROM devices WHERE device_id LIKE :prefix || '%' ORDER BY id"),
+            {"prefix": _prefix(seed)}
+        )]
+
+def cleanup(engine, seed: int):
+    with engine.begin() as connection:
+        device_filter = "device_id IN (SELECT id FROM devices WHERE device_id LIKE :prefix || '%')"
+        for table in ("analysis_results", "stat_series", "stat_rollups", "stats"):
+            connection.execute(text(f"DELETE FROM {table} WHERE {device_filter}"), {"prefix": _prefix(seed)})
+        connection.execute(text("DELETE FROM devices WHERE device_id LIKE :prefix || '%'"), {"prefix": _prefix(seed)})
+
+def run_db(engine, rows: int, devices: int, repeat: int, seed: int, window_hours) -> dict:
+    device_pks = _device_pks(engine, seed)
+    if not device_pks:
+        raise SystemExit("Нет сгенерированных данных, запустите без --skip-generate")
+    rng = random.Random(seed)
+    per_device = max(rows // devices, 1)
+    results = {}
+    with Session(engine) as db:
+        for hours in window_hours:
+            window = timedelta(hours=hours)
+            # Одинаковая последовательность окон в каждом прогоне
+            windows = [
+                (rng.choice(device_pks), DATA_START + rng.random() * (DATA_SPAN - window))
+                for _ in range(repeat)
+            ]
+            for name, function in (
+                ("window_statistics", lambda device_pk, start: window_statistics(db, device_pk, start, start + window)),
+                ("aggregate_stats", lambda device_pk, start: aggregate_stats(db, device_pk, start, start + window))
+            ):
+                samples = []
+                for device_pk, start in windows:
+                    started = time.perf_counter()
+                    function(device_pk, start)
+                    samples.append(time.perf_counter() - started)
+                rows_per_window = per_device * (window / DATA_SPAN)
+                results[f"db.{name}[{hours}h]"] = report.summarize(samples, rows_per_window, "rows/s")
+            print(f"db window {hours}h: done")
+
+        # Диапазон устройств целиком за весь период, как в анализе пользователя
+        samples = _measure(
+            lambda: devices_window_totals(db, device_pks[0], device_pks[-1], DATA_START, DATA_START + DATA_SPAN),
+            max(repeat // 10, 3)
+        )
+        results[f"db.devices_window_totals[{devices}]"] = report.summarize(samples, len(device_pks), "devices/s")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("suite", choices=("micro", "db"))
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeat", type=int, default=30)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000, 10_000_000])
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--window-hours", type=int, nargs="+", default=[1, 24, 168])
+    parser.add_argument("--skip-generate", action="store_true", help="Использовать уже сгенерированные данные")
+    parser.add_argument("--keep", action="store_true", help="Не удалять сгенерированные данные после прогона")
+    args = parser.parse_args()
+
+    if args.suite == "micro":
+        results = run_micro(args.sizes, args.repeat, args.seed)
+        report.write(args.output, results, seed=args.seed)
+        return
+
+    engine = make_engine("bench")
+    if not args.skip_generate:
+        cleanup(engine, args.seed)
+        started = time.perf_counter()
+        generate(engine, args.rows, args.devices, args.seed)
+        print(f"Generated {args.rows} rows in {time.perf_counter() - started:.1f}s")
+    try:
+        results = run_db(engine, args.rows, args.devices, args.repeat, args.seed, args.window_hours)
+        report.write(args.output, results, seed=args.seed, rows=args.rows, devices=args.devices)
+    finally:
+        if not args.keep:
+            cleanup(engine, args.seed)
+
+if __name__ == "__main__":
+    main()
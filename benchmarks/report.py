@@ -0,0 +1,124 @@
+"""
+Общий формат результатов бенчмарков и сравнение с сохраненным baseline.
+
+Файл результатов:
+  {"meta": {...}, "results": {"<имя>": {"p50_ms", "p95_ms", "p99_ms", "throughput", "throughput_unit", "samples"}}}
+
+Сравнение: задержки (p50/p95/p99) не должны вырасти, а пропускная способность - упасть
+больше чем на tolerance (доля, по умолчанию 0.2) относительно baseline; ошибок запросов не должно стать больше.
+
+Если baseline еще нет (первый запуск на окружении), результаты сохраняются как baseline и сравнение пропускается.
+
+Запуск:
+  python -m benchmarks.report results.json --baseline benchmarks/baseline.json --tolerance 0.2
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+from datetime import datetime
+import numpy as np
+
+LATENCY_KEYS = ("p50_ms", "p95_ms", "p99_ms")
+
+def summarize(samples_seconds, items_per_sample: float = 1, unit: str = "ops/s") -> dict:
+    """Перцентили задержки в миллисекундах и пропускная способность по замерам в секундах"""
+    samples = np.asarray(samples_seconds, dtype=np.float64) * 1000
+    p50, p95, p99 = np.percentile(samples, (50, 95, 99))
+    return {
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+        "throughput": round(float(items_per_sample * len(samples) / (samples.sum() / 1000)), 3),
+        "throughput_unit": unit,
+        "samples": len(samples)
+    }
+
+def _git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def write(path: str, results: dict, **meta):
+    """Записывает результаты; существующий файл дополняется (разные наборы бенчмарков пишут в один файл)"""
+    try:
+        with open(path) as file:
+            report = json.load(file)
+    except FileNotFoundError:
+        report = {"meta": {}, "results": {}}
+    report["meta"].update(
+        meta,
+        created_at=datetime.utcnow().isoformat(),
+        revision=_git_revision(),
+        python=platform.python_version(),
+        machine=platform.machine()
+    )
+    report["results"].update(results)
+    with open(path, "w") as file:
+        json.dump(report, file, indent=2, sort_keys=True)
+    return report
+
+def compare(results: dict, baseline: dict, tolerance: float = 0.2) -> list:
+    """
+    :return: Список регрессий - строк с описанием, пустой список, если регрессий нет.
+    Бенчмарки, которых нет в baseline, не сравниваются.
+    """
+    regressions = []
+    for name, expected in sorted(baseline.items()):
+        actual = results.get(name)
+        if actual is None:
+            continue
+        for key in LATENCY_KEYS:
+            if key in expected and actual[key] > expected[key] * (1 + tolerance):
+                regressions.append(f"{name}: {key} {actual[key]} > {expected[key]} (+{tolerance:.0%})")
+        if actual.get("failures", 0) > expected.get("failures", 0):
+            regressions.append(f"{name}: failures {actual['failures']} > {expected.get('failures', 0)}")
+        if "throughput" in expected and actual["throughput"] < expected["throughput"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: throughput {actual['throughput']} < {expected['throughput']} (-{tolerance:.0%})"
+            )
+    return regressions
+
+def _save_baseline(path: str, results: dict):
+    with open(path, "w") as file:
+        json.dump(results, file, indent=2, sort_keys=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("results")
+    parser.add_argument("--baseline", default="benchmarks/baseline.json")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--update-baseline", action="store_true", help="Сохранить результаты как новый baseline")
+    args = parser.parse_args()
+
+    with open(args.results) as file:
+        results = json.load(file)
+    if args.update_baseline:
+        _save_baseline(args.baseline, results)
+        print(f"Baseline сохранен в {args.baseline}")
+        return
+
+    try:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    except FileNotFoundError:
+        _save_baseline(args.baseline, results)
+        print(f"Baseline {args.baseline} не найден: текущие результаты сохранены как baseline, сравнение пропущено")
+        return
+
+    regressions = compare(results["results"], baseline["results"], args.tolerance)
+    for name, actual in sorted(results["results"].items()):
+        expected = baseline["results"].get(name, {})
+        print(f"{name:<40} p95 {actual['p95_ms']:>10.2f} ms (baseline {expected.get('p95_ms', '-')}), "
+              f"{actual['throughput']:>12.1f} {actual['throughput_unit']}")
+    if regressions:
+        print("\nРегрессии:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+    print("\nРегрессий нет")
+
+if __name__ == "__main__":
+    main()
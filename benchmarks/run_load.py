@@ -0,0 +1,66 @@
+"""
+Headless-профили нагрузки locust (tests/locustfile.py) с результатами в JSON (формат benchmarks.report).
+
+  ingest      - IngestUser: пакетная и одиночная запись
+  read        - ReadUser: страницы статистики, аналитика, прореженные ряды
+  analysis    - AnalysisUser: анализ устройства с ожиданием результата
+  large-owner - LargeOwnerUser: анализ владельца с --owner-devices устройствами
+
+Частота анализа ограничена по владельцу (OWNER_ANALYSIS_RATE, OWNER_ANALYSIS_BURST). Ответы 429 с Retry-After
+не считаются ошибками и попадают в результаты отдельно, как "<запрос> (429)". Чтобы профили analysis и large-owner
+измеряли сам анализ, а не ограничитель, API запускают с увеличенными лимитами, например
+OWNER_ANALYSIS_RATE=1000 OWNER_ANALYSIS_BURST=1000.
+
+Запуск (API должен быть поднят):
+  python -m benchmarks.run_load --host http://localhost:8000 --profiles ingest read --output results.json
+  python -m benchmarks.report results.json --baseline benchmarks/baseline.json
+"""
+import argparse
+import subprocess
+import sys
+
+# Профиль: класс пользователя, количество пользователей, скорость запуска (пользователей/сек), длительность
+PROFILES = {
+    "ingest": ("IngestUser", 50, 10, "2m"),
+    "read": ("ReadUser", 50, 10, "2m"),
+    "analysis": ("AnalysisUser", 20, 5, "2m"),
+    "large-owner": ("LargeOwnerUser", 5, 1, "3m")
+}
+
+def run_profile(name: str, host: str, output: str, seed: int, extra=()):
+    user_class, users, spawn_rate, duration = PROFILES[name]
+    command = [
+        "locust", "-f", "tests/locustfile.py", user_class,
+        "--headless", "--only-summary",
+        "--host", host,
+        "--users", str(users),
+        "--spawn-rate", str(spawn_rate),
+        "--run-time", duration,
+        "--seed", str(seed),
+        "--profile-name", f"load.{name}",
+        "--results-json", output,
+        *extra
+    ]
+    print(" ".join(command))
+    return subprocess.run(command).returncode
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="http://localhost:8000")
+    parser.add_argument("--profiles", nargs="+", choices=sorted(PROFILES), default=sorted(PROFILES))
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--owner-devices", type=int, default=2000)
+    args = parser.parse_args()
+
+    failed = []
+    for name in args.profiles:
+        extra = ("--owner-devices", str(args.owner_devices)) if name == "large-owner" else ()
+        if run_profile(name, args.host, args.output, args.seed, extra):
+            failed.append(name)
+    if failed:
+        print(f"Профили с ошибками запросов: {', '.join(failed)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+#!/bin/sh
+# Выполняется образом postgres при создании кластера (/docker-entrypoint-initdb.d):
+# разрешает подключения репликации для сервиса db-replica
+set -e
+echo "host replication all all md5" >> "$PGDATA/pg_hba.conf"
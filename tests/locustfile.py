@@ -1,72 +1,347 @@
-from locust import HttpUser, task, between
+from locust import HttpUser, events, task, between
 from datetime import datetime, timedelta
+import itertools
+import json
+import os
 import random
+import sys
 import time
 
-class DeviceUser(HttpUser):
+import requests
+
+# Общий формат результатов с бенчмарками (benchmarks/report.py)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks import report  # noqa: E402
+from app import binary_ingest  # noqa: E402
+
+ANALYSIS_WAIT = 30  # Сколько секунд сервер ждет завершения анализа в одном запросе
+
+# Номера пользователей внутри процесса locust: вместе с run id дают уникальные имена устройств
+_user_numbers = itertools.count(1)
+
+
+@events.init_command_line_parser.add_listener
+def _add_arguments(parser):
+    parser.add_argument("--seed", type=int, default=42, env_var="LOCUST_SEED",
+                        help="Seed генерации данных: одинаковый seed дает одинаковые значения")
+    parser.add_argument("--run-id", default="", env_var="LOCUST_RUN_ID",
+                        help="Префикс имен устройств, по умолчанию - seed и время запуска")
+    parser.add_argument("--results-json", default="", env_var="LOCUST_RESULTS_JSON",
+                        help="Файл для результатов в формате benchmarks/report.py")
+    parser.add_argument("--profile-name", default="load", env_var="LOCUST_PROFILE_NAME",
+                        help="Префикс имен результатов в JSON")
+    parser.add_argument("--owner-devices", type=int, default=2000, env_var="LOCUST_OWNER_DEVICES",
+                        help="Количество устройств владельца в профиле LargeOwnerUser")
+    parser.add_argument("--owner-rows-per-device", type=int, default=50, env_var="LOCUST_OWNER_ROWS",
+                        help="Записей статистики на устройство владельца в профиле LargeOwnerUser")
+
+
+def _run_id(environment):
+    options = environment.parsed_options
+    if not options.run_id:
+        options.run_id = f"{options.seed}-{int(time.time())}"
+    return options.run_id
+
+
+def _random_stat(rng):
+    return {
+        "x": rng.uniform(-100, 100),
+        "y": rng.uniform(-100, 100),
+        "z": rng.uniform(-100, 100)
+    }
+
+
+def _post_analysis(client, path, body, name):
+    """
+    Запуск анализа. Ответ 429 с Retry-After - ожидаемое ограничение частоты по владельцу, а не ошибка:
+    он учитывается отдельно под именем "<name> (429)", и пользователь ждет указанное время.
+    """
+    with client.post(path, json=body, name=name, catch_response=True) as response:
+        retry_after = response.headers.get("Retry-After") if response.status_code == 429 else None
+        if retry_after is not None:
+            response.request_meta["name"] = f"{name} (429)"
+            response.success()
+    if retry_after is not None:
+        time.sleep(float(retry_after))
+    return response
+
+
+def _window(hours=1):
+    end_time = datetime.utcnow()
+    return {
+        "start_time": (end_time - timedelta(hours=hours)).isoformat(),
+        "end_time": end_time.isoformat()
+    }
+
+
+class SeededUser(HttpUser):
+    """
+    Базовый пользователь с детерминированными данными и собственным устройством.
+    Значения зависят только от --seed и номера пользователя, имя устройства уникально в пределах --run-id.
+    """
+    abstract = True
     wait_time = between(1, 3)  # Время ожидания между запросами
-    
+    seed_rows = 5
+
     def on_start(self):
         """Выполняется при старте каждого пользователя"""
-        # Создаем тестовое устройство
-        self.device_id = f"test_device_{random.randint(1000, 9999)}"
+        self.user_number = next(_user_numbers)
+        self.rng = random.Random(self.environment.parsed_options.seed * 100003 + self.user_number)
+        self.numeric_device_id = None
+        # Создаем тестовое устройство. Владелец у каждого пользователя свой:
+        # частота анализа ограничивается по владельцу (OWNER_ANALYSIS_RATE)
+        self.device_id = f"load-{_run_id(self.environment)}-{self.user_number}"
         response = self.client.post("/devices/", json={
             "device_id": self.device_id,
-            "owner": "test_user"
-        })
+            "owner": self.device_id
+        }, name="/devices/")
         if response.status_code != 200:
             print(f"Failed to create device: {response.text}")
             return
-            
+
         # Сохраняем числовой ID устройства из ответа
         self.numeric_device_id = response.json()["id"]
-            
+
         # Добавляем начальную статистику для устройства
-        for _ in range(5):  # Добавляем 5 записей статистики
-            self.client.post(f"/devices/{self.numeric_device_id}/stats/", json={
-                "x": random.uniform(-100, 100),
-                "y": random.uniform(-100, 100),
-                "z": random.uniform(-100, 100)
-            })
-        
-        # Добавляем небольшую задержку, чтобы данные успели записаться
-        time.sleep(1)
+        if self.seed_rows:
+            self.client.post(
+                f"/devices/{self.numeric_device_id}/stats/batch",
+                json=self._batch(self.seed_rows),
+                name="/devices/[id]/stats/batch"
+            )
+
+    def _batch(self, size):
+        now = datetime.utcnow()
+        return [
+            dict(_random_stat(self.rng), timestamp=(now - timedelta(milliseconds=i)).isoformat())
+            for i in range(size)
+        ]
 
-    @task(3)
     def add_stats(self):
         """Добавление статистики устройства"""
-        self.client.post(f"/devices/{self.numeric_device_id}/stats/", json={
-            "x": random.uniform(-100, 100),
-            "y": random.uniform(-100, 100),
-            "z": random.uniform(-100, 100)
-        })
+        self.client.post(
+            f"/devices/{self.numeric_device_id}/stats/",
+            json=_random_stat(self.rng),
+            name="/devices/[id]/stats/"
+        )
 
-    @task(1)
     def get_stats(self):
         """Получение статистики устройства"""
-        end_time = datetime.now()
-        start_time = end_time - timedelta(hours=1)
         self.client.get(
             f"/devices/{self.numeric_device_id}/stats/",
-            params={
-                "start_time": start_time.isoformat(),
-                "end_time": end_time.isoformat()
-            }
+            params=_window(),
+            name="/devices/[id]/stats/ (get)"
         )
 
-    @task(1)
     def analyze_device(self):
         """Запуск анализа устройства"""
-        end_time = datetime.now()
-        start_time = end_time - timedelta(hours=1)
-        response = self.client.post(
-            f"/devices/{self.numeric_device_id}/analyze/",
-            json={
-                "start_time": start_time.isoformat(),
-                "end_time": end_time.isoformat()
-            }
+        response = _post_analysis(
+            self.client, f"/devices/{self.numeric_device_id}/analyze/", _window(), "/devices/[id]/analyze/"
         )
-        if response.status_code == 200:
+        if response.status_code == 200 and response.json()["status"] == "pending":
             task_id = response.json()["task_id"]
-            # Получаем результат анализа
-            self.client.get(f"/analysis/{task_id}/") 
\ No newline at end of file
+            # Получаем результат анализа одним запросом, ожидающим завершения задачи
+            self.client.get(
+                f"/analysis/{task_id}/",
+                params={"wait": ANALYSIS_WAIT},
+                name="/analysis/[task_id]/?wait"
+            )
+
+
+class DeviceUser(SeededUser):
+    """Смешанный сценарий: запись по одной записи, чтение и анализ"""
+
+    @task(3)
+    def add_stats_task(self):
+        self.add_stats()
+
+    @task(1)
+    def get_stats_task(self):
+        self.get_stats()
+
+    @task(1)
+    def analyze_device_task(self):
+        self.analyze_device()
+
+
+BATCH_SIZE = 500  # Количество записей в одном пакетном запросе
+
+
+class BatchDeviceUser(SeededUser):
+    """
+    Пакетная загрузка статистики.
+    Пропускная способность в записях/сек = RPS запроса "stats/batch" * BATCH_SIZE,
+    для сравнения с DeviceUser запускайте классы по отдельности:
+    locust -f tests/locustfile.py BatchDeviceUser
+    """
+
+    @task(3)
+    def add_stats_batch(self):
+        """Пакетное добавление статистики устройства"""
+        self.client.post(
+            f"/devices/{self.numeric_device_id}/stats/batch",
+            json=self._batch(BATCH_SIZE),
+            name="/devices/[id]/stats/batch"
+        )
+
+    @task(1)
+    def get_stats_task(self):
+        self.get_stats()
+
+    @task(1)
+    def analyze_device_task(self):
+        self.analyze_device()
+
+
+class IngestUser(SeededUser):
+    """Профиль ingest: почти только запись, пакетами и по одной записи"""
+    wait_time = between(0.1, 0.5)
+
+    @task(5)
+    def add_stats_batch(self):
+        self.client.post(
+            f"/devices/{self.numeric_device_id}/stats/batch",
+            json=self._batch(BATCH_SIZE),
+            name="/devices/[id]/stats/batch"
+        )
+
+    @task(5)
+    def add_stats_task(self):
+        self.add_stats()
+
+    @task(5)
+    def add_stats_binary(self):
+        """Пакет в двоичном формате (см. app/binary_ingest.py)"""
+        now_us = int(time.time() * 1000000)
+        timestamps = [now_us - i * 1000 for i in range(BATCH_SIZE)]
+        values = [[self.rng.uniform(-100, 100) for _ in range(3)] for _ in range(BATCH_SIZE)]
+        self.client.post(
+            f"/devices/{self.numeric_device_id}/stats/binary",
+            data=binary_ingest.encode(timestamps, values),
+            headers={"Content-Type": binary_ingest.MEDIA_TYPE},
+            name="/devices/[id]/stats/binary"
+        )
+
+
+class ReadUser(SeededUser):
+    """Профиль чтения: страницы статистики, аналитика и прореженные ряды по заранее записанным данным"""
+    wait_time = between(0.1, 0.5)
+    seed_rows = 2000
+
+    @task(3)
+    def get_stats_page(self):
+        self.client.get(
+            f"/devices/{self.numeric_device_id}/stats/",
+            params=dict(_window(), limit=100),
+            name="/devices/[id]/stats/?limit"
+        )
+
+    @task(3)
+    def get_analytics(self):
+        self.client.get(
+            f"/devices/{self.numeric_device_id}/analytics/",
+            params=_window(hours=24),
+            name="/devices/[id]/analytics/"
+        )
+
+    @task(2)
+    def get_series(self):
+        window = _window(hours=24)
+        self.client.get(
+            f"/devices/{self.numeric_device_id}/series",
+            params={"start": window["start_time"], "end": window["end_time"]},
+            name="/devices/[id]/series"
+        )
+
+
+class AnalysisUser(SeededUser):
+    """Профиль анализа: запуск анализа устройства и ожидание результата"""
+    wait_time = between(0.5, 1)
+    seed_rows = 500
+
+    @task(1)
+    def add_stats_task(self):
+        self.add_stats()
+
+    @task(4)
+    def analyze_device_task(self):
+        self.analyze_device()
+
+
+class LargeOwnerUser(HttpUser):
+    """
+    Профиль анализа крупного владельца: --owner-devices устройств одного владельца создаются один раз
+    при старте теста, пользователи запускают анализ всех устройств владельца и ждут результата.
+    Все пользователи делят маркерное ведро владельца, поэтому при настройках по умолчанию
+    большая часть запусков получает 429 (см. benchmarks/run_load.py).
+    """
+    wait_time = between(1, 3)
+    owner = None
+
+    @task
+    def analyze_owner(self):
+        response = _post_analysis(
+            self.client, f"/users/{LargeOwnerUser.owner}/analyze/", _window(hours=24), "/users/[owner]/analyze/"
+        )
+        if response.status_code == 200:
+            self.client.get(
+                f"/analysis/{response.json()['task_id']}/",
+                params={"wait": ANALYSIS_WAIT},
+                name="/analysis/[owner task_id]/?wait"
+            )
+
+
+@events.test_start.add_listener
+def _prepare_large_owner(environment, **kwargs):
+    if LargeOwnerUser not in environment.user_classes or LargeOwnerUser.owner is not None:
+        return
+    options = environment.parsed_options
+    owner = f"load-owner-{_run_id(environment)}"
+    rng = random.Random(options.seed)
+    session = requests.Session()
+    device_ids = []
+    for number in range(options.owner_devices):
+        response = session.post(f"{environment.host}/devices/", json={
+            "device_id": f"{owner}-{number}",
+            "owner": owner
+        })
+        response.raise_for_status()
+        device_ids.append(response.json()["id"])
+
+    now = datetime.utcnow()
+    rows = [
+        dict(
+            _random_stat(rng),
+            device_id=device_id,
+            timestamp=(now - timedelta(seconds=i * 60)).isoformat()
+        )
+        for device_id in device_ids
+        for i in range(options.owner_rows_per_device)
+    ]
+    for start in range(0, len(rows), 10000):
+        session.post(f"{environment.host}/stats/batch", json=rows[start:start + 10000]).raise_for_status()
+    LargeOwnerUser.owner = owner
+    print(f"Prepared owner {owner}: {len(device_ids)} devices, {len(rows)} rows")
+
+
+@events.quitting.add_listener
+def _write_results(environment, **kwargs):
+    """Перцентили и RPS по каждому запросу в JSON для сравнения с baseline"""
+    options = environment.parsed_options
+    if not options.results_json:
+        return
+    results = {}
+    for entry in environment.stats.entries.values():
+        if not entry.num_requests:
+            continue
+        results[f"{options.profile_name}.{entry.method} {entry.name}"] = {
+            "p50_ms": entry.get_response_time_percentile(0.5),
+            "p95_ms": entry.get_response_time_percentile(0.95),
+            "p99_ms": entry.get_response_time_percentile(0.99),
+            "throughput": round(entry.total_rps, 3),
+            "throughput_unit": "req/s",
+            "samples": entry.num_requests,
+            "failures": entry.num_failures
+        }
+    report.write(options.results_json, results, seed=options.seed, run_id=options.run_id)
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,42 @@
+import uuid
+import pytest
+import redis
+from fastapi.testclient import TestClient
+from app import cache, crud, main, registry
+
+class _Session:
+    """Сессия без БД: запуск анализа владельца только добавляет запись задания"""
+
+    def add(self, instance):
+        pass
+
+    def commit(self):
+        pass
+
+@pytest.fixture
+def owner(monkeypatch):
+    """Владелец с ведром на 2 анализа всех устройств (скрипт ведра выполняется в Redis из REDIS_URL)"""
+    try:
+        cache.get_redis().ping()
+    except redis.RedisError:
+        pytest.skip("Redis недоступен")
+    name = f"test-rate-limit-{uuid.uuid4()}"
+    monkeypatch.setattr(cache, "OWNER_RATE_LIMIT", 0.5)
+    monkeypatch.setattr(cache, "OWNER_RATE_BURST", 2 * cache.OWNER_ANALYSIS_TOKEN_COST)
+    monkeypatch.setattr(registry, "owner_exists", lambda db, owner: owner == name)
+    monkeypatch.setattr(crud.analyze_user_devices, "apply_async", lambda *args, **kwargs: None)
+    main.app.dependency_overrides[main.get_db] = _Session
+    yield name
+    main.app.dependency_overrides.clear()
+    cache.get_redis().delete(cache.RATE_LIMIT_PREFIX + name)
+
+def test_owner_analysis_past_burst_gets_429(owner):
+    client = TestClient(main.app)
+    window = {"start_time": "2024-01-01T00:00:00", "end_time": "2024-01-02T00:00:00"}
+    for _ in range(2):
+        assert client.post(f"/users/{owner}/analyze/", json=window).status_code == 200
+
+    response = client.post(f"/users/{owner}/analyze/", json=window)
+    assert response.status_code == 429
+    # Маркеры пополняются со скоростью 0.5 в секунду: до 10 маркеров - не больше 20 секунд
+    assert 0 < int(response.headers["Retry-After"]) <= 20
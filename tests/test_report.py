@@ -0,0 +1,37 @@
+import json
+import sys
+from benchmarks import report
+
+BASELINE = {"api": {"p50_ms": 10.0, "p95_ms": 20.0, "p99_ms": 40.0, "throughput": 100.0, "failures": 0}}
+
+def _result(scale_latency: float = 1.0, scale_throughput: float = 1.0, failures: int = 0) -> dict:
+    expected = BASELINE["api"]
+    result = {key: expected[key] * scale_latency for key in report.LATENCY_KEYS}
+    result.update(throughput=expected["throughput"] * scale_throughput, failures=failures)
+    return {"api": result}
+
+def test_compare_within_tolerance():
+    assert report.compare(_result(1.19, 0.81), BASELINE, tolerance=0.2) == []
+
+def test_compare_flags_slower_latency_and_lower_throughput():
+    regressions = report.compare(_result(1.21, 0.79), BASELINE, tolerance=0.2)
+    assert len(regressions) == 4
+    assert [r.split()[1] for r in regressions] == ["p50_ms", "p95_ms", "p99_ms", "throughput"]
+
+def test_compare_ignores_improvements():
+    assert report.compare(_result(0.5, 2.0), BASELINE, tolerance=0.2) == []
+
+def test_compare_flags_new_failures():
+    assert report.compare(_result(failures=3), BASELINE) == ["api: failures 3 > 0"]
+
+def test_compare_skips_benchmarks_missing_from_results():
+    assert report.compare({}, BASELINE) == []
+
+def test_missing_baseline_is_written_on_first_run(tmp_path, monkeypatch):
+    results_path = tmp_path / "results.json"
+    baseline_path = tmp_path / "baseline.json"
+    results = {"meta": {}, "results": _result()}
+    results_path.write_text(json.dumps(results))
+    monkeypatch.setattr(sys, "argv", ["report", str(results_path), "--baseline", str(baseline_path)])
+    report.main()
+    assert json.loads(baseline_path.read_text()) == results
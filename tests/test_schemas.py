@@ -0,0 +1,32 @@
+import math
+import pytest
+from fastapi.testclient import TestClient
+from pydantic import ValidationError
+from app import main, schemas
+
+@pytest.fixture
+def client():
+    # Невалидное тело отклоняется до обращения к БД
+    main.app.dependency_overrides[main.get_db] = lambda: None
+    yield TestClient(main.app)
+    main.app.dependency_overrides.clear()
+
+@pytest.mark.parametrize("value", [math.nan, math.inf, -math.inf, "NaN", "Infinity"])
+@pytest.mark.parametrize("schema", [schemas.StatCreate, schemas.StatBatchItem])
+def test_stat_rejects_non_finite(schema, value):
+    with pytest.raises(ValidationError):
+        schema(x=1.0, y=value, z=3.0)
+
+def test_stat_accepts_finite():
+    stat = schemas.DeviceStatBatchItem(device_id=1, x=-1.5, y=0, z=1e30)
+    assert (stat.x, stat.y, stat.z) == (-1.5, 0.0, 1e30)
+
+# NaN и Infinity - расширение JSON, которое принимает json.loads в Starlette; тело передается как есть
+@pytest.mark.parametrize("path, body", [
+    ("/devices/1/stats/", '{"x": NaN, "y": 0, "z": 0}'),
+    ("/devices/1/stats/batch", '[{"x": 1, "y": Infinity, "z": 0}]'),
+    ("/stats/batch", '[{"device_id": 1, "x": 1, "y": 0, "z": -Infinity}]'),
+])
+def test_ingest_rejects_non_finite(client, path, body):
+    response = client.post(path, data=body, headers={"Content-Type": "application/json"})
+    assert response.status_code == 422